@@ -174,6 +174,31 @@ class FakeConnection(object):
                     if self._matches_cols(cf, cq, cols):
                         yield Cell(row, cf, cq, cv, ts, val)
 
+    def batch_scan(self, table, scanranges=None, cols=None):
+        """ Scan a table over several ranges at once, as pyaccumulo's
+            batch_scan does. Each matching entry is returned once, even
+            if it is in more than one of the ranges; like Accumulo, no
+            order is guaranteed.
+
+            Arguments:
+
+            table : string - the name of the table to scan
+            scanranges : [pyaccumulo.Range] - the ranges of rows to scan,
+                or None to scan the entire table
+            cols : optional [[string]] - columns to return, as for scan()
+        """
+        if scanranges is None:
+            for cell in self.scan(table, cols=cols):
+                yield cell
+            return
+
+        for row, rdb in self.db[table].iteritems():
+            for (cf, cq, cv, ts), val in rdb.iteritems():
+                if any(FakeConnection.in_range(row, cf, cq, cv, scanrange)
+                       for scanrange in scanranges) and \
+                   self._matches_cols(cf, cq, cols):
+                    yield Cell(row, cf, cq, cv, ts, val)
+
     def _scan(self, table, scanrange=None):
         """ Helper function for scan() that returns a generator
             NB: deprecated, since scan() is supposed to return a generator
@@ -0,0 +1,153 @@
+## **************
+##  Copyright 2026 MIT Lincoln Laboratory
+##  Project: PACE
+##  Authors: ATLH
+##  Description: Bounded least-recently-used cache
+##  Modifications:
+##  Date         Name  Modification
+##  ----         ----  ------------
+##  17 Oct 2026  ATLH    Original file
+## **************
+
+import os
+import sys
+this_dir = os.path.dirname(os.path.dirname(__file__))
+base_dir = os.path.join(this_dir, '../..')
+sys.path.append(base_dir)
+
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    Mapping with a bounded number of entries. When a new entry would
+    exceed the bound, the entry that was least recently looked up or
+    stored is evicted. Keeps counts of hits, misses and evictions.
+
+    All operations are protected by a lock, so a single cache may be
+    shared between threads.
+    """
+
+    def __init__(self, max_size=128):
+        """
+        Arguments:
+        max_size - (int) maximum number of entries held, must be positive
+        """
+        if max_size < 1:
+            raise ValueError('max_size must be positive')
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        """
+        Returns whether key is cached, without counting a hit or
+        miss or changing the order of eviction
+        """
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for key, marking it as the most
+        recently used entry, or default if key is not cached
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """
+        Returns the value cached for key, or default if key is not
+        cached, without counting a hit or miss or changing the order
+        of eviction
+        """
+        with self._lock:
+            return self._entries.get(key, default)
+
+    def put(self, key, value):
+        """
+        Caches value for key as the most recently used entry,
+        evicting the least recently used entry if the cache is full
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_create(self, key, create):
+        """
+        Returns the value cached for key. If key is not cached,
+        create() is called, and its result cached and returned.
+        Exceptions raised by create() are passed on and nothing
+        is cached.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self._entries[key] = value
+                self.hits += 1
+                return value
+            value = create()
+            self.put(key, value)
+            return value
+
+    def keys(self):
+        """
+        Returns: a list of the cached keys, from the least to the most
+        recently used, without counting hits or misses
+        """
+        with self._lock:
+            return self._entries.keys()
+
+    def pop(self, key, default=None):
+        """
+        Removes key from the cache, returning its value or default
+        if it was not cached
+        """
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        """
+        Removes all entries, leaving the counts unchanged
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def hit_rate(self):
+        """
+        Returns: the fraction of lookups so far that were hits, 
+        or 0.0 if there have been no lookups
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        """
+        Returns: dictionary with the number of hits, misses and
+        evictions so far and the current and maximum size
+        """
+        with self._lock:
+            return {'hits' : self.hits,
+                    'misses' : self.misses,
+                    'evictions' : self.evictions,
+                    'size' : len(self._entries),
+                    'max_size' : self.max_size}
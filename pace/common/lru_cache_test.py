@@ -0,0 +1,88 @@
+## **************
+##  Copyright 2026 MIT Lincoln Laboratory
+##  Project: PACE
+##  Authors: ATLH
+##  Description: Unit tests for lru_cache
+##  Modifications:
+##  Date         Name  Modification
+##  ----         ----  ------------
+##  17 Oct 2026  ATLH    Original file
+## **************
+
+import os
+import sys
+this_dir = os.path.dirname(os.path.dirname(__file__))
+base_dir = os.path.join(this_dir, '../..')
+sys.path.append(base_dir)
+
+import unittest
+from pace.common.lru_cache import LRUCache
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_eviction_order(self):
+        '''
+        Tests that the least recently used entry is evicted
+        '''
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_stats(self):
+        '''
+        Tests the counts of hits and misses
+        '''
+        cache = LRUCache(4)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        cache.put('a', 1)
+        cache.get('a')
+        self.assertEqual(cache.stats(),
+                         {'hits' : 1, 'misses' : 2, 'evictions' : 0,
+                          'size' : 1, 'max_size' : 4})
+        self.assertAlmostEqual(cache.hit_rate(), 1.0 / 3)
+        self.assertEqual(LRUCache(4).hit_rate(), 0.0)
+
+    def test_get_or_create(self):
+        '''
+        Tests that values are only created on a miss
+        '''
+        cache = LRUCache(4)
+        created = []
+        def create():
+            created.append(1)
+            return len(created)
+        self.assertEqual(cache.get_or_create('a', create), 1)
+        self.assertEqual(cache.get_or_create('a', create), 1)
+        self.assertEqual(len(created), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        def fail():
+            raise KeyError('not found')
+        self.assertRaises(KeyError, cache.get_or_create, 'b', fail)
+        self.assertFalse('b' in cache)
+
+    def test_pop_and_clear(self):
+        '''
+        Tests removing entries
+        '''
+        cache = LRUCache(4)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.peek('a'), 1)
+        self.assertEqual(cache.peek('c', 'none'), 'none')
+        self.assertEqual(cache.keys(), ['a', 'b'])
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a', 'gone'), 'gone')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, LRUCache, 0)
@@ -16,16 +16,108 @@ base_dir = os.path.join(this_dir, '../..')
 sys.path.append(base_dir)
 
 import struct, fractions 
+import itertools
 from abc import ABCMeta, abstractmethod
 from Crypto.Cipher import AES
 from Crypto.Util import Counter, number
+from Crypto.Util.strxor import strxor
 from Crypto import Random 
 from pyaccumulo import Cell
 from pace.encryption.enc_mutation import EncMutation, EncCell, EncRange
-from pace.encryption.vars import CELL_MUT_MAPPING
+from pace.encryption.vars import CELL_MUT_MAPPING, ALGORITHM_IDS, ENVELOPE_FORMAT_ID
 from pace.encryption.abstract_encrypt import AbstractEncrypt
 from pace.encryption.encryption_exceptions import EncryptionException, DecryptionException
 
+ENVELOPE_HEADER = struct.Struct('>IBBB')
+"""
+Fixed size header of the binary ciphertext envelope: key version, IV 
+length, algorithm identifier (see ALGORITHM_IDS in vars.py) and format
+identifier. The header is stored after the payload, so that the last byte
+of an envelope is always ENVELOPE_FORMAT_ID while the last byte of a 
+legacy ciphertext (which ends in 'ver' + str(version)) is always a digit. 
+"""
+
+def seal_envelope(payload, algorithm, version, iv_length):
+    '''
+    Arguments:
+    payload - (byte string) the ciphertext to wrap
+    algorithm - name of the algorithm used to produce the payload 
+    version - (int) version of the key used, 0 if there is none
+    iv_length - (int) number of random IV bytes used by the algorithm
+    
+    Returns: the payload wrapped in the binary envelope 
+    '''
+    try:
+        return payload + ENVELOPE_HEADER.pack(version, iv_length,
+                                              ALGORITHM_IDS[algorithm],
+                                              ENVELOPE_FORMAT_ID)
+    except struct.error:
+        raise EncryptionException('Key version %s cannot be stored in a ciphertext' 
+                                  % str(version))
+
+def is_envelope(ctext):
+    '''
+    Returns True if ctext is in the binary envelope format rather than
+    the legacy format with the version appended after 'ver'
+    '''
+    return ctext[-1:] == chr(ENVELOPE_FORMAT_ID)
+
+def open_envelope(ctext, algorithm, iv_length):
+    '''
+    Arguments:
+    ctext - (byte string) ciphertext in the binary envelope format
+    algorithm - name of the algorithm the ciphertext is expected to 
+            be encrypted with
+    iv_length - (int) number of random IV bytes used by the algorithm
+    
+    Returns: (payload, version) tuple where payload is a buffer over 
+    ctext (no data is copied) and version is an int
+    
+    Raises DecryptionException if the envelope is malformed or was 
+    produced by a different algorithm.
+    '''
+    payload_length = len(ctext) - ENVELOPE_HEADER.size 
+    if payload_length < 0:
+        raise DecryptionException('Ciphertext is not properly formatted: it '+\
+                                  'is too short to contain an envelope')
+    (version, ctext_iv_length, algorithm_id, format_id) = \
+        ENVELOPE_HEADER.unpack_from(ctext, payload_length)
+    if format_id != ENVELOPE_FORMAT_ID:
+        raise DecryptionException('Ciphertext is not properly formatted: '+\
+                                  'unknown envelope format %d' % format_id)
+    if algorithm_id != ALGORITHM_IDS[algorithm] or ctext_iv_length != iv_length:
+        raise DecryptionException('Ciphertext was not encrypted with %s' % algorithm)
+    return (buffer(ctext, 0, payload_length), version)
+
+#the largest number of blocks that CBC and CTR mode encrypt or decrypt 
+#through a cached ECB context (see aes_context); longer values are 
+#faster with the modes of AES.new, where expanding the key is a small
+#part of the cost. Both paths must produce the same bytes, which
+#test_context_known_answers checks against AES.new for every length
+#up to and past this cutoff.
+CONTEXT_MAX_BLOCKS = 2
+
+MASK_64 = 2**64 - 1
+
+def aes_context(key, contexts):
+    '''
+    Arguments:
+    key - (byte string) the AES key
+    contexts - LRUCache of the ECB cipher objects of a key object, 
+            keyed by key (see cipher_contexts in encryption_pki.py)
+    
+    Returns: the ECB cipher object for key from contexts, creating it
+    on a miss. Raises ValueError if the key is not a valid AES key.
+    '''
+    return contexts.get_or_create(key, lambda: AES.new(key, AES.MODE_ECB))
+
+def _fits_context(data, contexts):
+    '''
+    Returns whether data should be encrypted or decrypted block by 
+    block through a cached context, rather than with AES.new
+    '''
+    return contexts is not None and len(data) <= CONTEXT_MAX_BLOCKS*AES.block_size
+
 
 class Pycrypto_AES_Base(AbstractEncrypt):
     '''
@@ -33,6 +125,19 @@ class Pycrypto_AES_Base(AbstractEncrypt):
     Keys must be 16, 24, or 32 bytes long.
     '''   
     
+    """
+    Number of random bytes each encryption draws for its IV (or nonce),
+    zero for deterministic modes of operation
+    """
+    iv_length = AES.block_size
+    
+    """
+    Whether _encrypt and _decrypt take a contexts keyword argument, the
+    cache of ECB cipher objects (see aes_context) through which short
+    values are encrypted without expanding the key again
+    """
+    uses_contexts = False
+    
     @staticmethod
     def _encrypt(plaintext, key, iv=None):
         """ Encrypt the plaintext with the key. For modes of operation that 
@@ -65,6 +170,81 @@ class Pycrypto_AES_Base(AbstractEncrypt):
         raise NotImplementedError(
             '_decrypt is not implemented')
 
+    @staticmethod
+    def _iv_from_random(material):
+        """ Turns iv_length random bytes into the IV argument that 
+            _encrypt expects.
+        """
+        return material
+    
+    @classmethod
+    def _context_kwargs(cls, key_container):
+        """ Returns the keyword arguments to pass to _encrypt and _decrypt
+            for keys of key_container: the cipher contexts of its key
+            object, if the mode of operation uses them and the key 
+            object keeps them, or none.
+        """
+        if not cls.uses_contexts:
+            return {}
+        cipher_contexts = getattr(key_container.key_object, 'cipher_contexts', None)
+        if cipher_contexts is None:
+            return {}
+        return {'contexts' : cipher_contexts()}
+    
+    @classmethod
+    def _encrypt_many(cls, plaintexts, key, iv_material=None, **kwargs):
+        """ Encrypt a list of plaintexts with the same key. Only the
+            random reads are batched: the IVs for all of the plaintexts
+            are drawn with a single read from the random number generator,
+            and each plaintext is then encrypted by its own call to
+            _encrypt with its IV, so the ciphertexts are identical to
+            those produced by calling _encrypt on each plaintext with the
+            corresponding IV. Short CBC and CTR values reuse the key's
+            cached ECB context there (see aes_context); all other values
+            get a new cipher object from AES.new. The iv_material argument
+            should NOT be supplied except for testing purposes.
+            
+            Arguments:
+            plaintexts ([byte string]) - the plaintexts to encrypt
+            key (byte string) - the AES key
+            iv_material (optional byte string) - iv_length random bytes
+                for each plaintext, concatenated
+            kwargs - passed on to _encrypt (see _context_kwargs)
+            
+            Returns a list of the encrypted data as byte strings, in the
+            same order as plaintexts.
+        """
+        if cls.iv_length == 0:
+            return [cls._encrypt(ptext, key, **kwargs) for ptext in plaintexts]
+        
+        if iv_material is None:
+            iv_material = Random.new().read(cls.iv_length*len(plaintexts))
+        elif len(iv_material) != cls.iv_length*len(plaintexts):
+            raise EncryptionException('IV material must be %d bytes per plaintext' 
+                                      % cls.iv_length)
+        
+        l = cls.iv_length
+        return [cls._encrypt(ptext, key, cls._iv_from_random(iv_material[i*l:(i+1)*l]),
+                             **kwargs)
+                for (i, ptext) in enumerate(plaintexts)]
+    
+    @staticmethod
+    def _ctr_xor(data, context, init_ctr):
+        """ XOR data with the CTR mode keystream of the ECB cipher object
+            context, starting from the 16 byte counter block init_ctr and
+            incrementing it as a 128-bit big-endian integer, as 
+            Counter.new(128) does. The keystream is produced by a single 
+            call to context.
+        """
+        if not data:
+            return ''
+        (high, low) = struct.unpack('>QQ', init_ctr)
+        num_blocks = (len(data) + AES.block_size - 1) // AES.block_size
+        blocks = ''.join(struct.pack('>QQ', (high + ((low + i) >> 64)) & MASK_64,
+                                     (low + i) & MASK_64)
+                         for i in xrange(num_blocks))
+        return strxor(data, context.encrypt(blocks)[:len(data)])
+    
     @staticmethod 
     def _pad(s):
         '''
@@ -135,63 +315,163 @@ class Pycrypto_AES_Base(AbstractEncrypt):
         '''
         return key_container.key_object.get_key(key_container.key_id, int(version))
     
+    @classmethod
+    def _get_decryption_keys(cls, key_container, versions):
+        '''
+        Arguments:
+        
+        key_container: a (keytor) object that contains a key_id 
+                and the key_object handle to look up and obtain the
+                keys
+        versions: iterable of the versions of the decryption keys 
+                to obtain, may contain repeats
+        
+        Returns: dictionary mapping each distinct version to its 
+                decryption key. Each version is looked up only once, 
+                no matter how many times it appears in versions.
+                
+        Raises PKILookupError if a key for the key_id is not contained in the keyobject. 
+        '''
+        return dict((version, cls._get_decryption_key(key_container, version))
+                    for version in set(versions))
+    
+    @classmethod
+    def _seal(cls, ctext, version):
+        '''
+        Arguments:
+        
+        ctext: ciphertext produced by _encrypt
+        version: (int) version of the key used to encrypt it 
+        
+        Returns: ctext wrapped in the binary envelope, or for deterministic
+        modes of operation in the legacy format (see _seal_legacy), so that
+        searches still match cells written before the envelope existed
+        '''
+        if cls.iv_length == 0:
+            return cls._seal_legacy(ctext, version)
+        return seal_envelope(ctext, cls.name, version, cls.iv_length)
+    
+    @staticmethod
+    def _seal_legacy(ctext, version):
+        '''
+        Arguments:
+        
+        ctext: ciphertext produced by _encrypt
+        version: (int) version of the key used to encrypt it 
+        
+        Returns: ctext with 'ver' and the version appended. Used for 
+        everything that is compared against stored ciphertexts, such as
+        the rows and columns of searches.
+        '''
+        return str(ctext) + 'ver' + str(version)
+    
+    @classmethod
+    def _split_version(cls, ctext):
+        '''
+        Arguments:
+        
+        ctext: ciphertext either in the binary envelope format or in the 
+                legacy format with the key version appended, delineated 
+                by the last instance of 'ver'
+        
+        Returns: (ciphertext, version) tuple where version is an int and, 
+        for the envelope format, ciphertext is a buffer over ctext
+        
+        Raises DecryptionException if the ciphertext does not contain 
+        version information.
+        '''
+        if is_envelope(ctext):
+            return open_envelope(ctext, cls.name, cls.iv_length)
+        try: 
+            (ctext, version) = ctext.rsplit('ver',1)
+            return (ctext, int(version))
+        except ValueError:
+            raise DecryptionException('Ciphertext is not properly formatted: it '+\
+                                      'does not contain version information')
+    
     @classmethod
     def encrypt_mutation(cls, mutation, key_container, cell_sections):
+        return cls.encrypt_mutations([mutation], key_container, cell_sections)[0]
+    
+    @classmethod
+    def encrypt_mutations(cls, mutations, key_container, cell_sections):
         (key, version) = cls._get_encryption_key(key_container)
-        ptexts = EncMutation.concatenate_cell_section_values(mutation, cell_sections)
-        #add version number delineated by 'ver'  - version is int so this is fine 
-        ctexts = [cls._encrypt(ptext, key)+'ver'+str(version) for ptext in ptexts] 
-        return ctexts
+        ptexts = [EncMutation.concatenate_cell_section_values(mutation, cell_sections,
+                                                              cls.iv_length == 0)
+                  for mutation in mutations]
+        #encrypt the cell sections of every mutation in one pass 
+        ctexts = iter(cls._encrypt_many(list(itertools.chain.from_iterable(ptexts)), key,
+                                        **cls._context_kwargs(key_container)))
+        return [[cls._seal(ctext, version) for ctext in itertools.islice(ctexts, len(mut_ptexts))]
+                for mut_ptexts in ptexts]
     
     @classmethod
     def decrypt_mutation(cls, mutation, dec_mutation, key_container, cell_location, cell_sections):
-        ptexts = []
-        ctexts = mutation[cell_location]
-        for ctext in ctexts:
-            #grab the version, delineated by last instance of 'ver'
-            try: 
-                (ctext, version) = ctext.rsplit('ver',1)
-            except ValueError:
-                raise DecryptionException('Ciphertext is not properly formatted: it '+\
-                                          'does not contain version information')
-            key = cls._get_decryption_key(key_container, version)
-            ptexts.append(cls._decrypt(ctext, key))
-        split_values = EncMutation.split_values(ptexts)
+        #grab the versions from the envelopes, and look up each 
+        #distinct version only once for the whole mutation
+        ctexts = [cls._split_version(ctext) for ctext in mutation[cell_location]]
+        keys = cls._get_decryption_keys(key_container, 
+                                        [version for (_, version) in ctexts])
+        kwargs = cls._context_kwargs(key_container)
+        ptexts = [cls._decrypt(ctext, keys[version], **kwargs) for (ctext, version) in ctexts]
+        split_values = EncMutation.split_values(ptexts, len(cell_sections))
         for sec, values in zip(cell_sections, split_values):
             dec_mutation[sec] = list(values)
     
     @classmethod
     def encrypt_row(cls, row, key_container):
         (key, version) = cls._get_encryption_key(key_container)
-        #add version number delineated by 'ver - version is int so this is fine 
-        return cls._encrypt(row,key)+'ver'+str(version)
+        return cls._seal_legacy(cls._encrypt(row, key, **cls._context_kwargs(key_container)),
+                                version)
+     
+    @classmethod
+    def encrypt_rows(cls, rows, key_container, memo=None):
+        '''
+        Encrypts each distinct row only once, with a single lookup
+        of the current key. When memo is given, rows already encrypted
+        under the current version of the key are taken from it, and 
+        newly encrypted rows are added to it. 
+        '''
+        (key, version) = cls._get_encryption_key(key_container)
+        enc_rows = {}
+        if memo is not None:
+            for row in set(rows):
+                enc_row = memo.get((cls.name, key_container.key_id, version, row))
+                if enc_row is not None:
+                    enc_rows[row] = enc_row
+        
+        new_rows = [row for row in set(rows) if row not in enc_rows]
+        for (row, ctext) in zip(new_rows, 
+                                cls._encrypt_many(new_rows, key,
+                                                  **cls._context_kwargs(key_container))):
+            enc_rows[row] = cls._seal_legacy(ctext, version)
+            if memo is not None:
+                memo.put((cls.name, key_container.key_id, version, row), enc_rows[row])
+        return [enc_rows[row] for row in rows]
      
     @classmethod
     def encrypt_cols(cls, cols, key_container, cell_sections):
         (key, version) = cls._get_encryption_key(key_container)
-        #add version number delineated by 'ver - version is int so this is fine 
         c_text = EncRange.get_value_by_cell_string(cols, cell_sections)
-        return cls._encrypt(c_text,key)+'ver'+str(version)        
+        return cls._seal_legacy(cls._encrypt(c_text, key, **cls._context_kwargs(key_container)),
+                                version)
     
     @classmethod
     def encrypt_cell(cls, cell_dict, key_container, cell_sections):
         (key, version) = cls._get_encryption_key(key_container)
-        ptext = EncCell.get_value_by_cell_string(cell_dict,cell_sections)
-        #add version number delineated by 'ver' - version is int so this is fine 
-        return cls._encrypt(ptext, key)+'ver'+str(version)
+        ptext = EncCell.get_value_by_cell_string(cell_dict, cell_sections,
+                                                 cls.iv_length == 0)
+        return cls._seal(cls._encrypt(ptext, key, **cls._context_kwargs(key_container)), 
+                         version)
 
     
     @classmethod
     def decrypt_cell(cls, cell_dict, dec_cell, key_container, cell_location, cell_sections):
-        #grab the version, delineated by last instance of 'ver'
-        try: 
-            (ctext,version) = cell_dict[CELL_MUT_MAPPING[cell_location]].rsplit('ver',1)
-        except ValueError:
-                raise DecryptionException('Ciphertext is not properly formatted: it '+\
-                                          'does not contain version information')
+        #grab the version from the envelope
+        (ctext, version) = cls._split_version(cell_dict[CELL_MUT_MAPPING[cell_location]])
         key = cls._get_decryption_key(key_container,version)
-        ptext = cls._decrypt(ctext, key)
-        split_value = EncCell.split_value_by_cell_string(ptext)
+        ptext = cls._decrypt(ctext, key, **cls._context_kwargs(key_container))
+        split_value = EncCell.split_value_by_cell_string(ptext, len(cell_sections))
         for (sec, value) in zip(cell_sections, split_value):
             dec_cell[CELL_MUT_MAPPING[sec]] = value
     
@@ -252,8 +532,10 @@ class Pycrypto_AES_CBC(Pycrypto_AES_Base):
     
     name = 'Pycrypto_AES_CBC'
     
+    uses_contexts = True
+    
     @staticmethod
-    def _encrypt(plaintext, key, iv=None):
+    def _encrypt(plaintext, key, iv=None, contexts=None):
         #Deal with the case when field is empty
         if plaintext is None:
             plaintext = ''
@@ -261,18 +543,38 @@ class Pycrypto_AES_CBC(Pycrypto_AES_Base):
             raise EncryptionException('IV size must equal cipher block size')
         if iv is None:
             iv = Random.new().read(AES.block_size)
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        return iv + cipher.encrypt(Pycrypto_AES_Base._pad(plaintext))
+        padded = Pycrypto_AES_Base._pad(plaintext)
+        if not _fits_context(padded, contexts):
+            cipher = AES.new(key, AES.MODE_CBC, iv)
+            return iv + cipher.encrypt(padded)
+        
+        #chain the few blocks through the cached context
+        context = aes_context(key, contexts)
+        blocks = [iv]
+        for i in xrange(0, len(padded), AES.block_size):
+            blocks.append(context.encrypt(strxor(padded[i:i+AES.block_size], blocks[-1])))
+        return ''.join(blocks)
     
     @staticmethod
-    def _decrypt(ciphertext, key):
+    def _decrypt(ciphertext, key, contexts=None):
         #error handling 
         Pycrypto_AES_Base._has_iv_material(ciphertext)
         Pycrypto_AES_Base._is_multiple_16(ciphertext)
         
-        iv = ciphertext[:AES.block_size]
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        return Pycrypto_AES_Base._strip_pad(cipher.decrypt(str(ciphertext[AES.block_size:])))
+        ciphertext = str(ciphertext)
+        body = ciphertext[AES.block_size:]
+        if not _fits_context(body, contexts):
+            iv = ciphertext[:AES.block_size]
+            cipher = AES.new(key, AES.MODE_CBC, iv)
+            return Pycrypto_AES_Base._strip_pad(cipher.decrypt(body))
+        if not body:
+            return ''
+        
+        #each plaintext block is the decrypted ciphertext block xored 
+        #with the previous ciphertext block
+        context = aes_context(key, contexts)
+        ptext = strxor(context.decrypt(body), ciphertext[:-AES.block_size])
+        return Pycrypto_AES_Base._strip_pad(ptext)
     
 class Pycrypto_AES_OFB(Pycrypto_AES_Base):
     '''
@@ -327,8 +629,20 @@ class Pycrypto_AES_CTR(Pycrypto_AES_Base):
     
     name = 'Pycrypto_AES_CTR'
     
+    #only the 64-bit message nonce is random
+    iv_length = AES.block_size//2
+    
+    @staticmethod
+    def _iv_from_random(material):
+        """ Turns a random 64-bit nonce into the initial counter block:
+            the nonce followed by a 64-bit block counter starting at 1.
+        """
+        return struct.pack('15s', material) + '\x01'
+    
+    uses_contexts = True
+    
     @staticmethod
-    def _encrypt(plaintext, key, init_ctr=None):
+    def _encrypt(plaintext, key, init_ctr=None, contexts=None):
         """Optional initial counter argument, to be used only for testing 
            purposes, must be the AES block length (16 bytes).
         """
@@ -341,42 +655,38 @@ class Pycrypto_AES_CTR(Pycrypto_AES_Base):
             if len(init_ctr) != AES.block_size:
                 raise EncryptionException('Initial counter must be ' + 
                                           str(AES.block_size) + ' bytes')
-            else:
-                #Convert counter bytes to an integer (an unsigned long long), 
-                #in two steps because unpack takes 8-byte (not 16-byte) input
-                int1 = struct.unpack('>Q', init_ctr[:AES.block_size//2])[0]
-                int2 = struct.unpack('>Q', init_ctr[AES.block_size//2:])[0]
-                init_ctr_int = int1 * 2**(AES.block_size*4) + int2
 
         if init_ctr is None:
             #Generate 64-bit nonce randomly
             nonce = Random.new().read(AES.block_size//2)
             #Set remaining 64 bits to be a block counter starting at 1
             init_ctr = struct.pack('15s', nonce) + '\x01'
-            #Compute integer version of initial counter by scaling nonce by 
-            #64 bits and adding 1
-            init_ctr_int = struct.unpack('>Q', nonce)[0]*2**(AES.block_size*4)+1
 
-        ctr = Counter.new(AES.block_size*8, initial_value = init_ctr_int)
+        plaintext = str(plaintext)
+        if _fits_context(plaintext, contexts):
+            return init_ctr + Pycrypto_AES_Base._ctr_xor(plaintext, 
+                                                         aes_context(key, contexts),
+                                                         init_ctr)
+        
+        ctr = Counter.new(AES.block_size*8, 
+                          initial_value = number.bytes_to_long(init_ctr))
         cipher = AES.new(key, AES.MODE_CTR, counter = ctr) 
         return init_ctr + cipher.encrypt(plaintext)
     
     @staticmethod
-    def _decrypt(ciphertext, key):
+    def _decrypt(ciphertext, key, contexts=None):
         #error handling
         Pycrypto_AES_Base._has_iv_material(ciphertext)
-        try: 
-            nonce = struct.unpack('>Q', ciphertext[:AES.block_size//2])[0]
-            block_ctr = struct.unpack(
-                '>Q', 
-                ciphertext[AES.block_size//2 : AES.block_size])[0]
-            init_ctr = nonce * 2**(AES.block_size*4) + block_ctr
-        except ValueError:
-            raise DecryptionException("Value for the start counter value is not an integer.")
+        ciphertext = str(ciphertext)
+        init_ctr = ciphertext[:AES.block_size]
+        body = ciphertext[AES.block_size:]
+        if _fits_context(body, contexts):
+            return Pycrypto_AES_Base._ctr_xor(body, aes_context(key, contexts), init_ctr)
         
-        ctr = Counter.new(AES.block_size*8, initial_value = init_ctr)
+        ctr = Counter.new(AES.block_size*8, 
+                          initial_value = number.bytes_to_long(init_ctr))
         cipher = AES.new(key, AES.MODE_CTR, counter = ctr)
-        return cipher.decrypt(str(ciphertext[AES.block_size:])) 
+        return cipher.decrypt(body) 
     
     
 class Pycrypto_AES_GCM(Pycrypto_AES_Base):
@@ -401,7 +711,7 @@ class Pycrypto_AES_GCM(Pycrypto_AES_Base):
         #Deal with the case when field is empty
         if plaintext is None:
             plaintext = ''
-        if iv is not None and len(nonce) != AES.block_size:
+        if iv is not None and len(iv) != AES.block_size:
             raise EncryptionException('IV size must equal cipher block size')
         if iv is None:    
             iv = Random.new().read(AES.block_size)
@@ -439,6 +749,8 @@ class Pycrypto_AES_SIV(Pycrypto_AES_Base):
     
     name = "Pycrypto_AES_SIV"
     
+    iv_length = 0
+    
     @staticmethod
     def _encrypt(plaintext, key):
         if plaintext is None:
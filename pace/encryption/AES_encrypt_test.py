@@ -26,8 +26,13 @@ sys.path.append(base_dir)
 from binascii import unhexlify
 
 from pace.common.pacetest import PACETestCase
+from Crypto import Random
+from Crypto.Cipher import AES
+from Crypto.Util import Counter, number
 from pace.encryption.AES_encrypt import Pycrypto_AES_CFB, Pycrypto_AES_CBC, \
-    Pycrypto_AES_OFB, Pycrypto_AES_CTR
+    Pycrypto_AES_OFB, Pycrypto_AES_CTR, Pycrypto_AES_GCM, Pycrypto_AES_SIV, \
+    CONTEXT_MAX_BLOCKS
+from pace.common.lru_cache import LRUCache
 
 KEY_128 = unhexlify('2b7e151628aed2a6abf7158809cf4f3c')
 KEY_192 = unhexlify('8e73b0f7da0e6452c810f32b809079e562f8ead2522c6b7b')
@@ -188,3 +193,96 @@ class AESTests(PACETestCase):
         #test decrypt
         actual_pt = Pycrypto_AES_CFB._decrypt(actual_ct, KEY_256)
         self.assertEqual(plaintext, actual_pt)
+
+    def test_encrypt_many(self):
+        #the bulk path must be byte-identical to the per-cell path
+        plaintexts = [PLAINTEXT[:n] for n in (0, 1, 16, 17, 33, 64)]
+        for cls in [Pycrypto_AES_CFB, Pycrypto_AES_CBC, Pycrypto_AES_OFB,
+                    Pycrypto_AES_CTR, Pycrypto_AES_GCM]:
+            l = cls.iv_length
+            material = Random.new().read(l*len(plaintexts))
+            actual_cts = cls._encrypt_many(plaintexts, KEY_128, material)
+            expected_cts = [cls._encrypt(pt, KEY_128, 
+                                         cls._iv_from_random(material[i*l:(i+1)*l]))
+                            for (i, pt) in enumerate(plaintexts)]
+            self.assertEqual(expected_cts, actual_cts)
+
+            #test decrypt with freshly drawn IVs
+            actual_pts = [cls._decrypt(ct, KEY_128) 
+                          for ct in cls._encrypt_many(plaintexts, KEY_128)]
+            self.assertEqual(plaintexts, actual_pts)
+
+        #deterministic mode draws no IVs
+        self.assertEqual(Pycrypto_AES_SIV._encrypt_many(plaintexts, KEY_256),
+                         [Pycrypto_AES_SIV._encrypt(pt, KEY_256) for pt in plaintexts])
+
+    def test_context_cache(self):
+        #the cached contexts must give the same results as AES.new
+        contexts = LRUCache(4)
+        for n in (0, 1, 15, 16, 17, 31, 32, 33, 64):
+            plaintext = PLAINTEXT[:n]
+            expected_ct = IV + AES.new(KEY_192, AES.MODE_CBC, IV).encrypt(
+                                            Pycrypto_AES_CBC._pad(plaintext))
+            for kwargs in ({}, {'contexts' : contexts}):
+                self.assertEqual(Pycrypto_AES_CBC._encrypt(plaintext, KEY_192, IV, **kwargs), 
+                                 expected_ct)
+                self.assertEqual(Pycrypto_AES_CBC._decrypt(expected_ct, KEY_192, **kwargs), 
+                                 plaintext)
+            for key in (KEY_128, KEY_192, KEY_256):
+                expected_ct = Pycrypto_AES_CTR._encrypt(plaintext, key, INIT_COUNTER)
+                self.assertEqual(Pycrypto_AES_CTR._encrypt(plaintext, key, INIT_COUNTER,
+                                                           contexts=contexts),
+                                 expected_ct)
+                self.assertEqual(Pycrypto_AES_CTR._decrypt(expected_ct, key, 
+                                                           contexts=contexts), 
+                                 plaintext)
+
+        #the counter block wraps around as a 128-bit integer
+        init_ctr = '\xff'*AES.block_size
+        ct = Pycrypto_AES_CTR._encrypt('\x00'*32, KEY_128, init_ctr, contexts=contexts)
+        self.assertEqual(ct[AES.block_size:], 
+                         AES.new(KEY_128, AES.MODE_ECB).encrypt(init_ctr + '\x00'*16))
+        
+        #short values expand the key only once, long values use AES.new
+        contexts = LRUCache(4)
+        key = Random.new().read(16)
+        for _ in range(3):
+            Pycrypto_AES_CTR._decrypt(Pycrypto_AES_CTR._encrypt(PLAINTEXT[:20], key, 
+                                                                contexts=contexts),
+                                      key, contexts=contexts)
+        self.assertEqual((contexts.misses, contexts.hits), (1, 5))
+        Pycrypto_AES_CTR._encrypt(PLAINTEXT, key, contexts=contexts)
+        self.assertEqual((contexts.misses, contexts.hits), (1, 5))
+
+    def test_context_known_answers(self):
+        #CBC and CTR through a cached context must agree with the modes
+        #of AES.new for every length up to and past CONTEXT_MAX_BLOCKS
+        contexts = LRUCache(4)
+        max_length = (CONTEXT_MAX_BLOCKS + 2)*AES.block_size
+        counters = (INIT_COUNTER, '\x00'*AES.block_size,
+                    '\x01'*8 + '\xff'*8, '\xff'*AES.block_size)
+        for key in (KEY_128, KEY_192, KEY_256):
+            for n in range(max_length + 1):
+                plaintext = Random.new().read(n)
+
+                iv = Random.new().read(AES.block_size)
+                expected_ct = iv + AES.new(key, AES.MODE_CBC, iv).encrypt(
+                                                Pycrypto_AES_CBC._pad(plaintext))
+                self.assertEqual(Pycrypto_AES_CBC._encrypt(plaintext, key, iv,
+                                                           contexts=contexts),
+                                 expected_ct)
+                self.assertEqual(Pycrypto_AES_CBC._decrypt(expected_ct, key,
+                                                           contexts=contexts),
+                                 plaintext)
+
+                for init_ctr in counters:
+                    ctr = Counter.new(AES.block_size*8,
+                                      initial_value=number.bytes_to_long(init_ctr))
+                    expected_ct = init_ctr + AES.new(key, AES.MODE_CTR,
+                                                     counter=ctr).encrypt(plaintext)
+                    self.assertEqual(Pycrypto_AES_CTR._encrypt(plaintext, key, init_ctr,
+                                                               contexts=contexts),
+                                     expected_ct)
+                    self.assertEqual(Pycrypto_AES_CTR._decrypt(expected_ct, key,
+                                                               contexts=contexts),
+                                     plaintext)
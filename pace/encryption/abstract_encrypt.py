@@ -62,6 +62,33 @@ class AbstractEncrypt(object):
         '''
         pass 
     
+    @classmethod
+    def encrypt_mutations(cls, mutations, key, cell_sections):
+        '''
+        Arguments: 
+        mutations - list of mutations as defined in encmutation 
+        key - key in whatever format is used for particular
+              encryption scheme 
+        cell_sections - the list of part of the cell to be encrypted.
+              Options are defined in VALID_KEYS in vars.py. 
+        
+        Returns: A list containing, for each mutation, the list of 
+              ciphertexts that encrypt_mutation returns for it. 
+              Encryption modules that can encrypt a whole batch
+              of mutations at once should override this. 
+        '''
+        return [cls.encrypt_mutation(mutation, key, cell_sections)
+                for mutation in mutations]
+    
+    @classmethod
+    def _encrypt_many(cls, plaintexts, key):
+        '''
+        Returns: a list of the ciphertexts of plaintexts, each encrypted
+              with key by _encrypt. Encryption modules that can encrypt
+              several plaintexts at once should override this.
+        '''
+        return [cls._encrypt(plaintext, key) for plaintext in plaintexts]
+    
     @abstractmethod
     def decrypt_mutation(mutation, dec_mutation, key, cell_location, cell_sections):
         '''
@@ -104,6 +131,23 @@ class AbstractEncrypt(object):
         """
         pass
     
+    @classmethod
+    def encrypt_rows(cls, rows, key, memo=None):
+        """
+        Arguments:
+        rows - list of (string) rows to be encrypted 
+        key - key in whatever format is used for particular
+              encryption scheme 
+        memo - (optional) cache of previously encrypted rows with
+              the get and put methods of pace.common.lru_cache.LRUCache,
+              encryption modules that do not support it ignore it
+              
+        Returns: list of the encrypted rows, in the same order as rows,
+        that encrypt_row returns for each of them. Encryption modules 
+        that can encrypt many rows at once should override this.
+        """
+        return [cls.encrypt_row(row, key) for row in rows]
+    
     @abstractmethod
     def encrypt_cols(cols, key_container,  cell_sections):
         """
@@ -168,16 +212,17 @@ class Identity_AccEncrypt(AbstractEncrypt):
     testing
     '''
     name = 'Identity'
+    iv_length = 0
     
     @staticmethod
     def encrypt_mutation(mutation, key, cell_sections):
-        ctexts = EncMutation.concatenate_cell_section_values(mutation, cell_sections)
+        ctexts = EncMutation.concatenate_cell_section_values(mutation, cell_sections, True)
         return ctexts
      
     @staticmethod
     def decrypt_mutation(mutation, dec_mutation, key, cell_location, cell_sections):
         ptexts = mutation[cell_location]
-        split_values = EncMutation.split_values(ptexts)
+        split_values = EncMutation.split_values(ptexts, len(cell_sections))
         for sec, values in zip(cell_sections, split_values):
             dec_mutation[sec] = list(values)
     
@@ -191,11 +236,12 @@ class Identity_AccEncrypt(AbstractEncrypt):
     
     @staticmethod
     def encrypt_cell(cell, key, cell_sections):
-        return EncCell.get_value_by_cell_string(cell,cell_sections)
+        return EncCell.get_value_by_cell_string(cell, cell_sections, True)
     
     @staticmethod
     def decrypt_cell(cell, dec_cell, key, cell_location, cell_sections):
-        split_value = EncCell.split_value_by_cell_string(cell[CELL_MUT_MAPPING[cell_location]])
+        split_value = EncCell.split_value_by_cell_string(cell[CELL_MUT_MAPPING[cell_location]],
+                                                         len(cell_sections))
         for (sec, value) in zip(cell_sections, split_value):
             dec_cell[CELL_MUT_MAPPING[sec]] = value
 
@@ -28,9 +28,13 @@ from pace.encryption.encryption_pki import DummyEncryptionPKI
 from pace.encryption.acc_encrypt import AccumuloEncrypt
 from pace.encryption.enc_mutation import EncMutation, EncCell 
 from pace.encryption.enc_classes import ALGORITHMS, AES_ALGORITHMS, IV_AES_ALGORITHMS,\
-                                       LENGTHBOUND_AES_ALGORITHMS, AUTH_ALGORITHMS, DET_ALGORITHMS
+                                       LENGTHBOUND_AES_ALGORITHMS, AUTH_ALGORITHMS, DET_ALGORITHMS,\
+                                       VIS_ALGORITHMS
 from pace.encryption.encryption_exceptions import DecryptionException
-from pace.encryption.AES_encrypt import Pycrypto_AES_Base
+from pace.encryption.AES_encrypt import Pycrypto_AES_Base, seal_envelope
+from pace.encryption.visibility.vis_encrypt import SHARES_LENGTH
+from pace.encryption.visibility.secret_vis_tree import SecretVisTreeEncryptor
+from Crypto import Random
 
 def _create_encryptor_dict(config): 
     '''
@@ -56,10 +60,8 @@ def _decrypt_mutations_equal(list_mut, mut2):
         mutation is the same as the original
         '''
         equal = True
-        equal &= len(list_mut) == len(mut2.updates)
-        for (mut, update) in zip(list_mut, mut2.updates):
-            equal &= mut.row == mut2.row
-            equal &= mut.updates[0] == update
+        equal &= all([mut.row == mut2.row for mut in list_mut])
+        equal &= [update for mut in list_mut for update in mut.updates] == mut2.updates
         return equal
 
 def _check_versioning(encClass):
@@ -67,13 +69,13 @@ def _check_versioning(encClass):
     Test the encryptions classes are properly dealing with versions.
     Versions are pulled from the DummyEncryptionPKI in encryption_pki.py
     """
-    groundtruth = {"Pycrypto_AES_CFB": '3',
-                  "Pycrypto_AES_CBC": '1',
-                  "Pycrypto_AES_OFB": '3',
-                  "Pycrypto_AES_CTR": '1',
-                  "Pycrypto_AES_GCM": '2',
-                  "Pycrypto_AES_CFB": '3',
-                  "Pycrypto_AES_SIV": '1'}
+    groundtruth = {"Pycrypto_AES_CFB": 3,
+                  "Pycrypto_AES_CBC": 1,
+                  "Pycrypto_AES_OFB": 3,
+                  "Pycrypto_AES_CTR": 1,
+                  "Pycrypto_AES_GCM": 2,
+                  "Pycrypto_AES_CFB": 3,
+                  "Pycrypto_AES_SIV": 1}
     config = stringio.StringIO(
                         '[value]\n'+\
                         'key_id = '+ encClass.name +'\n'+\
@@ -85,9 +87,96 @@ def _check_versioning(encClass):
     enc_muts = EncMutation(mut, encryptor_dict).encrypt()
     assert_true(len(enc_muts) == 1)
     enc_mut = enc_muts[0]
-    assert_true(enc_mut.updates[0].value.rsplit('ver',1)[-1] == groundtruth[encClass.name],
+    assert_true(encClass._split_version(enc_mut.updates[0].value)[1] == groundtruth[encClass.name],
                 'Not grabbing the most recent version of the key')
 
+def _check_legacy_format(encClass):
+    """
+    Tests that cells in the legacy format, where the key version is
+    appended after 'ver', can still be decrypted
+    """
+    config = stringio.StringIO(
+                        '[value]\n'+\
+                        'key_id = '+ encClass.name +'\n'+\
+                        'encryption = ' + encClass.name)
+    encryptor_dict = _create_encryptor_dict(config)
+    key_container = encryptor_dict['value'].key_container
+    (key, version) = key_container.key_object.get_current_key(encClass.name)
+    ptext = 'val1ver2'
+    enc_cell = Cell('row','cf','cq','',1234, 
+                    encClass._encrypt(ptext, key) + 'ver' + str(version))
+    eq_(EncCell.decrypt(enc_cell, encryptor_dict),
+        Cell('row','cf','cq','',1234, ptext))
+    
+def _check_legacy_vis_format(encClass):
+    """
+    Tests that VIS cells in the legacy format, where the encrypted shares
+    and the ciphertext are delineated by '#', can still be decrypted
+    """
+    config = stringio.StringIO(
+                        '[value]\n'+\
+                        'key_id = '+ encClass.name +'\n'+\
+                        'encryption = ' + encClass.name)
+    encryptor_dict = _create_encryptor_dict(config)
+    key_container = encryptor_dict['value'].key_container
+    cell_key = Random.get_random_bytes(key_container.cell_key_length)
+    vis_expr = '(a&b)|c'
+    shares = SecretVisTreeEncryptor.encrypt_secret_shares(vis_expr, cell_key,
+                                                          key_container,
+                                                          encClass.leaf_class)
+    enc_cell = Cell('row','cf','cq',vis_expr,1234, 
+                    shares + '#' + encClass._encrypt('val#1', cell_key))
+    eq_(EncCell.decrypt(enc_cell, encryptor_dict),
+        Cell('row','cf','cq',vis_expr,1234,'val#1'))
+    
+def _check_text_shares(encClass):
+    """
+    Tests that VIS cells in the binary envelope whose encrypted shares 
+    are text formatted like the visibility label, rather than a binary
+    share tree, can still be decrypted
+    """
+    config = stringio.StringIO(
+                        '[value]\n'+\
+                        'key_id = '+ encClass.name +'\n'+\
+                        'encryption = ' + encClass.name)
+    encryptor_dict = _create_encryptor_dict(config)
+    key_container = encryptor_dict['value'].key_container
+    cell_key = Random.get_random_bytes(key_container.cell_key_length)
+    vis_expr = '(a&b)|c'
+    shares = SecretVisTreeEncryptor.encrypt_secret_shares(vis_expr, cell_key,
+                                                          key_container,
+                                                          encClass.leaf_class)
+    ctext = seal_envelope(SHARES_LENGTH.pack(len(shares)) + shares +\
+                          encClass._encrypt('val1', cell_key),
+                          encClass.name, 0, encClass.iv_length)
+    enc_cell = Cell('row','cf','cq',vis_expr,1234,ctext)
+    eq_(EncCell.decrypt(enc_cell, encryptor_dict),
+        Cell('row','cf','cq',vis_expr,1234,'val1'))
+    
+def _check_envelope(encClass):
+    """
+    Tests that the binary envelope records the key version and the
+    algorithm, whatever bytes the ciphertext contains
+    """
+    payload = 'ciphertext containing ver and 1'
+    ctext = seal_envelope(payload, encClass.name, 70000, encClass.iv_length)
+    (actual_payload, version) = encClass._split_version(ctext)
+    eq_(str(actual_payload), payload)
+    eq_(version, 70000)
+    
+    other_class = [c for c in AES_ALGORITHMS.values() if c is not encClass][0]
+    assert_raises(DecryptionException, other_class._split_version, ctext)
+    assert_raises(DecryptionException, encClass._split_version, ctext[1:-1] + '\x02')
+    assert_raises(DecryptionException, encClass._split_version, '\x01')
+
+def _check_deterministic_legacy_format(encClass):
+    """
+    Tests that deterministic algorithms still write ciphertexts in the
+    legacy format, so searches match cells written before the envelope
+    """
+    eq_(encClass._seal('ciphertext', 2), 'ciphertextver2')
+    eq_(encClass._split_version('ciphertextver2'), ('ciphertext', 2))
+
 def _check_malformed_ciphertext_version(encClass):
     """
     Tests error handling in the case where the ciphertext does 
@@ -195,6 +284,10 @@ def test_all_encryption_algorithms():
     for encClass in ALGORITHMS.values():
         yield _check_encrypt_decrypt_mutation, encClass
         yield _check_encrypt_decrypt_cell, encClass
+        
+    for encClass in VIS_ALGORITHMS.values():
+        yield _check_legacy_vis_format, encClass
+        yield _check_text_shares, encClass
 
 def test_aes_encryption_algorithms():
     
@@ -208,6 +301,8 @@ def test_aes_encryption_algorithms():
     for encClass in AES_ALGORITHMS.values():
         yield _check_key_length, encClass 
         yield _check_versioning, encClass
+        yield _check_legacy_format, encClass
+        yield _check_envelope, encClass
         yield _check_malformed_ciphertext_version, encClass 
         
 def test_authenticated_algorithms():
@@ -219,6 +314,7 @@ def test_deterministic_algorithms():
     
     for encClass in DET_ALGORITHMS.values():
         yield _check_determinism, encClass
+        yield _check_deterministic_legacy_format, encClass
 
 
 def test_aes_padding():
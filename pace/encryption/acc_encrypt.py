@@ -16,13 +16,33 @@ base_dir = os.path.join(this_dir, '../..')
 sys.path.append(base_dir)
 
 import ConfigParser
+import cPickle
+import logging
+import itertools
+import time
+import threading
+import multiprocessing
+from Crypto import Random
+from Queue import Queue, Full
 from StringIO import StringIO
-from collections import namedtuple
+from collections import namedtuple, deque
+from multiprocessing.pool import ThreadPool
+from pyaccumulo import Range
+from pace.pki.abstractpki import PKILookupError
+from pace.common.lru_cache import LRUCache
 from pace.encryption.vars import VALID_KEYS
-from pace.encryption.enc_classes import ALGORITHMS
-from pace.encryption.enc_mutation import EncMutation, EncCell, EncRange
+from pace.encryption.enc_classes import ALGORITHMS, AES_ALGORITHMS, VIS_ALGORITHMS
+from pace.encryption.enc_mutation import EncMutation, EncCell, EncRange, EncryptionPlan
+from pace.encryption.encryption_pki import CIPHER_CONTEXTS_SIZE, KeyCache
+from pace.encryption.visibility.vis_parser import parse_cached
+from pace.encryption.encryption_exceptions import UnsatisfiableLabelException
+from pace.encryption.visibility.secret_vis_tree import SecretVisTreeEncryptor
+from pace.encryption.visibility.share_keys import ShareKeyManager
 
-Keytor = namedtuple('Keytor',['key_id','key_object','cell_key_length'])
+logger = logging.getLogger(__name__)
+
+Keytor = namedtuple('Keytor',['key_id','key_object','cell_key_length','share_keys'])
+Keytor.__new__.__defaults__ = (None,)
 """
 Key container object, used to encapsulate the information needed to obtain a key for a 
 particular user and algorithm and/or generate a cell_key if the algorithm is a VIS_*
@@ -30,6 +50,10 @@ particular user and algorithm and/or generate a cell_key if the algorithm is a V
     key_object - a handle on an instance of an EncryptionPKI object 
     cell_key_length - (int) for VIS_* algorithm, length in bytes 
                     (not bits) of the cell_key to be generated. 
+    share_keys - (optional) for VIS_* algorithm, ShareKeyManager (see 
+                    visibility/share_keys.py) used to reuse cell keys across
+                    cells with the same visibility label, or None (the default)
+                    to generate a new cell key for every cell
 """
 
 Encryptor = namedtuple('Encryptor', ['encryption', 'cell_sections', 'key_container'])
@@ -43,6 +67,277 @@ cell.
                     key material
 """
 
+class BatchKeyResolver(object):
+    """
+    Key object that wraps another key object (see encryption_pki.py) for
+    the encryptions or decryptions of a call to encrypt_batch, 
+    encrypt_many or decrypt_scan, or of a DecryptionSession. Key 
+    requests are passed through to the wrapped key object once and 
+    their results kept in a KeyCache, so that later requests for the 
+    same (key_id, version) or (key_id, attribute, version) are answered
+    from memory. At most max_size results are kept, each for ttl 
+    seconds, and all of them are discarded when the key epoch of the
+    wrapped key object changes (see keys_changed in encryption_pki.py),
+    so a long-lived resolver does not grow without bound or keep using
+    revoked keys.
+    
+    Lookups that fail are not remembered, so the PKILookupError is 
+    raised again on every request, just as with the wrapped key object.
+    Only the prefetches remember the attribute keys the user lacks, 
+    under the same bounds, so that each of them is not asked for again
+    until it expires or the keys change.
+    
+    A single resolver may be shared between threads. Its lock is not
+    held while the wrapped key object is called, so threads retrieving
+    different keys do not wait for each other; threads requesting a key
+    that is already being retrieved wait for that retrieval rather than
+    repeating it. 
+    
+    A pickled resolver keeps the keys it has already retrieved but not 
+    the wrapped key object, so once unpickled (e.g. in a worker process)
+    it raises PKILookupError for any key that was not retrieved 
+    beforehand.
+    """
+    
+    def __init__(self, key_object, max_size=1024, ttl=3600, clock=time.time):
+        """
+        Arguments:
+        key_object - key management object that meets the
+            interface outlined in encryption_pki.py
+        max_size - (optional) maximum number of key requests whose
+            results are kept, defaults to 1024
+        ttl - (optional) number of seconds results are kept for, 
+            defaults to 3600
+        clock - (optional) function returning the current time in 
+            seconds, defaults to time.time
+        """
+        self.key_object = key_object
+        self.max_size = max_size
+        self.ttl = ttl
+        self._keys = KeyCache(max_size, ttl, negative_ttl=0, clock=clock)
+        self._unavailable = KeyCache(max_size, ttl, negative_ttl=0, clock=clock)
+        self._epoch = self.key_epoch
+        self._pending = {}
+        self._cipher_contexts = None
+        self._lock = threading.Lock()
+        
+    def _check_epoch(self):
+        """
+        Discards the results kept so far if the keys of the wrapped key
+        object changed since they were retrieved
+        """
+        epoch = self.key_epoch
+        if epoch != self._epoch:
+            with self._lock:
+                if epoch != self._epoch:
+                    self._keys.clear()
+                    self._unavailable.clear()
+                    self._epoch = epoch
+        
+    def _lookup(self, method, *args):
+        """
+        Helper function that returns the kept result of calling method
+        on the wrapped key object with args, calling it if there is 
+        no such result.
+        """
+        self._check_epoch()
+        request = (method,) + args
+        with self._lock:
+            pending = self._pending.get(request)
+            if pending is None:
+                pending = self._pending[request] = threading.Lock()
+        #only one thread retrieves a key at a time; the others find
+        #it in _keys once they get the key's lock
+        with pending:
+            try:
+                return self._keys.lookup(request, lambda: self._retrieve(method, args))
+            finally:
+                with self._lock:
+                    if self._pending.get(request) is pending:
+                        del self._pending[request]
+        
+    def _retrieve(self, method, args):
+        """
+        Helper function that calls method on the wrapped key object
+        with args
+        """
+        if self.key_object is None:
+            raise PKILookupError('Key was not retrieved before the '+\
+                                 'key resolver was copied')
+        return getattr(self.key_object, method)(*args)
+        
+    def __getstate__(self):
+        with self._lock:
+            return {'_keys' : self._keys.results(),
+                    'max_size' : self.max_size,
+                    'ttl' : self.ttl}
+    
+    def __setstate__(self, state):
+        self.__init__(None, state['max_size'], state['ttl'])
+        for (key, value) in state['_keys'].items():
+            self._keys.put(key, value)
+        
+    @property
+    def key_epoch(self):
+        """
+        The key epoch (see encryption_pki.py) of the wrapped key object
+        """
+        return getattr(self.key_object, 'key_epoch', 0)
+    
+    def cipher_contexts(self):
+        """
+        Returns: the cipher contexts (see encryption_pki.py) of the 
+        wrapped key object. A resolver without one, such as an unpickled
+        resolver, keeps its own for the keys it holds.
+        """
+        cipher_contexts = getattr(self.key_object, 'cipher_contexts', None)
+        if cipher_contexts is not None:
+            return cipher_contexts()
+        with self._lock:
+            if self._cipher_contexts is None:
+                self._cipher_contexts = LRUCache(CIPHER_CONTEXTS_SIZE)
+            return self._cipher_contexts
+        
+    def get_key(self, algorithm, version=1):
+        return self._lookup('get_key', algorithm, version)
+    
+    def get_current_key(self, algorithm):
+        return self._lookup('get_current_key', algorithm)
+    
+    def get_attribute_key(self, algorithm, attribute, version=1):
+        return self._lookup('get_attribute_key', algorithm, attribute, version)
+    
+    def get_current_attribute_key(self, algorithm, attribute):
+        return self._lookup('get_current_attribute_key', algorithm, attribute)
+    
+    def has_attribute(self, algorithm, attribute):
+        """
+        Returns: the memoized has_attribute of the wrapped key object,
+        or True if it has no such method or is no longer available
+        """
+        if self.key_object is not None and \
+           not hasattr(self.key_object, 'has_attribute'):
+            return True
+        try:
+            return self._lookup('has_attribute', algorithm, attribute)
+        except PKILookupError:
+            return True
+    
+    def prefetch_attribute_keys(self, algorithm, attribute_versions):
+        """
+        Arguments:
+        algorithm - (string) name of the algorithm of the keys
+        attribute_versions - iterable of (attribute, version) pairs, with
+            integer versions, of the attribute keys about to be needed
+            
+        Effect: the keys that have not been retrieved yet are retrieved
+        together with the get_attribute_keys method of the wrapped key 
+        object, if it has one, so that later requests for them are
+        answered from memory. Keys the user does not have are skipped,
+        and are not asked for again by later prefetches.
+        """
+        get_attribute_keys = getattr(self.key_object, 'get_attribute_keys', None)
+        if get_attribute_keys is None:
+            return
+        self._check_epoch()
+        with self._lock:
+            missing = set(pair for pair in attribute_versions
+                          if not self._keys.cached(('get_attribute_key', algorithm) + pair)
+                          and not self._unavailable.cached((algorithm,) + pair))
+        if not missing:
+            return
+        keys = get_attribute_keys(algorithm, missing)
+        with self._lock:
+            for ((attribute, version), key) in keys.items():
+                self._keys.put(('get_attribute_key', algorithm, attribute, version), key)
+            for pair in missing:
+                if pair not in keys:
+                    self._unavailable.put((algorithm,) + pair, True)
+
+class DecryptionSession(object):
+    """
+    Decrypts batches of cells for an AccumuloEncrypt, keeping the keys
+    retrieved for earlier batches in a BatchKeyResolver, which bounds
+    how many are kept and for how long and discards them when the keys
+    change. Before a batch is decrypted, the attribute keys needed by 
+    its CEABAC cells are read
+    from their encrypted shares and retrieved all at once (see 
+    BatchKeyResolver.prefetch_attribute_keys), rather than one at a 
+    time as each cell is decrypted. 
+    
+    Cells whose visibility labels the user's attributes cannot satisfy
+    may be skipped rather than raising an UnsatisfiableLabelException.
+    Once a label is known to be unsatisfiable with any version of the 
+    user's keys, its cells are rejected without reading their shares or
+    looking up keys (see label_unsatisfiable in secret_vis_tree.py).
+    The number of cells skipped is kept in skipped. 
+    
+    A session may be shared between threads. 
+    """
+    
+    def __init__(self, acc_encrypt, skip_unreadable=False):
+        """
+        Arguments:
+        acc_encrypt - the AccumuloEncrypt whose configuration and key 
+            object are used to decrypt cells
+        skip_unreadable - (optional) whether cells the user's attributes
+            do not satisfy the visibility labels of are left out of the 
+            decrypted batches, defaults to False
+        """
+        self.resolver = BatchKeyResolver(acc_encrypt.key_object)
+        self.encrypt_dict = acc_encrypt._batch_encryptor_dict(self.resolver)
+        self.skip_unreadable = skip_unreadable
+        self.skipped = 0
+        self._lock = threading.Lock()
+        
+    def prefetch(self, cells):
+        """
+        Arguments:
+        cells - list of cells as defined in pyaccumulo
+        
+        Effect: retrieves the attribute keys needed to decrypt the 
+        CEABAC sections of cells, for each algorithm with one request
+        to the key object. 
+        """
+        for step in self.encrypt_dict.steps:
+            encryption = step.encryptor.encryption
+            if encryption not in VIS_ALGORITHMS.values():
+                continue
+            key_container = step.encryptor.key_container
+            needed = set()
+            for cell in cells:
+                if cell.cv and not \
+                   SecretVisTreeEncryptor.label_unsatisfiable(cell.cv, key_container):
+                    needed.update(encryption.attribute_key_versions(
+                                                getattr(cell, step.cell_field),
+                                                cell.cv))
+            self.resolver.prefetch_attribute_keys(key_container.key_id, needed)
+    
+    def decrypt_batch(self, cells):
+        """
+        Arguments:
+        cells - an iterable of cells as defined in pyaccumulo
+        
+        Returns: A list of new cells containing the decrypted data, 
+        in the same order as cells. If the session skips unreadable 
+        cells, they are left out of the list and counted in skipped. 
+        """
+        cells = list(cells)
+        self.prefetch(cells)
+        if not self.skip_unreadable:
+            return [EncCell.decrypt(cell, self.encrypt_dict) for cell in cells]
+        
+        decrypted = []
+        skipped = 0
+        for cell in cells:
+            try:
+                decrypted.append(EncCell.decrypt(cell, self.encrypt_dict))
+            except UnsatisfiableLabelException:
+                skipped += 1
+        with self._lock:
+            self.skipped += skipped
+        return decrypted
+
 class ConfigurationException(Exception):
     """ Exception raised when unable to process configuration file
         
@@ -56,18 +351,97 @@ class ConfigurationException(Exception):
         return self.msg
 
 
+#Encryptor dictionary used by the worker processes of 
+#AccumuloEncrypt.encrypt_many, set by _init_encrypt_worker
+_worker_encrypt_dict = None
+
+def _init_encrypt_worker(pickled_encrypt_dict):
+    """
+    Initializer for the worker processes of AccumuloEncrypt.encrypt_many
+    """
+    global _worker_encrypt_dict
+    #the random number generator must be reseeded after a fork
+    Random.atfork()
+    _worker_encrypt_dict = cPickle.loads(pickled_encrypt_dict)
+    
+def _encrypt_chunk(pickled_mutations, columnar=False):
+    """
+    Encrypts a pickled list of mutations in a worker process of
+    AccumuloEncrypt.encrypt_many. Returns the encrypted mutations
+    as encrypt_batch does, or None if a key needed was not resolved
+    before the worker was started.
+    """
+    mutations = cPickle.loads(pickled_mutations)
+    try:
+        return EncMutation.encrypt_batch([EncMutation(mutation, _worker_encrypt_dict)
+                                          for mutation in mutations],
+                                         columnar)
+    except PKILookupError:
+        return None
+
+class _ScanReader(threading.Thread):
+    """
+    Background thread used by AccumuloEncrypt.decrypt_scan. Reads
+    the cells returned by a scan and places them on a bounded queue 
+    in lists of at most batch_size cells. The end of the scan is 
+    marked by placing None on the queue; if the scan raises an 
+    exception, the exception is placed on the queue instead. 
+    """
+    
+    def __init__(self, cells, batch_size, max_batches):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cells = cells
+        self.batch_size = batch_size
+        self.queue = Queue(max_batches)
+        self.stopped = threading.Event()
+        
+    def _put(self, item):
+        """
+        Places item on the queue, waiting for room unless the
+        reader has been stopped. Returns False if the reader was
+        stopped before item could be placed on the queue.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+        
+    def run(self):
+        try:
+            cells = iter(self.cells)
+            while True:
+                batch = list(itertools.islice(cells, self.batch_size))
+                if not batch:
+                    break
+                if not self._put(batch):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+            
+    def stop(self):
+        self.stopped.set()
+        
 class AccumuloEncrypt(object):
     """High level interface for encrypting/decrypting accumulo cells. 
     Parametrized by a configuration file and a separate 
     key management object. 
     """
-    def __init__(self, config, key_object):
+    def __init__(self, config, key_object, share_key_store=None):
         """
         Arguments:
         config - configuration file in the format specified
         by INI files, see README for more details. 
         key_object - key management object that meets the
         interface outlined in encryption_pki.py
+        share_key_store - (optional) store for the shares of cell keys
+        that are reused across cells, such as an AccumuloShareKeyStore 
+        (see visibility/share_keys.py). Required if the configuration
+        sets share_key_reuse for any section, otherwise ignored.
         """
         self.config_parser = ConfigParser.ConfigParser()
         
@@ -78,11 +452,14 @@ class AccumuloEncrypt(object):
             self.config_parser.read(config)
             
         self.key_object = key_object 
-        self.encrypt_dict = self._config_to_encryptor(self.config_parser,
-                                                      self.key_object)
+        #compiled once, so that the work of applying the configuration
+        #is not repeated for every mutation and cell 
+        self.encrypt_dict = EncryptionPlan(self._config_to_encryptor(self.config_parser,
+                                                                     self.key_object,
+                                                                     share_key_store))
         
     @staticmethod 
-    def _config_to_encryptor(config_parser, key_object):
+    def _config_to_encryptor(config_parser, key_object, share_key_store=None):
         '''
         Converts configuration file into associated encryptor
         objects for each part of key
@@ -128,6 +505,9 @@ class AccumuloEncrypt(object):
                     raise ConfigurationException('Key_length must be 16,24,or 32 bytes long')
             else:
                 cell_key_length=16
+            
+            share_keys = AccumuloEncrypt._config_to_share_keys(config_parser, sec,
+                                                               share_key_store)
                 
             if not all([cell_sec in VALID_KEYS for cell_sec in cell_sections]):
                     raise ConfigurationException("At least one of cell_sections ("+\
@@ -137,24 +517,215 @@ class AccumuloEncrypt(object):
                                             cell_sections,
                                             Keytor(config_parser.get(sec,'key_id'), 
                                                    key_object,
-                                                   cell_key_length)))
+                                                   cell_key_length,
+                                                   share_keys)))
         if keys == [] or encryptors == []:
             raise ConfigurationException("Configuration was not properly parsed")
                                 
         return dict(zip(keys, encryptors))
    
         
-    def encrypt(self, mutation):
+    @staticmethod
+    def _config_to_share_keys(config_parser, sec, share_key_store):
+        '''
+        Returns: the ShareKeyManager for section sec of the configuration
+        if it sets share_key_reuse, otherwise None
+        '''
+        if not config_parser.has_option(sec, 'share_key_reuse'):
+            return None
+        try:
+            if not config_parser.getboolean(sec, 'share_key_reuse'):
+                return None
+        except ValueError:
+            raise ConfigurationException('%s is not a valid boolean for share_key_reuse' %
+                                         config_parser.get(sec, 'share_key_reuse'))
+        if config_parser.get(sec, 'encryption') not in VIS_ALGORITHMS:
+            raise ConfigurationException('share_key_reuse is only supported for '+\
+                                         'VIS_* algorithms')
+        if share_key_store is None:
+            raise ConfigurationException('share_key_reuse requires a share key store')
+        
+        options = {}
+        for (option, name) in [('share_key_max_uses', 'max_uses'),
+                               ('share_key_max_age', 'max_age')]:
+            if config_parser.has_option(sec, option):
+                try:
+                    options[name] = int(config_parser.get(sec, option))
+                except ValueError:
+                    raise ConfigurationException('%s is not an valid integer for %s' % 
+                                                 (config_parser.get(sec, option), option))
+                if options[name] < 1:
+                    raise ConfigurationException('%s must be positive' % option)
+        return ShareKeyManager(share_key_store, **options)
+        
+    def encrypt(self, mutation, columnar=False):
         """
         Arugments:
         mutation - an plaintext mutation as defined in the 
         pyaccumulo interface
+        columnar - (optional) if True, the encrypted updates that share
+        a row are returned in one ColumnarMutation instead of one 
+        mutation per update. Defaults to False.
         
         Returns: A list of new mutations containing the encrypted data
         as specified in the configuration file
         """
         enc_mut = EncMutation(mutation, self.encrypt_dict)
-        return enc_mut.encrypt()
+        return enc_mut.encrypt(columnar)
+    
+    def encrypt_batch(self, mutations, columnar=False):
+        """
+        Arguments:
+        mutations - a list of plaintext mutations as defined in the 
+        pyaccumulo interface
+        columnar - (optional) as for encrypt(), defaults to False
+        
+        Returns: A list containing, for each mutation, the list of 
+        new mutations that encrypt() returns for it. The cell sections
+        of the whole batch are encrypted together, and each key is 
+        retrieved from the key object only once.
+        """
+        encrypt_dict = self._batch_encryptor_dict(BatchKeyResolver(self.key_object))
+        return EncMutation.encrypt_batch([EncMutation(mutation, encrypt_dict)
+                                          for mutation in mutations],
+                                         columnar)
+    
+    def encrypt_many(self, mutations, workers=None, chunk_size=500, 
+                     columnar=False):
+        """
+        Arguments:
+        mutations - a list of plaintext mutations as defined in the 
+            pyaccumulo interface
+        workers - (optional) number of worker processes to use, defaults
+            to the number of CPUs
+        chunk_size - (optional) number of mutations encrypted together 
+            by a worker at a time, defaults to 500
+        columnar - (optional) as for encrypt(), defaults to False
+        
+        Returns: A list containing, for each mutation, the list of new
+        mutations that encrypt() returns for it, as encrypt_batch does. 
+        The mutations are encrypted in chunks by a pool of worker 
+        processes. The keys are retrieved up front, so workers never
+        contact the key store; a chunk that needs a key that could not
+        be retrieved up front is encrypted in this process instead. 
+        
+        If there is only one worker or chunk, or the pool cannot be
+        started, the mutations are encrypted in this process with 
+        encrypt_batch, as is any chunk of mutations that cannot be
+        pickled. 
+        
+        Raises ConfigurationException if there is more than one worker
+        and chunk but the keys and configuration cannot be copied to 
+        the worker processes, such as when share keys are reused with
+        a store that cannot be pickled (see visibility/share_keys.py). 
+        Use encrypt_batch, or one worker, with such configurations.
+        """
+        mutations = list(mutations)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be positive')
+        if workers <= 1 or len(mutations) <= chunk_size:
+            return self.encrypt_batch(mutations, columnar)
+        
+        encrypt_dict = self._batch_encryptor_dict(BatchKeyResolver(self.key_object))
+        self._resolve_encryption_keys(mutations, encrypt_dict)
+        chunks = [mutations[i:i+chunk_size] 
+                  for i in xrange(0, len(mutations), chunk_size)]
+        try:
+            pickled_encrypt_dict = cPickle.dumps(encrypt_dict, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError) as e:
+            raise ConfigurationException('encrypt_many cannot copy the keys and '
+                                         'configuration to worker processes, '
+                                         'use one worker instead: %s' % e)
+        try:
+            pool = multiprocessing.Pool(min(workers, len(chunks)),
+                                        _init_encrypt_worker,
+                                        (pickled_encrypt_dict,))
+        except OSError as e:
+            logger.warning('encrypt_many could not start worker processes, '
+                           'encrypting in this process instead: %s', e)
+            return self.encrypt_batch(mutations, columnar)
+        
+        enc_muts = []
+        pending = deque()
+        try:
+            #keep two chunks per worker in flight so memory stays bounded
+            for chunk in chunks:
+                if len(pending) >= 2*workers:
+                    enc_muts.extend(self._collect_chunk(pending.popleft(), encrypt_dict, columnar))
+                try:
+                    pickled_chunk = cPickle.dumps(chunk, cPickle.HIGHEST_PROTOCOL)
+                except (cPickle.PicklingError, TypeError) as e:
+                    logger.warning('encrypt_many could not pickle a chunk of '
+                                   'mutations, encrypting it in this process '
+                                   'instead: %s', e)
+                    pending.append((chunk, None))
+                else:
+                    pending.append((chunk, pool.apply_async(_encrypt_chunk, 
+                                                            (pickled_chunk, columnar))))
+            while pending:
+                enc_muts.extend(self._collect_chunk(pending.popleft(), encrypt_dict, columnar))
+        finally:
+            pool.terminate()
+            pool.join()
+        return enc_muts
+    
+    @staticmethod
+    def _collect_chunk(submitted, encrypt_dict, columnar=False):
+        """
+        Returns the encrypted mutations for a (chunk, result) pair 
+        submitted by encrypt_many, encrypting the chunk in this process
+        if it was not encrypted by a worker.
+        """
+        (chunk, result) = submitted
+        enc_muts = result.get() if result is not None else None
+        if enc_muts is None:
+            enc_muts = EncMutation.encrypt_batch([EncMutation(mutation, encrypt_dict)
+                                                  for mutation in chunk],
+                                                 columnar)
+        return enc_muts
+    
+    @staticmethod
+    def _resolve_encryption_keys(mutations, encrypt_dict):
+        """
+        Retrieves, through the key objects in encrypt_dict, the current
+        keys needed to encrypt mutations: the key for each AES algorithm
+        and, for each VIS algorithm, the key of every attribute in the 
+        visibility labels of the mutations. Keys that cannot be 
+        retrieved are skipped.
+        """
+        terms = None
+        for encryptor in encrypt_dict.values():
+            keytor = encryptor.key_container
+            if encryptor.encryption in AES_ALGORITHMS.values():
+                lookups = [(keytor.key_object.get_current_key, (keytor.key_id,))]
+            elif encryptor.encryption in VIS_ALGORITHMS.values():
+                if terms is None:
+                    labels = set(update.colVisibility 
+                                 for mutation in mutations 
+                                 for update in mutation.updates)
+                    terms = set()
+                    for label in labels:
+                        if label:
+                            terms.update(parse_cached(label).get_terms())
+                lookups = [(keytor.key_object.get_current_attribute_key, 
+                            (keytor.key_id, term)) for term in terms]
+            else:
+                lookups = []
+            for (lookup, args) in lookups:
+                try:
+                    lookup(*args)
+                except PKILookupError:
+                    pass
+    
+    def _batch_encryptor_dict(self, key_object):
+        """
+        Returns a copy of the encryption plan in which every
+        key container looks up its keys through key_object rather
+        than self.key_object.
+        """
+        return self.encrypt_dict.with_key_object(key_object)
     
     def encrypt_search(self, row, columns = None):
         '''
@@ -184,6 +755,33 @@ class AccumuloEncrypt(object):
                 as the second part of the tuple. 
         '''
         return EncRange.encrypt(row, columns, self.encrypt_dict)
+    
+    def encrypt_search_many(self, rows, columns = None, memo = None):
+        '''
+        Batched version of encrypt_search for looking up many rows
+        at once, for example with a batch scanner. 
+        
+        Arguments:
+        rows - list of rows to search for
+        columns - double nested list of what columns to look for, 
+            as in encrypt_search. Defaults to None. 
+        memo - (optional) cache of previously encrypted rows, with the
+            get and put methods of pace.common.lru_cache.LRUCache. 
+            Rows that repeat across calls sharing a memo are encrypted 
+            only once for each version of the key. Defaults to None. 
+            
+        Returns: A tuple containing two things:
+            1) a list containing, for each row, a Range that covers 
+               exactly the (encrypted) row
+            2) the encrypted columns, as in encrypt_search
+        The configuration is checked, the columns encrypted and the row
+        key retrieved only once for the whole list of rows. 
+        '''
+        (enc_rows, enc_cols) = EncRange.encrypt_many(rows, columns, 
+                                                     self.encrypt_dict, memo)
+        return ([Range(srow=row, erow=row, sinclude=True, einclude=True)
+                 for row in enc_rows],
+                enc_cols)
         
         
     def decrypt(self, cell):
@@ -197,3 +795,97 @@ class AccumuloEncrypt(object):
         return EncCell.decrypt(cell, self.encrypt_dict)
 
     
+    
+    def decrypt_batch(self, cells, skip_unreadable=False):
+        """
+        Arguments:
+        cells - an iterable of cells as defined in pyaccumulo
+        skip_unreadable - (optional) whether to leave out cells whose
+            visibility labels the user's attributes do not satisfy,
+            rather than raising an UnsatisfiableLabelException, 
+            defaults to False
+        
+        Returns: A list of new cells containing the decrypted data
+        as specified in the configuration file, in the same order as
+        cells. Each key needed by the batch is retrieved from the 
+        key object only once, no matter how many cells use it, and
+        the attribute keys are retrieved together before decryption
+        (see DecryptionSession). 
+        """
+        return self.decryption_session(skip_unreadable).decrypt_batch(cells)
+    
+    def decryption_session(self, skip_unreadable=False):
+        """
+        Arguments:
+        skip_unreadable - (optional) whether the session leaves out 
+            cells whose visibility labels the user's attributes do not
+            satisfy, defaults to False
+            
+        Returns: a new DecryptionSession for decrypting several batches
+        of cells, retrieving each key only once over all of them
+        """
+        return DecryptionSession(self, skip_unreadable)
+    
+    def decrypt_scan(self, conn, table, scanrange=None, cols=None,
+                     batch_size=1000, workers=4, prefetch=4, session=None):
+        """
+        Scans a table and decrypts the cells that are returned.
+        
+        Arguments:
+        conn - the connection to the accumulo server, either
+            a pyaccumulo.Accumulo or a FakeConnection
+        table - the name of the table to scan
+        scanrange - (optional) pyaccumulo.Range to pass to the scan,
+            defaults to None
+        cols - (optional) list of columns to pass to the scan,
+            defaults to None
+        batch_size - (optional) number of cells decrypted together,
+            defaults to 1000
+        workers - (optional) number of threads decrypting batches,
+            defaults to 4
+        prefetch - (optional) number of batches that may be read
+            from the scan or decrypted ahead of the cell most recently 
+            yielded, defaults to 4
+        session - (optional) DecryptionSession used to decrypt the 
+            cells, for example one that skips unreadable cells and 
+            counts them, defaults to a new session of this object
+        
+        Returns: A generator yielding the decrypted cells in the
+        order the scan returned them. The scan is read in a background
+        thread and batches are decrypted by a pool of worker threads,
+        so reading from the server overlaps with decryption. At most 
+        about 2*prefetch batches are held in memory at once. Each key 
+        is retrieved from the key object only once over the whole scan.
+        Exceptions raised by the scan or by decryption are raised 
+        from the generator. 
+        """
+        if batch_size < 1 or workers < 1 or prefetch < 1:
+            raise ValueError('batch_size, workers and prefetch must be positive')
+        
+        if session is None:
+            session = self.decryption_session()
+        decrypt = session.decrypt_batch
+        
+        reader = _ScanReader(conn.scan(table, scanrange=scanrange, cols=cols),
+                             batch_size, prefetch)
+        pool = ThreadPool(workers)
+        pending = deque()
+        try:
+            reader.start()
+            scan_done = False
+            while not scan_done or pending:
+                #keep up to prefetch batches decrypting ahead of the consumer
+                while not scan_done and len(pending) < prefetch:
+                    batch = reader.queue.get()
+                    if batch is None:
+                        scan_done = True
+                    elif isinstance(batch, Exception):
+                        raise batch
+                    else:
+                        pending.append(pool.apply_async(decrypt, (batch,)))
+                if pending:
+                    for cell in pending.popleft().get():
+                        yield cell
+        finally:
+            reader.stop()
+            pool.terminate()
@@ -16,16 +16,41 @@ base_dir = os.path.join(this_dir, '../..')
 sys.path.append(base_dir)
 
 import random
+import cPickle
 import logging
 import unittest
+import threading
 from StringIO import StringIO
 from pyaccumulo import Mutation, Cell, Range
-from pace.encryption.encryption_exceptions import EncryptionException, DecryptionException
-from pace.encryption.acc_encrypt import AccumuloEncrypt, ConfigurationException
+from pace.encryption.encryption_exceptions import EncryptionException, DecryptionException, \
+    UnsatisfiableLabelException
+from pace.encryption.acc_encrypt import AccumuloEncrypt, ConfigurationException, \
+    BatchKeyResolver
 from pace.encryption.encryption_pki import DummyEncryptionPKI
 from pace.pki.accumulo_keystore import AccumuloKeyStore
-from pace.encryption.AES_encrypt import Pycrypto_AES_CFB
+from pace.encryption.AES_encrypt import Pycrypto_AES_CFB, Pycrypto_AES_SIV
 from pace.common.fakeconn import FakeConnection 
+from pace.common.lru_cache import LRUCache
+from pace.encryption.visibility.share_keys import MemoryShareKeyStore, AccumuloShareKeyStore, \
+    ShareKeyManager
+from pace.encryption.visibility.vis_parser_test import accumulo_valid
+
+class CountingKeyObject(object):
+    """
+    Wraps a key object and counts the key lookups made of it
+    """
+    def __init__(self, key_object):
+        self.key_object = key_object
+        self.calls = []
+        
+    def __getattr__(self, name):
+        method = getattr(self.key_object, name)
+        if not callable(method) or name == 'cipher_contexts':
+            return method
+        def counted(*args):
+            self.calls.append((name,) + args)
+            return method(*args)
+        return counted
 
 class AccumuloCryptTest(unittest.TestCase):
     
@@ -150,6 +175,467 @@ class AccumuloCryptTest(unittest.TestCase):
             
         self.assertEqual(sorted(gt_cells), sorted(dec_cells))
         
+    def test_decrypt_batch(self):
+        '''
+        Tests that decrypting a batch of cells gives the same result
+        as decrypting each cell, while retrieving each key only once
+        '''
+        config = '[row]\n'+\
+                 'key_id = Pycrypto_AES_CFB\n'+\
+                 'encryption = Pycrypto_AES_CFB\n'+\
+                 '[value]\n'+\
+                 'key_id = Pycrypto_AES_OFB\n'+\
+                 'encryption = Pycrypto_AES_OFB'
+        mut = Mutation('row1')
+        for i in range(10):
+            mut.put(cf='cf%d' % i, cq='cq%d' % i, cv='', ts=i, val='val%d' % i)
+        ae = AccumuloEncrypt(StringIO(config), self.pki)
+        enc_cells = [Cell(m.row, u.colFamily, u.colQualifier, u.colVisibility,
+                          u.timestamp, u.value)
+                     for m in ae.encrypt(mut) for u in m.updates]
+        
+        counting_pki = CountingKeyObject(self.pki)
+        batch_ae = AccumuloEncrypt(StringIO(config), counting_pki)
+        dec_cells = batch_ae.decrypt_batch(enc_cells)
+        self.assertEqual(dec_cells, [ae.decrypt(c) for c in enc_cells])
+        self.assertEqual(sorted(counting_pki.calls),
+                         [('get_key', 'Pycrypto_AES_CFB', 3),
+                          ('get_key', 'Pycrypto_AES_OFB', 3)])
+        
+    def test_decrypt_batch_prefetch(self):
+        '''
+        Tests that the attribute keys needed to decrypt a batch of 
+        CEABAC cells are retrieved with a single request before the
+        cells are decrypted
+        '''
+        self.assertEqual(self.pki.get_attribute_keys('VIS_AES_CBC', 
+                                                     [('a', 1), ('a', 4), ('z', 1)]),
+                         {('a', 1) : 'Sixteen bate k1y'})
+        
+        config = '[value]\n'+\
+                 'key_id = VIS_AES_CBC\n'+\
+                 'encryption = VIS_AES_CBC'
+        ae = AccumuloEncrypt(StringIO(config), self.pki)
+        mut = Mutation('row1')
+        for (i, vis) in enumerate(['a&(b|c)', 'd|e', '(a&b)|c', 'a&(b|c)']):
+            mut.put(cf='cf%d' % i, cq='cq', cv=vis, ts=i, val='val%d' % i)
+        enc_cells = [Cell(m.row, u.colFamily, u.colQualifier, u.colVisibility,
+                          u.timestamp, u.value)
+                     for m in ae.encrypt(mut) for u in m.updates]
+        
+        counting_pki = CountingKeyObject(self.pki)
+        batch_ae = AccumuloEncrypt(StringIO(config), counting_pki)
+        session = batch_ae.decryption_session()
+        dec_cells = session.decrypt_batch(enc_cells)
+        self.assertEqual(dec_cells, [ae.decrypt(c) for c in enc_cells])
+        self.assertEqual(counting_pki.calls,
+                         [('get_attribute_keys', 'VIS_AES_CBC', 
+                           set([('a', 5), ('b', 3), ('c', 5), ('d', 2), ('e', 1)]))])
+        
+        #the keys are kept for later batches of the session
+        self.assertEqual(session.decrypt_batch(enc_cells[:2]), dec_cells[:2])
+        self.assertEqual(len(counting_pki.calls), 1)
+        
+        #keys the user lacks are only asked for once
+        counting_pki = CountingKeyObject(self.pki)
+        resolver = BatchKeyResolver(counting_pki)
+        resolver.prefetch_attribute_keys('VIS_AES_CBC', [('a', 1), ('z', 1)])
+        resolver.prefetch_attribute_keys('VIS_AES_CBC', [('a', 1), ('z', 1)])
+        resolver.prefetch_attribute_keys('VIS_AES_CBC', [('z', 1), ('a', 4)])
+        self.assertEqual(counting_pki.calls,
+                         [('get_attribute_keys', 'VIS_AES_CBC', set([('a', 1), ('z', 1)])),
+                          ('get_attribute_keys', 'VIS_AES_CBC', set([('a', 4)]))])
+        self.assertEqual(resolver.get_attribute_key('VIS_AES_CBC', 'a', 1),
+                         'Sixteen bate k1y')
+
+    def test_resolver_threads(self):
+        '''
+        Tests that a resolver retrieves different keys concurrently,
+        and a key being retrieved by one thread only once
+        '''
+        started = threading.Event()
+        release = threading.Event()
+        pki = self.pki
+        calls = []
+        class SlowKeyObject(object):
+            def get_attribute_key(self, algorithm, attribute, version=1):
+                calls.append(attribute)
+                if attribute == 'a':
+                    started.set()
+                    release.wait(10)
+                return pki.get_attribute_key(algorithm, attribute, version)
+        resolver = BatchKeyResolver(SlowKeyObject())
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                        resolver.get_attribute_key('VIS_AES_CBC', 'a', 1)))
+                   for _ in range(3)]
+        threads[0].start()
+        self.assertTrue(started.wait(10))
+        for thread in threads[1:]:
+            thread.start()
+        
+        #'a' is still being retrieved, but 'b' need not wait for it
+        other = []
+        thread = threading.Thread(target=lambda: other.append(
+                        resolver.get_attribute_key('VIS_AES_CBC', 'b', 1)))
+        thread.start()
+        thread.join(5)
+        self.assertEqual(other, [pki.get_attribute_key('VIS_AES_CBC', 'b', 1)])
+        release.set()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(results, [pki.get_attribute_key('VIS_AES_CBC', 'a', 1)]*3)
+        self.assertEqual(sorted(calls), ['a', 'b'])
+
+    def test_resolver_bounds(self):
+        '''
+        Tests that a resolver keeps a bounded number of keys, forgets
+        them after its ttl, and discards them when the keys change
+        '''
+        now = [0]
+        counting_pki = CountingKeyObject(self.pki)
+        resolver = BatchKeyResolver(counting_pki, max_size=2, ttl=10,
+                                    clock=lambda: now[0])
+        for version in (1, 2, 3, 1):
+            resolver.get_attribute_key('VIS_AES_CBC', 'a', version)
+        self.assertEqual([call[3] for call in counting_pki.calls], [1, 2, 3, 1])
+        resolver.get_attribute_key('VIS_AES_CBC', 'a', 1)
+        self.assertEqual(len(counting_pki.calls), 4)
+        
+        #expired keys are retrieved again
+        now[0] = 10
+        resolver.get_attribute_key('VIS_AES_CBC', 'a', 1)
+        self.assertEqual(len(counting_pki.calls), 5)
+        
+        #so are keys and missing keys once the keys change
+        resolver.prefetch_attribute_keys('VIS_AES_CBC', [('z', 1)])
+        resolver.prefetch_attribute_keys('VIS_AES_CBC', [('z', 1)])
+        self.assertEqual(len(counting_pki.calls), 6)
+        self.pki.keys_changed()
+        resolver.get_attribute_key('VIS_AES_CBC', 'a', 1)
+        resolver.prefetch_attribute_keys('VIS_AES_CBC', [('z', 1)])
+        self.assertEqual(counting_pki.calls[6:],
+                         [('get_attribute_key', 'VIS_AES_CBC', 'a', 1),
+                          ('get_attribute_keys', 'VIS_AES_CBC', set([('z', 1)]))])
+
+    def test_skip_unreadable(self):
+        '''
+        Tests that cells whose labels the user cannot satisfy are
+        skipped and counted, and that once a label is known to be
+        unsatisfiable its cells are rejected without any key lookups
+        '''
+        config = '[value]\n'+\
+                 'key_id = VIS_AES_CBC\n'+\
+                 'encryption = VIS_AES_CBC'
+        ae = AccumuloEncrypt(StringIO(config), self.pki)
+        mut = Mutation('row1')
+        for (i, vis) in enumerate(['a&(b|c)', 'd|e', 'd|e', '(a&b)|c', 'd|e']):
+            mut.put(cf='cf%d' % i, cq='cq', cv=vis, ts=i, val='val%d' % i)
+        enc_cells = [Cell(m.row, u.colFamily, u.colQualifier, u.colVisibility,
+                          u.timestamp, u.value)
+                     for m in ae.encrypt(mut) for u in m.updates]
+
+        limited_pki = DummyEncryptionPKI(terms=['a', 'b'])
+        counting_pki = CountingKeyObject(limited_pki)
+        limited_ae = AccumuloEncrypt(StringIO(config), counting_pki)
+        self.assertRaises(UnsatisfiableLabelException,
+                          limited_ae.decrypt_batch, enc_cells)
+
+        session = limited_ae.decryption_session(skip_unreadable=True)
+        dec_cells = session.decrypt_batch(enc_cells)
+        self.assertEqual(dec_cells, [ae.decrypt(enc_cells[0]),
+                                     ae.decrypt(enc_cells[3])])
+        self.assertEqual(session.skipped, 3)
+
+        #the label is rejected before any keys are looked up
+        counting_pki.calls = []
+        self.assertEqual(session.decrypt_batch(enc_cells[1:3]), [])
+        self.assertEqual(session.skipped, 5)
+        self.assertEqual(counting_pki.calls, [])
+
+        #until the keys of the user change
+        self.assertTrue(limited_pki.has_attribute('VIS_AES_CBC', 'a'))
+        self.assertFalse(limited_pki.has_attribute('VIS_AES_CBC', 'd'))
+        limited_pki.keys_changed()
+        session.decrypt_batch(enc_cells[1:2])
+        self.assertEqual(session.skipped, 6)
+        self.assertTrue(counting_pki.calls)
+
+    def test_decrypt_scan(self):
+        '''
+        Tests that decrypting a scan gives the same cells, in the same 
+        order, as decrypting each scanned cell, while retrieving each 
+        key only once
+        '''
+        config = '[row]\n'+\
+                 'key_id = Pycrypto_AES_CFB\n'+\
+                 'encryption = Pycrypto_AES_CFB\n'+\
+                 '[value]\n'+\
+                 'key_id = Pycrypto_AES_OFB\n'+\
+                 'encryption = Pycrypto_AES_OFB'
+        ae = AccumuloEncrypt(StringIO(config), self.pki)
+        conn = FakeConnection()
+        conn.create_table('enc_test')
+        for i in range(25):
+            mut = Mutation('row%d' % i)
+            mut.put(cf='cf%d' % i, cq='cq%d' % i, cv='', ts=i, val='val%d' % i)
+            for enc_mut in ae.encrypt(mut):
+                conn.write('enc_test', enc_mut)
+        
+        counting_pki = CountingKeyObject(self.pki)
+        scan_ae = AccumuloEncrypt(StringIO(config), counting_pki)
+        dec_cells = list(scan_ae.decrypt_scan(conn, 'enc_test', batch_size=4,
+                                              workers=3, prefetch=2))
+        self.assertEqual(dec_cells, 
+                         [ae.decrypt(c) for c in conn.scan('enc_test')])
+        self.assertEqual(len(dec_cells), 25)
+        self.assertEqual(sorted(counting_pki.calls),
+                         [('get_key', 'Pycrypto_AES_CFB', 3),
+                          ('get_key', 'Pycrypto_AES_OFB', 3)])
+        
+        self.assertEqual(list(scan_ae.decrypt_scan(conn, 'enc_test', 
+                                                   scanrange=Range(srow='none', 
+                                                                   erow='none'))),
+                         [])
+        
+    def test_encrypt_batch(self):
+        '''
+        Tests that encrypting a batch of mutations round trips and
+        retrieves each encryption key only once
+        '''
+        config = '[row]\n'+\
+                 'key_id = Pycrypto_AES_CTR\n'+\
+                 'encryption = Pycrypto_AES_CTR\n'+\
+                 '[colFamily]\n'+\
+                 'key_id = Pycrypto_AES_GCM\n'+\
+                 'cell_sections = colFamily,colQualifier\n'+\
+                 'encryption = Pycrypto_AES_GCM'
+        muts = []
+        for i in range(5):
+            mut = Mutation('row%d' % i)
+            mut.put(cf='cf%d' % i, cq='cq%d' % i, cv='', ts=i, val='val%d' % i)
+            mut.put(cf='cf', cq='cq', cv='', ts=i, val='val')
+            muts.append(mut)
+            
+        counting_pki = CountingKeyObject(self.pki)
+        ae = AccumuloEncrypt(StringIO(config), counting_pki)
+        enc_muts = ae.encrypt_batch(muts)
+        self.assertEqual(sorted(counting_pki.calls),
+                         [('get_current_key', 'Pycrypto_AES_CTR'),
+                          ('get_current_key', 'Pycrypto_AES_GCM')])
+        
+        self.assertEqual(len(enc_muts), len(muts))
+        for (mut, mut_enc_muts) in zip(muts, enc_muts):
+            dec_cells = [ae.decrypt(Cell(m.row, u.colFamily, u.colQualifier, 
+                                         u.colVisibility, u.timestamp, u.value))
+                         for m in mut_enc_muts for u in m.updates]
+            self.assertEqual(dec_cells,
+                             [Cell(mut.row, u.colFamily, u.colQualifier, 
+                                   u.colVisibility, u.timestamp, u.value)
+                              for u in mut.updates])
+        
+    def test_encrypt_batch_labels(self):
+        '''
+        Tests that cells with different visibility labels encrypted
+        together round trip, and that each attribute key is looked up
+        once per batch
+        '''
+        config = '[value]\n'+\
+                 'key_id = VIS_AES_CBC\n'+\
+                 'encryption = VIS_AES_CBC'
+        key_object = CountingKeyObject(self.pki)
+        ae = AccumuloEncrypt(StringIO(config), key_object)
+        
+        muts = []
+        for i in range(5):
+            mut = Mutation('row%d' % i)
+            mut.put(cf='cf', cq='cq', cv='a&(b|c)', ts=i, val='val%d' % i)
+            mut.put(cf='cf', cq='cq', cv='d|a', ts=i, val='val+%d' % i)
+            mut.put(cf='cf', cq='cq', cv='a&(b|c)', ts=i, val='')
+            muts.append(mut)
+        enc_muts = ae.encrypt_batch(muts)
+        lookups = [call for call in key_object.calls
+                   if call[0] == 'get_current_attribute_key']
+        self.assertEqual(sorted(call[2] for call in lookups), ['a', 'b', 'c', 'd'])
+        
+        dec_ae = AccumuloEncrypt(StringIO(config), self.pki)
+        for (mut, mut_enc_muts) in zip(muts, enc_muts):
+            dec_cells = [dec_ae.decrypt(Cell(m.row, u.colFamily, u.colQualifier, 
+                                             u.colVisibility, u.timestamp, u.value))
+                         for m in mut_enc_muts for u in m.updates]
+            self.assertEqual(dec_cells,
+                             [Cell(mut.row, u.colFamily, u.colQualifier, 
+                                   u.colVisibility, u.timestamp, u.value)
+                              for u in mut.updates])
+        
+    def test_threshold_labels(self):
+        '''
+        Tests that cells with threshold labels are written with the 
+        equivalent Accumulo column visibility, and decrypt with the 
+        threshold label stored with their shares
+        '''
+        config = '[value]\n'+\
+                 'key_id = VIS_AES_CBC\n'+\
+                 'encryption = VIS_AES_CBC'
+        mut = Mutation('row1')
+        mut.put(cf='cf', cq='cq', cv='2{a,b,c}&d', ts=1, val='val1')
+        mut.put(cf='cf', cq='cq', cv='a|b', ts=2, val='val2')
+        for store in [None, MemoryShareKeyStore()]:
+            ae = AccumuloEncrypt(StringIO(config + ('\nshare_key_reuse = true' 
+                                                    if store else '')),
+                                 self.pki, store)
+            enc_cells = [Cell(m.row, u.colFamily, u.colQualifier, u.colVisibility,
+                              u.timestamp, u.value)
+                         for m in ae.encrypt(mut) for u in m.updates]
+            self.assertEqual([c.cv for c in enc_cells], 
+                             ['((a&b)|(a&c)|(b&c))&d', 'a|b'])
+            self.assertTrue(all(accumulo_valid(c.cv) for c in enc_cells))
+            self.assertEqual([ae.decrypt(c).val for c in enc_cells], ['val1', 'val2'])
+            
+            #the stored label must expand to the cell's visibility
+            moved = enc_cells[0]._replace(cv='a|b')
+            self.assertRaises(DecryptionException, ae.decrypt, moved)
+        
+    def test_share_key_reuse(self):
+        '''
+        Tests that cells with the same visibility label share a cell
+        key when share_key_reuse is set, and that the key is replaced
+        after share_key_max_uses cells or when the keys change
+        '''
+        config = '[value]\n'+\
+                 'key_id = VIS_AES_CBC\n'+\
+                 'encryption = VIS_AES_CBC\n'+\
+                 'share_key_reuse = true\n'+\
+                 'share_key_max_uses = 3'
+        store = AccumuloShareKeyStore(FakeConnection())
+        ae = AccumuloEncrypt(StringIO(config), self.pki, store)
+        
+        muts = []
+        for i in range(4):
+            mut = Mutation('row%d' % i)
+            mut.put(cf='cf', cq='cq', cv='a&(b|c)', ts=i, val='val%d' % i)
+            mut.put(cf='cf', cq='cq', cv='d', ts=i, val='val+%d' % i)
+            muts.append(mut)
+        enc_muts = ae.encrypt_batch(muts)
+        
+        #one key for the first three cells of each label, then another
+        table = store.conn.db[store.table]
+        self.assertEqual(len(table), 4)
+        
+        dec_ae = AccumuloEncrypt(StringIO(config), self.pki, store)
+        for (mut, mut_enc_muts) in zip(muts, enc_muts):
+            dec_cells = [dec_ae.decrypt(Cell(m.row, u.colFamily, u.colQualifier, 
+                                             u.colVisibility, u.timestamp, u.value))
+                         for m in mut_enc_muts for u in m.updates]
+            self.assertEqual(dec_cells,
+                             [Cell(mut.row, u.colFamily, u.colQualifier, 
+                                   u.colVisibility, u.timestamp, u.value)
+                              for u in mut.updates])
+        
+        self.pki.keys_changed()
+        ae.encrypt(muts[0])
+        self.assertEqual(len(table), 6)
+        
+        #revoking a key through the key object's keystore changes the keys
+        ae.encrypt(muts[0])
+        self.assertEqual(len(table), 6)
+        self.pki._acc_keystore.remove_revoked_keys(self.pki._user_id, 'VIS_AES_CBC', 'e')
+        ae.encrypt(muts[0])
+        self.assertEqual(len(table), 8)
+        
+        #readers without the store cannot find the cell key
+        plain_ae = AccumuloEncrypt(StringIO(config.replace('true', 'false')), self.pki)
+        update = enc_muts[0][0].updates[0]
+        self.assertRaises(DecryptionException, plain_ae.decrypt,
+                          Cell(enc_muts[0][0].row, update.colFamily, update.colQualifier,
+                               update.colVisibility, update.timestamp, update.value))
+        
+    def test_share_key_pickling(self):
+        '''
+        Tests that a share key manager can be pickled, for the worker
+        processes of encrypt_many, unless its store only works within
+        one process, in which case encrypt_many refuses to use workers
+        '''
+        manager = ShareKeyManager(AccumuloShareKeyStore(FakeConnection()),
+                                  max_uses=3, max_labels=10)
+        copy = cPickle.loads(cPickle.dumps(manager, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copy.max_uses, 3)
+        self.assertEqual(copy._encryption_keys.max_size, 10)
+        self.assertEqual(len(copy._encryption_keys), 0)
+        with copy._lock:
+            pass
+        
+        self.assertRaises(TypeError, cPickle.dumps, 
+                          ShareKeyManager(MemoryShareKeyStore()))
+        
+        config = '[value]\n'+\
+                 'key_id = VIS_AES_CBC\n'+\
+                 'encryption = VIS_AES_CBC\n'+\
+                 'share_key_reuse = true'
+        ae = AccumuloEncrypt(StringIO(config), self.pki, MemoryShareKeyStore())
+        muts = []
+        for i in range(10):
+            mut = Mutation('row%d' % i)
+            mut.put(cf='cf', cq='cq', cv='a&(b|c)', ts=i, val='val%d' % i)
+            muts.append(mut)
+        self.assertRaises(ConfigurationException, ae.encrypt_many, muts,
+                          workers=2, chunk_size=3)
+        enc_muts = ae.encrypt_many(muts, workers=1, chunk_size=3)
+        for (mut, mut_enc_muts) in zip(muts, enc_muts):
+            dec_cells = [ae.decrypt(Cell(m.row, u.colFamily, u.colQualifier, 
+                                         u.colVisibility, u.timestamp, u.value))
+                         for m in mut_enc_muts for u in m.updates]
+            self.assertEqual(dec_cells,
+                             [Cell(mut.row, u.colFamily, u.colQualifier, 
+                                   u.colVisibility, u.timestamp, u.value)
+                              for u in mut.updates])
+        
+    def test_share_key_configuration(self):
+        '''
+        Tests the configuration errors for share_key_reuse
+        '''
+        vis = '[value]\nkey_id = VIS_AES_CBC\nencryption = VIS_AES_CBC\n'
+        store = MemoryShareKeyStore()
+        for (config, config_store) in [(vis + 'share_key_reuse = true\n', None),
+                                       ('[value]\nkey_id = Pycrypto_AES_CBC\n'+\
+                                        'encryption = Pycrypto_AES_CBC\n'+\
+                                        'share_key_reuse = true\n', store),
+                                       (vis + 'share_key_reuse = maybe\n', store),
+                                       (vis + 'share_key_reuse = true\n'+\
+                                        'share_key_max_age = 0\n', store)]:
+            self.assertRaises(ConfigurationException, AccumuloEncrypt,
+                              StringIO(config), self.pki, config_store)
+        
+    def test_encrypt_many(self):
+        '''
+        Tests that encrypting mutations in worker processes round trips
+        and returns the encrypted mutations in order
+        '''
+        config = '[row]\n'+\
+                 'key_id = Pycrypto_AES_CTR\n'+\
+                 'encryption = Pycrypto_AES_CTR\n'+\
+                 '[value]\n'+\
+                 'key_id = VIS_AES_CBC\n'+\
+                 'encryption = VIS_AES_CBC'
+        muts = []
+        for i in range(40):
+            mut = Mutation('row%d' % i)
+            mut.put(cf='cf%d' % i, cq='cq', cv='a&(b|c)', ts=i, val='val%d' % i)
+            muts.append(mut)
+            
+        ae = AccumuloEncrypt(StringIO(config), self.pki)
+        for workers in [1, 3]:
+            enc_muts = ae.encrypt_many(muts, workers=workers, chunk_size=7)
+            self.assertEqual(len(enc_muts), len(muts))
+            for (mut, mut_enc_muts) in zip(muts, enc_muts):
+                dec_cells = [ae.decrypt(Cell(m.row, u.colFamily, u.colQualifier, 
+                                             u.colVisibility, u.timestamp, u.value))
+                             for m in mut_enc_muts for u in m.updates]
+                self.assertEqual(dec_cells,
+                                 [Cell(mut.row, u.colFamily, u.colQualifier, 
+                                       u.colVisibility, u.timestamp, u.value)
+                                  for u in mut.updates])
+        
     def _run_search(self, config, row, cols, correct_cells):
         '''
         Tests the encrypting search functionality
@@ -185,6 +671,52 @@ class AccumuloCryptTest(unittest.TestCase):
             
         self.assertEqual(sorted(dec_cells), sorted(correct_cells))
         
+    def test_encrypt_search_many(self):
+        '''
+        Tests that searching for many rows at once finds the same cells 
+        as searching for each row, while retrieving the row key once 
+        per call and encrypting rows in the memo only once
+        '''
+        config = '[row]\n'+\
+                 'key_id = Pycrypto_AES_SIV\n'+\
+                 'encryption = Pycrypto_AES_SIV\n'+\
+                 '[colFamily]\n'+\
+                 'key_id = Pycrypto_AES_SIV\n'+\
+                 'encryption = Pycrypto_AES_SIV'
+        ae = AccumuloEncrypt(StringIO(config), self.pki)
+        conn = FakeConnection()
+        conn.create_table('enc_test')
+        for i in range(5):
+            mut = Mutation('row%d' % i)
+            mut.put(cf='cf1', cq='cq1', cv='', ts=i, val='val%d' % i)
+            mut.put(cf='cf2', cq='cq2', cv='', ts=i, val='val%d' % i)
+            for enc_mut in ae.encrypt(mut):
+                conn.write('enc_test', enc_mut)
+        
+        counting_pki = CountingKeyObject(self.pki)
+        search_ae = AccumuloEncrypt(StringIO(config), counting_pki)
+        rows = ['row3', 'row0', 'row3', 'norow']
+        memo = LRUCache(10)
+        (ranges, enc_cols) = search_ae.encrypt_search_many(rows, [['cf2']], memo)
+        self.assertEqual(len(ranges), len(rows))
+        self.assertEqual(counting_pki.calls.count(('get_current_key', 'Pycrypto_AES_SIV')), 2)
+        for (row, scanrange) in zip(rows, ranges):
+            (enc_row, expected_cols) = ae.encrypt_search(row, [['cf2']])
+            self.assertEqual((scanrange.srow, scanrange.erow), (enc_row, enc_row))
+            self.assertEqual(enc_cols, expected_cols)
+            dec_cells = [ae.decrypt(c) for c in conn.scan('enc_test', 
+                                                          scanrange=scanrange,
+                                                          cols=enc_cols)]
+            self.assertEqual(dec_cells, 
+                             [Cell(row, 'cf2', 'cq2', '', int(row[3]), 'val'+row[3])]
+                             if row != 'norow' else [])
+        self.assertEqual(memo.misses, 3)
+        
+        (ranges_again, _) = search_ae.encrypt_search_many(['row0', 'row3'], None, memo)
+        self.assertEqual([r.srow for r in ranges_again], 
+                         [ranges[1].srow, ranges[0].srow])
+        self.assertEqual(memo.hits, 2)
+        
     def test_det_row_search(self):
         config = '[row]\n'+\
                 'key_id = Pycrypto_AES_SIV\n'+\
@@ -195,6 +727,57 @@ class AccumuloCryptTest(unittest.TestCase):
                          [Cell('brow','cf1','cq1','',6,'val1'),
                           Cell('brow','cf2','cq2','',7,'val2')]) 
     
+    def test_legacy_det_search(self):
+        '''
+        Tests that searches still find deterministically encrypted
+        cells written in the legacy format, with the key version 
+        appended after 'ver'
+        '''
+        config = '[row]\n'+\
+                'key_id = Pycrypto_AES_SIV\n'+\
+                'encryption = Pycrypto_AES_SIV\n'+\
+                '[colFamily]\n'+\
+                'key_id = Pycrypto_AES_SIV\n'+\
+                'encryption = Pycrypto_AES_SIV\n'
+        (key, version) = self.pki.get_current_key('Pycrypto_AES_SIV')
+        legacy = lambda ptext: Pycrypto_AES_SIV._encrypt(ptext, key) + 'ver' + str(version)
+        
+        conn = FakeConnection()
+        conn.create_table('enc_test')
+        for (row, cf, ts) in [('arow', 'cf1', 1), ('brow', 'cf1', 2), ('brow', 'cf2', 3)]:
+            mut = Mutation(legacy(row))
+            mut.put(cf=legacy(cf), cq='cq', cv='', ts=ts, val='val%d' % ts)
+            conn.write('enc_test', mut)
+        
+        ae = AccumuloEncrypt(StringIO(config), self.pki)
+        (enc_row, enc_cols) = ae.encrypt_search('brow', [['cf2']])
+        dec_cells = [ae.decrypt(c) for c in conn.scan('enc_test', 
+                                                      scanrange=Range(srow=enc_row, 
+                                                                      erow=enc_row,
+                                                                      sinclude=True,
+                                                                      einclude=True),
+                                                      cols=enc_cols)]
+        self.assertEqual(dec_cells, [Cell('brow', 'cf2', 'cq', '', 3, 'val3')])
+        
+        #several cell sections encrypted together, joined by '+'
+        config += 'cell_sections = colFamily,colQualifier\n'
+        conn = FakeConnection()
+        conn.create_table('enc_test')
+        for (row, cf, ts) in [('brow', 'cf1', 1), ('brow', 'cf2', 2)]:
+            mut = Mutation(legacy(row))
+            mut.put(cf=legacy(cf + '+cq'), cq='', cv='', ts=ts, val='val%d' % ts)
+            conn.write('enc_test', mut)
+        
+        ae = AccumuloEncrypt(StringIO(config), self.pki)
+        (enc_row, enc_cols) = ae.encrypt_search('brow', [['cf2', 'cq']])
+        dec_cells = [ae.decrypt(c) for c in conn.scan('enc_test', 
+                                                      scanrange=Range(srow=enc_row, 
+                                                                      erow=enc_row,
+                                                                      sinclude=True,
+                                                                      einclude=True),
+                                                      cols=enc_cols)]
+        self.assertEqual(dec_cells, [Cell('brow', 'cf2', 'cq', '', 2, 'val2')])
+        
     def test_unencrypted_search(self):
         config = '[colFamily]\n'+\
                 'key_id = Pycrypto_AES_CBC\n'+\
@@ -18,12 +18,228 @@ sys.path.append(base_dir)
 
 import itertools
 import copy
-from collections import defaultdict
+import struct
+from collections import defaultdict, namedtuple
 from pyaccumulo import Mutation, Cell, Range
-from operator import methodcaller
 
 from pace.encryption.encryption_exceptions import EncryptionException, DecryptionException
-from pace.encryption.vars import DELIN_CHAR, CELL_MUT_MAPPING, DET_ALGORITHMS, VALID_KEYS, CELL_ORDER
+from pace.encryption.vars import DELIN_CHAR, SECTIONS_MARKER, CELL_MUT_MAPPING, DET_ALGORITHMS, VALID_KEYS, CELL_ORDER
+from pace.encryption.visibility.vis_parser import accumulo_expression
+
+#marker and number of sections at the start of a packed value
+SECTIONS_PREFIX = struct.Struct('>BB')
+
+_SECTIONS_HEADERS = {}
+
+def _sections_header(num_sections):
+    '''
+    Returns: the struct for the header of a packed value with 
+    num_sections sections: the marker, the number of sections and 
+    the length of each section 
+    '''
+    header = _SECTIONS_HEADERS.get(num_sections)
+    if header is None:
+        header = struct.Struct('>BB%dI' % num_sections)
+        _SECTIONS_HEADERS[num_sections] = header
+    return header
+
+def _to_str(data):
+    '''
+    Returns: the bytes of data as a string, memoryviews
+    do not convert with str()
+    '''
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return str(data)
+
+def pack_sections(values, delimited=False):
+    '''
+    Arguments:
+    values - list of strings holding the cell sections 
+    delimited - (optional) if True, the values are joined by DELIN_CHAR
+        as in earlier versions, defaults to False
+    
+    Returns: a single string holding all of the values. A single 
+    value is returned unchanged. Several values are prefixed by a 
+    header recording the length of each, so that values containing
+    DELIN_CHAR or any other byte are recovered exactly by 
+    unpack_sections. 
+    
+    Deterministically encrypted values must be delimited: searches 
+    compare them against the ciphertexts of values written by earlier
+    versions, so the same sections must give the same bytes.
+    '''
+    if len(values) == 1:
+        return values[0]
+    if delimited:
+        return DELIN_CHAR.join(values)
+    header = _sections_header(len(values))
+    return header.pack(SECTIONS_MARKER, len(values), *map(len, values)) + ''.join(values)
+
+def unpack_sections(data, num_sections=None):
+    '''
+    Arguments:
+    data - string or buffer (str, bytearray, buffer or memoryview) 
+           holding a value written by pack_sections
+    num_sections - number of sections expected in the value, if
+           known. Values with a single section are returned whole.
+    
+    Returns: the list of sections held in the value. Values that
+    are not in the packed format, such as delimited values, are 
+    split on DELIN_CHAR. 
+    '''
+    if num_sections == 1:
+        return [_to_str(data)]
+    
+    if len(data) >= SECTIONS_PREFIX.size:
+        (marker, count) = SECTIONS_PREFIX.unpack_from(data)
+        if marker == SECTIONS_MARKER and count > 1 and\
+           num_sections in (None, count):
+            header = _sections_header(count)
+            if len(data) >= header.size:
+                lengths = header.unpack_from(data)[2:]
+                start = header.size
+                if start + sum(lengths) == len(data):
+                    sections = []
+                    for section_length in lengths:
+                        sections.append(_to_str(data[start:start + section_length]))
+                        start += section_length
+                    return sections
+    
+    return _to_str(data).split(DELIN_CHAR)
+
+PlanStep = namedtuple('PlanStep', ['cell_location', 'cell_field', 'encryptor'])
+"""
+A single step of an EncryptionPlan, encrypting some sections of a cell
+into one location.
+    cell_location - the part of the cell (as in VALID_KEYS) where the
+                    encrypted data is stored
+    cell_field - the field of a pyaccumulo Cell for cell_location
+    encryptor - the Encryptor for cell_location 
+"""
+
+class EncryptionPlan(dict):
+    """
+    Read-only encryptor dictionary, keyed by cell location, that is 
+    compiled once into the steps needed to encrypt or decrypt a 
+    mutation or cell, so that they need not be worked out again for 
+    every mutation or cell. May be used anywhere an encryptor 
+    dictionary is expected. 
+    
+    Attributes:
+        steps - tuple of PlanSteps in the order of VALID_KEYS 
+        blanked_sections - tuple of the cell sections that are 
+            encrypted into another location, but are not themselves
+            the location of encrypted data, and so must be blanked
+            in the encrypted mutation
+    """
+    
+    def __init__(self, encryptor_dict):
+        """
+        Arguments:
+        encryptor_dict - dictionary keyed by cell location
+             containing the Encryptor for that location
+        """
+        dict.__init__(self, encryptor_dict)
+        self.steps = tuple(PlanStep(cell_location,
+                                    CELL_MUT_MAPPING[cell_location],
+                                    encryptor)
+                           for (cell_location, encryptor) 
+                           in sorted(encryptor_dict.items(), 
+                                     key=lambda item: VALID_KEYS.index(item[0])))
+        
+        source_locations = set()
+        for step in self.steps:
+            source_locations.update(step.encryptor.cell_sections)
+        self.blanked_sections = tuple(sec for sec in VALID_KEYS 
+                                      if sec in source_locations and sec not in self)
+        
+    @classmethod
+    def compile(cls, encryptor_dict):
+        """
+        Returns: encryptor_dict if it is already an EncryptionPlan,
+        otherwise a new EncryptionPlan for it
+        """
+        if isinstance(encryptor_dict, cls):
+            return encryptor_dict
+        return cls(encryptor_dict)
+    
+    def with_key_object(self, key_object):
+        """
+        Returns: a new EncryptionPlan in which every key container
+        looks up its keys through key_object 
+        """
+        return EncryptionPlan(dict((sec, encryptor._replace(
+                    key_container=encryptor.key_container._replace(key_object=key_object)))
+                    for (sec, encryptor) in self.items()))
+        
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('EncryptionPlan cannot be modified')
+    
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+    
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+#the cell sections of a mutation's updates, other than the row
+UPDATE_SECTIONS = ('colFamily', 'colQualifier', 'colVisibility', 
+                   'timestamp', 'value', 'deleteCell')
+
+def _accumulo_labels(labels, plan):
+    '''
+    Returns: the visibility labels in labels as they are written to 
+    Accumulo, with any threshold terms expanded (see accumulo_expression
+    in vis_parser.py). Labels that plan encrypts are ciphertexts rather
+    than expressions, and are returned unchanged.
+    '''
+    if 'colVisibility' in plan:
+        return labels
+    return [accumulo_expression(label) if label else label for label in labels]
+
+class ColumnarMutation(Mutation):
+    '''
+    Mutation that holds its updates as one list per cell section
+    (in the order of UPDATE_SECTIONS) rather than as a
+    list of update objects, as returned by EncMutation.encrypt when
+    columnar is True. The update objects are built the first time 
+    updates is read, for example when the mutation is written to 
+    Accumulo, and kept until the mutation is changed.
+    '''
+    def __init__(self, row, columns=None):
+        '''
+        Arguments:
+        row - the row of every update in the mutation
+        columns - (optional) list of the column family, column 
+             qualifier, column visibility, timestamp, value and 
+             delete flag lists of the updates
+        '''
+        Mutation.__init__(self, row)
+        if columns is not None:
+            self.columns = columns
+    
+    def __len__(self):
+        return len(self.columns[0])
+    
+    def put(self, cf='', cq='', cv=None, ts=None, val='', is_delete=None):
+        for (column, item) in zip(self.columns, (cf, cq, cv, ts, val, is_delete)):
+            column.append(item)
+        self._updates = None
+    
+    @property
+    def updates(self):
+        if self._updates is None:
+            mut = Mutation(self.row)
+            for (cf,cq,cv,ts,v,dc) in itertools.izip(*self.columns):
+                mut.put(cf,cq,cv,ts,v,dc)
+            self._updates = mut.updates
+        return self._updates
+    
+    @updates.setter
+    def updates(self, updates):
+        self.columns = [[getattr(update, sec) for update in updates]
+                        for sec in UPDATE_SECTIONS]
+        self._updates = None
 
 class EncMutation(Mutation): 
     '''
@@ -41,8 +257,16 @@ class EncMutation(Mutation):
              contains the key object for retrieving the key
         '''
         self._encrypted = False
+        self.encryptor_dict = EncryptionPlan.compile(encryptor_dict)
+        
+        if isinstance(mut, ColumnarMutation):
+            self._num_updates = len(mut)
+            self.update_dict = dict(zip(UPDATE_SECTIONS, 
+                                        [list(column) for column in mut.columns]))
+            self.update_dict['row'] = [mut.row] * len(mut)
+            return
+        
         self._num_updates = len(mut.updates)
-        self.encryptor_dict = encryptor_dict 
         
         #lists of updates grouped by cell location 
         self.update_dict = {}
@@ -81,19 +305,21 @@ class EncMutation(Mutation):
         return not self.__eq__(other)
         
     @staticmethod   
-    def concatenate_cell_section_values(mutation, cell_sections):
+    def concatenate_cell_section_values(mutation, cell_sections, delimited=False):
         '''
         Arguments:
         mutation - Mutation which one wants to extract
         the list of all the same cell locations
         cell_sections - the location(s) that need to be 
         extracted from the mutation
+        delimited - (optional) passed on to pack_sections, 
+        defaults to False
         
         Returns: a list of all of the cell locations 
         for that mutation (taking into account all of
         the cell's updates). If there is more then one
-        location, it is a list of the value concatenated
-        by the DELIN_CHAR character. 
+        location, it is a list of the values packed 
+        together by pack_sections. 
         
         For example: 
             mut = Mutation('abcd')
@@ -102,26 +328,29 @@ class EncMutation(Mutation):
         and 
             cell_sections = [colFamily, value]
         this function would return: 
-            ['cf1|val1','cf2|val2']
+            [pack_sections(['cf1','val1']), pack_sections(['cf2','val2'])]
         '''
-        sections = [mutation[sec] for sec in cell_sections]
-        return [DELIN_CHAR.join(map(str, u)) for u in zip(*sections)]
+        sections = [map(str, mutation[sec]) for sec in cell_sections]
+        if len(sections) == 1:
+            return sections[0]
+        return [pack_sections(u, delimited) for u in zip(*sections)]
     
     @staticmethod
-    def split_values(values):
+    def split_values(values, num_sections=None):
         '''
         Arguments:
         values - A list of values constructed by 
-        get_values_by_cell_string in which individual entries
-        are made of cell values concatenated by the DELIN_CHAR
+        concatenate_cell_section_values
+        num_sections - the number of cell sections packed into
+        each value, if known
         
         Returns: A list of tuples, the first list consisting of 
-        the first values marked by the DELIN_CHAR, the second list
-        the second values in the entries, and so on. For example
-        the list ['a|b|c', "1|2|3"] would return [(a,1), (b, 2), 
-        (c, 3)]. 
+        the first section of each value, the second list
+        the second sections of the values, and so on. For example
+        the values packed from ['a','b','c'] and ['1','2','3'] 
+        would return [(a,1), (b, 2), (c, 3)]. 
         '''
-        return zip(*map(methodcaller('split', DELIN_CHAR), values))
+        return zip(*[unpack_sections(value, num_sections) for value in values])
     
     def _remove_unencrypted_cell_sections(self, updates):
         """
@@ -133,14 +362,8 @@ class EncMutation(Mutation):
         unencrypted data, and replaces it with a list of empty
         strings as long as the original list of updates.
         """
-        source_locations = set()
-        target_locations = set()
-        for (cell_string, encryptor) in self.encryptor_dict.items():
-            source_locations.update(encryptor.cell_sections)
-            target_locations.add(cell_string)
-        
-        for sec in (source_locations - target_locations):
-            updates[sec] = list(itertools.repeat("", self._num_updates))
+        for sec in self.encryptor_dict.blanked_sections:
+            updates[sec] = [''] * self._num_updates
             
         return updates
             
@@ -152,23 +375,58 @@ class EncMutation(Mutation):
         """
         return self._key_object.get_key(key_id)
     
-    def encrypt(self):
+    def encrypt(self, columnar=False):
         '''
+        Arguments:
+        columnar - (optional) if True, consecutive updates that share
+             a row are returned in one ColumnarMutation rather than 
+             one Mutation per update. Defaults to False.
+        
         Returns a list of new mutations. Each portion of the cell that 
         has an associated encryptor is encrypted. 
         ''' 
+        return EncMutation.encrypt_batch([self], columnar)[0]
+    
+    @staticmethod
+    def encrypt_batch(enc_muts, columnar=False):
+        '''
+        Arguments:
+        enc_muts - list of EncMutations that all share the same 
+             encryptor_dict
+        columnar - (optional) passed on to encrypt(), defaults to False
+        
+        Returns: A list containing, for each EncMutation, the list
+        of new mutations that encrypt() returns for it. Each encryptor
+        encrypts its cell sections for the whole batch in one call.
+        '''
         #only want to encrypt the values once
-        if not self._encrypted:
-            self._encrypted = True 
-            enc_updates = self.update_dict.copy()
-            for (cell_string, encryptor) in self.encryptor_dict.items():
-                enc_updates[cell_string] = encryptor.encryption.encrypt_mutation(self, 
+        pending = [enc_mut for enc_mut in enc_muts if not enc_mut._encrypted]
+        if pending:
+            enc_updates = [enc_mut.update_dict.copy() for enc_mut in pending]
+            for step in pending[0].encryptor_dict.steps:
+                encryptor = step.encryptor
+                ctexts = encryptor.encryption.encrypt_mutations(pending,
                                                       encryptor.key_container,
-                                                      encryptor.cell_sections)     
-            self.update_dict = self._remove_unencrypted_cell_sections(enc_updates)
-            
-        #TODO: in the case where the row is deterministically encrypted
-        # update to only produce one mutation
+                                                      encryptor.cell_sections)
+                for (updates, mut_ctexts) in zip(enc_updates, ctexts):
+                    updates[step.cell_location] = mut_ctexts
+            for (enc_mut, updates) in zip(pending, enc_updates):
+                enc_mut._encrypted = True
+                updates['colVisibility'] = _accumulo_labels(updates['colVisibility'],
+                                                            enc_mut.encryptor_dict)
+                enc_mut.update_dict = enc_mut._remove_unencrypted_cell_sections(updates)
+        
+        if columnar:
+            return [enc_mut._to_columnar_mutations() for enc_mut in enc_muts]
+        return [enc_mut._to_mutations() for enc_mut in enc_muts]
+    
+    def _to_mutations(self):
+        '''
+        Returns a list of new mutations built from the current
+        contents of update_dict, one per update.
+        '''
+        #updates that share a row are only grouped into one mutation
+        #when encrypting with columnar set (see _to_columnar_mutations)
         muts = []
         for (row, cf,cq,cv,ts,v,dc) in zip(*self):
             mut = Mutation(row)
@@ -176,6 +434,29 @@ class EncMutation(Mutation):
             muts.append(mut)
         return muts
     
+    def _to_columnar_mutations(self):
+        '''
+        Returns a list of new ColumnarMutations built from the current
+        contents of update_dict. Consecutive updates that share a row
+        are written into the same mutation, so when the row is not 
+        encrypted or is deterministically encrypted only one mutation
+        is produced; otherwise there is one mutation per update.
+        '''
+        rows = self.update_dict['row']
+        columns = [self.update_dict[sec] for sec in UPDATE_SECTIONS]
+        
+        if len(set(rows)) == 1:
+            return [ColumnarMutation(rows[0], columns)]
+        
+        muts = []
+        start = 0
+        for end in xrange(1, len(rows) + 1):
+            if end == len(rows) or rows[end] != rows[start]:
+                muts.append(ColumnarMutation(rows[start], 
+                                             [column[start:end] for column in columns]))
+                start = end
+        return muts
+    
     def decrypt(self):
         '''
         Returns a new mutation. Each portion of the cell that 
@@ -183,16 +464,17 @@ class EncMutation(Mutation):
         used for testing.
         '''
         dec_updates = self.update_dict.copy()
-        for (cell_string, encryptor) in self.encryptor_dict.items():
+        for step in self.encryptor_dict.steps:
+            encryptor = step.encryptor
             encryptor.encryption.decrypt_mutation(self, 
                                                   dec_updates,
                                                   encryptor.key_container,
-                                                  cell_string,
+                                                  step.cell_location,
                                                   encryptor.cell_sections)
         
         self.update_dict = dec_updates
-        #only should be one cell since each encrypted mutation only contains one cell
-        assert len(self.update_dict['row']) == 1
+        #only should be one row since each encrypted mutation only contains one row
+        assert len(set(self.update_dict['row'])) == 1
         mut = Mutation(self.update_dict['row'][0])
         for (row, cf,cq,cv,ts,v,dc) in zip(*self):
             mut.put(cf,cq,cv,ts,v,dc) 
@@ -221,13 +503,14 @@ class EncRange(Range):
         extracted from the dict
   
         Returns: a string of all of the cell_sections 
-        for the range concatenated by the DELIN_CHAR
+        for the range joined by DELIN_CHAR, as they are for
+        deterministically encrypted cells (see pack_sections)
         '''
-        return DELIN_CHAR.join([str(cols[sec]) for sec in cell_sections])
+        return pack_sections([str(cols[sec]) for sec in cell_sections], True)
     
     @staticmethod
-    def split_value_by_cell_string(value):
-        return value.split(DELIN_CHAR)
+    def split_value_by_cell_string(value, num_sections=None):
+        return unpack_sections(value, num_sections)
     
     @staticmethod
     def _remove_unencrypted_cell_sections(encryptor_dict, col_dict):
@@ -240,13 +523,7 @@ class EncRange(Range):
         unencrypted data, and replaces it with a list of empty
         strings as long as the original list of updates.
         """
-        source_locations = set()
-        target_locations = set()
-        for (cell_string, encryptor) in encryptor_dict.items():
-            source_locations.update(encryptor.cell_sections)
-            target_locations.add(cell_string)
-        
-        for sec in (source_locations - target_locations):
+        for sec in EncryptionPlan.compile(encryptor_dict).blanked_sections:
             col_dict[sec] = ''
             
     @staticmethod
@@ -327,20 +604,67 @@ class EncRange(Range):
             
         would. 
         '''
-        if not EncRange._valid_configuration(encryptor_dict):
-            raise EncryptionException('Cannot encrypt a range object in which the configuration '+\
-                                      'has the leading portion of the key not either unencrypted ' +\
-                                      'or deterministically encrypted.')
+        encryptor_dict = EncryptionPlan.compile(encryptor_dict)
+        EncRange._check_configuration(encryptor_dict)
        
         #check to see if the row is being encrypted
         if encryptor_dict.has_key('row'):
             encryptor = encryptor_dict['row']
             row = encryptor.encryption.encrypt_row(row, encryptor.key_container)       
             
+        return (row, EncRange._encrypt_cols(cols, encryptor_dict))
+    
+    @staticmethod
+    def encrypt_many(rows, cols, encryptor_dict, memo=None):
+        '''
+        Arguments:
+        rows - list of rows to search for
+        cols - double nested list of what columns to look for, 
+            as in encrypt, or None
+        encryptor_dict - dictionary keyed by cell location
+             containing a tuple of the encryptor class and also
+             contains the key object for retrieving the key
+        memo - (optional) cache of previously encrypted rows, with 
+             the get and put methods of pace.common.lru_cache.LRUCache
+        
+        Returns: (encrypted_rows, encrypted_col_list) where encrypted_rows
+        is a list of the rows encrypted as encrypt would encrypt each of 
+        them, in the same order, and encrypted_col_list is as returned by
+        encrypt. The configuration is checked and the columns encrypted 
+        only once, and the rows are encrypted together. 
+        
+        Raises the same errors as encrypt.
+        '''
+        encryptor_dict = EncryptionPlan.compile(encryptor_dict)
+        EncRange._check_configuration(encryptor_dict)
+        
+        rows = list(rows)
+        if encryptor_dict.has_key('row'):
+            encryptor = encryptor_dict['row']
+            rows = encryptor.encryption.encrypt_rows(rows, encryptor.key_container,
+                                                     memo)
+        return (rows, EncRange._encrypt_cols(cols, encryptor_dict))
+    
+    @staticmethod
+    def _check_configuration(encryptor_dict):
+        '''
+        Raises an EncryptionException if the configuration
+        is not valid for searching, see _valid_configuration
+        '''
+        if not EncRange._valid_configuration(encryptor_dict):
+            raise EncryptionException('Cannot encrypt a range object in which the configuration '+\
+                                      'has the leading portion of the key not either unencrypted ' +\
+                                      'or deterministically encrypted.')
+    
+    @staticmethod
+    def _encrypt_cols(cols, encryptor_dict):
+        '''
+        Returns: the double nested list of columns cols, encrypted 
+        as encrypt specifies, or None if cols is None
+        '''
         enc_cols = []
         if cols == None:
-            return (row, None)
-        
+            return None
         
         for col in cols:
             col_dict = defaultdict(constant_empty())
@@ -363,7 +687,7 @@ class EncRange(Range):
             else: 
                 enc_cols.append([enc_col['colFamily'], enc_col['colQualifier']])
                 
-        return (row, enc_cols)
+        return enc_cols
     
     
 class EncCell(Cell):
@@ -371,12 +695,13 @@ class EncCell(Cell):
     Contains the logic for encrypting and decrypting a single cell
     '''
     @staticmethod
-    def get_value_by_cell_string(cell, cell_sections):
-        return DELIN_CHAR.join([str(cell[CELL_MUT_MAPPING[sec]]) for sec in cell_sections])
+    def get_value_by_cell_string(cell, cell_sections, delimited=False):
+        return pack_sections([str(cell[CELL_MUT_MAPPING[sec]]) for sec in cell_sections],
+                             delimited)
     
     @staticmethod
-    def split_value_by_cell_string(value):
-        return value.split(DELIN_CHAR)
+    def split_value_by_cell_string(value, num_sections=None):
+        return unpack_sections(value, num_sections)
         
     
     @staticmethod 
@@ -390,12 +715,15 @@ class EncCell(Cell):
         Returns new cell with all locations in cell encrypted
         that are noted in encryptor_dict
         '''
-        cell_dict = cell._asdict()
+        plan = EncryptionPlan.compile(encryptor_dict)
+        cell_dict = dict(zip(CELL_ORDER, cell))
         enc_cell = cell_dict.copy()
-        for (cell_string, encryptor) in encryptor_dict.items():
-            enc_cell[CELL_MUT_MAPPING[cell_string]] = encryptor.encryption.encrypt_cell(cell_dict, 
+        for step in plan.steps:
+            encryptor = step.encryptor
+            enc_cell[step.cell_field] = encryptor.encryption.encrypt_cell(cell_dict, 
                                                      encryptor.key_container, 
                                                      encryptor.cell_sections)
+        enc_cell['cv'] = _accumulo_labels([enc_cell['cv']], plan)[0]
         return Cell(*[enc_cell[field] for field in CELL_ORDER])
   
     @staticmethod 
@@ -409,13 +737,14 @@ class EncCell(Cell):
         Returns new cell with all locations in cell decrypted
         that are noted in encryptor_dict
         '''
-        cell_dict = cell._asdict()
+        cell_dict = dict(zip(CELL_ORDER, cell))
         dec_cell = cell_dict.copy()
-        for (cell_string, encryptor) in encryptor_dict.items():
+        for step in EncryptionPlan.compile(encryptor_dict).steps:
+            encryptor = step.encryptor
             encryptor.encryption.decrypt_cell(cell_dict, 
                                               dec_cell,
                                               encryptor.key_container,
-                                              cell_string,
+                                              step.cell_location,
                                               encryptor.cell_sections)
         return Cell(*[dec_cell[field] for field in CELL_ORDER])
             
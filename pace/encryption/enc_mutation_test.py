@@ -16,13 +16,15 @@ base_dir = os.path.join(this_dir, '../..')
 sys.path.append(base_dir)
 
 import random
+import cPickle
 import logging
 import unittest
 import ConfigParser
 import StringIO as stringio
 from pyaccumulo import Mutation, Cell, Range
 
-from pace.encryption.enc_mutation import EncMutation, EncCell, EncRange
+from pace.encryption.enc_mutation import EncMutation, ColumnarMutation, EncCell, EncRange, EncryptionPlan, \
+     pack_sections, unpack_sections
 from pace.encryption.acc_encrypt import AccumuloEncrypt
 from pace.encryption.encryption_pki import DummyEncryptionPKI
 from pace.encryption.encryption_exceptions import EncryptionException, DecryptionException
@@ -148,6 +150,54 @@ class EncStructureTest(unittest.TestCase):
         for mut in enc_muts:
             row_ids.add(mut.row)
         self.assertTrue(len(row_ids) == 1)
+        
+    def test_columnar_row_same(self):
+        """
+        Tests that with columnar set all of the updates are written
+        into one mutation when deterministic encryption is used, and
+        that it holds the same updates as the default output 
+        """
+        enc_muts = EncMutation(self.c_mut, self.encryptor_dict_det).encrypt()
+        col_muts = EncMutation(self.c_mut, self.encryptor_dict_det).encrypt(columnar=True)
+        self.assertTrue(len(col_muts) == 1)
+        self.assertTrue(isinstance(col_muts[0], ColumnarMutation))
+        self.assertEqual(len(col_muts[0]), 4)
+        self.assertEqual(col_muts[0].row, enc_muts[0].row)
+        self.assertEqual(col_muts[0].updates, 
+                         [mut.updates[0] for mut in enc_muts])
+        
+    def test_columnar_updates(self):
+        '''
+        Tests that the updates of a ColumnarMutation are built once,
+        and again only after the mutation changes
+        '''
+        col_mut = ColumnarMutation('row')
+        self.assertEqual(col_mut.updates, [])
+        col_mut.put(cf='cf1', cq='cq1', cv='a', ts=1, val='val1')
+        updates = col_mut.updates
+        self.assertTrue(col_mut.updates is updates)
+        
+        col_mut.put(cf='cf2', cq='cq2', cv='b', ts=2, val='val2')
+        mut = Mutation('row')
+        mut.put(cf='cf1', cq='cq1', cv='a', ts=1, val='val1')
+        mut.put(cf='cf2', cq='cq2', cv='b', ts=2, val='val2')
+        self.assertEqual(col_mut.updates, mut.updates)
+        self.assertEqual(len(col_mut), 2)
+        
+        col_mut.updates = mut.updates[:1]
+        self.assertEqual(col_mut.updates, mut.updates[:1])
+        self.assertEqual(len(col_mut), 1)
+        
+    def test_encrypt_decrypt_columnar(self):
+        '''
+        Tests encrypt then decrypt functionality of EncMutation when
+        all of the updates are written into one ColumnarMutation
+        '''
+        enc_muts = EncMutation(self.c_mut, self.encryptor_dict_det).encrypt(columnar=True)
+        self.assertTrue(len(enc_muts) == 1)
+        dec_mut = EncMutation(enc_muts[0], self.encryptor_dict_det).decrypt()
+        self.assertEqual(dec_mut.row, self.c_mut.row)
+        self.assertEqual(dec_mut.updates, self.c_mut.updates)
           
     def test_encrypt_decrypt_mutation(self):
         '''
@@ -188,16 +238,116 @@ class EncStructureTest(unittest.TestCase):
         '''
         mut = EncMutation(self.mut,self.encryptor_dict)
         values = EncMutation.concatenate_cell_section_values(mut, ['colFamily','colQualifier'])
-        self.assertEqual(values, ['cf1+cq1'])
+        self.assertEqual(values, [pack_sections(['cf1','cq1'])])
         
         split_values = EncMutation.split_values(values)
         self.assertEqual(split_values, [('cf1',),('cq1',)])
         
+        values = EncMutation.concatenate_cell_section_values(mut, ['colFamily'])
+        self.assertEqual(values, ['cf1'])
+        self.assertEqual(EncMutation.split_values(values, 1), [('cf1',)])
+        
         cell = Cell('row','cf','cq','cv',1234,'val')
         value = EncCell.get_value_by_cell_string(cell._asdict(), ['colFamily', 'colQualifier'])
-        self.assertEqual(value, 'cf+cq')
+        self.assertEqual(value, pack_sections(['cf','cq']))
         
         split_value = EncCell.split_value_by_cell_string(value)
         self.assertEqual(split_value,['cf','cq'])
+        
+    def test_pack_sections(self):
+        '''
+        Tests that packed sections are recovered exactly, including
+        sections containing the delimiter, and that values in the 
+        delimited format are still split 
+        '''
+        for sections in [['a', 'b'], ['a+b', '', '+'], ['', ''],
+                         ['\x00\x02', 'x' * 300, '++', '\xff']]:
+            packed = pack_sections(sections)
+            self.assertEqual(unpack_sections(packed), sections)
+            self.assertEqual(unpack_sections(packed, len(sections)), sections)
+            self.assertEqual(unpack_sections(bytearray(packed)), sections)
+            self.assertEqual(unpack_sections(buffer(packed)), sections)
+        
+        self.assertEqual(pack_sections(['a+b']), 'a+b')
+        self.assertEqual(unpack_sections('a+b', 1), ['a+b'])
+        
+        #values written in the delimited format 
+        self.assertEqual(pack_sections(['cf', 'cq'], True), 'cf+cq')
+        self.assertEqual(pack_sections(['a+b'], True), 'a+b')
+        self.assertEqual(unpack_sections('cf+cq'), ['cf', 'cq'])
+        self.assertEqual(unpack_sections('cf+cq+val', 3), ['cf', 'cq', 'val'])
+        self.assertEqual(EncCell.split_value_by_cell_string('cf+cq', 2), ['cf', 'cq'])
+        self.assertEqual(EncMutation.split_values(['cf1+cq1', 'cf2+cq2'], 2),
+                         [('cf1', 'cf2'), ('cq1', 'cq2')])
+        
+        #a header that does not match the expected number of sections
+        #or the length of the value is not read as the packed format
+        packed = pack_sections(['a', 'b'])
+        self.assertEqual(unpack_sections(packed, 3), [packed])
+        self.assertEqual(unpack_sections(packed + 'c'), [packed + 'c'])
+        
+    def test_encryption_plan(self):
+        '''
+        Tests the steps and blanked sections compiled from an 
+        encryptor dictionary
+        '''
+        plan = EncryptionPlan(self.encryptor_dict)
+        self.assertEqual(plan, self.encryptor_dict)
+        self.assertEqual([step.cell_location for step in plan.steps], 
+                         ['row', 'colFamily'])
+        self.assertEqual([step.cell_field for step in plan.steps], ['row', 'cf'])
+        self.assertEqual(plan.blanked_sections, ('colQualifier',))
+        self.assertEqual(EncryptionPlan(self.encryptor_dict_identity).blanked_sections, ())
+        self.assertTrue(EncryptionPlan.compile(plan) is plan)
+        
+        self.assertRaises(TypeError, plan.__setitem__, 'value', None)
+        self.assertRaises(TypeError, plan.pop, 'row')
+        
+        #key objects holding RSA keys need not pickle, so plans are
+        #copied without them, as with BatchKeyResolver in acc_encrypt.py
+        unkeyed = plan.with_key_object(None)
+        copied = cPickle.loads(cPickle.dumps(unkeyed, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual([step.cell_location for step in copied.steps], 
+                         ['row', 'colFamily'])
+        self.assertEqual(copied.blanked_sections, plan.blanked_sections)
+        self.assertEqual(copied, unkeyed)
+        
+    def test_encrypted_visibility(self):
+        '''
+        Tests that threshold terms are expanded in plaintext visibility
+        labels only, and not in encrypted ones, which need not parse
+        '''
+        mut = Mutation('row')
+        mut.put(cf='cf', cq='cq', cv='2{a,b,c}', ts='1', val='val')
+        enc_mut = EncMutation(mut, self.encryptor_dict_identity).encrypt()
+        self.assertEqual(enc_mut[0].updates[0].colVisibility, '(a&b)|(a&c)|(b&c)')
+        
+        config = stringio.StringIO('[colVisibility]\n'+\
+                                   'key_id = Identity\n'+\
+                                   'encryption = Identity')
+        encryptor_dict = self._create_encryptor_dict(config)
+        for cv in ('2{a,b,c}', '{x'):
+            mut = Mutation('row')
+            mut.put(cf='cf', cq='cq', cv=cv, ts='1', val='val')
+            enc_mut = EncMutation(mut, encryptor_dict).encrypt()
+            self.assertEqual(enc_mut[0].updates[0].colVisibility, cv)
+            enc_cell = EncCell.encrypt(Cell('row', 'cf', 'cq', cv, '1', 'val'),
+                                       encryptor_dict)
+            self.assertEqual(enc_cell.cv, cv)
+        
+    def test_delimiter_in_values(self):
+        '''
+        Tests that cell sections containing the delimiter are
+        encrypted and decrypted correctly
+        '''
+        mut = Mutation('row+1')
+        mut.put(cf='cf+1', cq='cq+1', cv='a&b', ts='12', val='val+1')
+        enc_mut = EncMutation(mut, self.encryptor_dict).encrypt()
+        self.assertTrue(len(enc_mut) == 1)
+        dec_mut = EncMutation(enc_mut[0], self.encryptor_dict).decrypt()
+        self.assertEqual(dec_mut.row, mut.row)
+        self.assertEqual(dec_mut.updates[0].colFamily, 'cf+1')
+        self.assertEqual(dec_mut.updates[0].colQualifier, 'cq+1')
+        self.assertEqual(dec_mut.updates[0].value, 'val+1')
        
     
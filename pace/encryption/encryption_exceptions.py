@@ -31,4 +31,13 @@ class DecryptionException(Exception):
         self.msg = msg
 
     def __str__(self):
-        return self.msg
\ No newline at end of file
+        return self.msg
+
+class UnsatisfiableLabelException(DecryptionException):
+    """ Exception raised when unable to decrypt a cell because the
+        user's attributes do not satisfy its visibility label.
+        
+        Attributes:
+            msg - error message for situation
+    """
+    pass
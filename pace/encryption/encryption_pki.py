@@ -15,50 +15,215 @@ this_dir = os.path.dirname(os.path.dirname(__file__))
 base_dir = os.path.join(this_dir, '../..')
 sys.path.append(base_dir)
 
+import time
 from Crypto.PublicKey import RSA
 from base64 import b64encode
-from beaker.cache import CacheManager
-from beaker.util import parse_cache_config_options
 
 from pace.pki.keystore import KeyInfo
 from pace.pki.abstractpki import PKILookupError
 from pace.pki.accumulo_keystore import AccumuloKeyStore
 from pace.common.fakeconn import FakeConnection 
+from pace.common.lru_cache import LRUCache
 
 import pace.pki.key_wrap_utils as key_utils
 from pace.encryption.enc_classes import AES_ALGORITHMS, VIS_ALGORITHMS
 
-#creating cache where all the contents are stored within local memory 
-cache_opts = {
-     'cache.type': 'memory',
-    }
-cache = CacheManager(**parse_cache_config_options(cache_opts))
+class KeyCache(object):
+    """
+    Cache of the results of key lookups for a single key object. Holds
+    at most max_size results, evicting the least recently used, and 
+    each result expires ttl seconds after it was looked up. Lookups 
+    that raise PKILookupError are remembered too, for negative_ttl
+    seconds, so that keys a user does not have are not looked up 
+    over and over again.
+    
+    Results are cached under tuples whose first element is the name
+    of the lookup method and whose second is the algorithm, followed 
+    by the rest of the arguments of the lookup.
+    
+    A single cache may be shared between threads. 
+    """
+    
+    def __init__(self, max_size=1024, ttl=3600, negative_ttl=60, clock=time.time):
+        """
+        Arguments:
+        max_size - (optional) maximum number of results held, defaults
+            to 1024
+        ttl - (optional) number of seconds keys are cached for, defaults
+            to 3600
+        negative_ttl - (optional) number of seconds failed lookups are
+            cached for, defaults to 60. If 0, they are not cached. 
+        clock - (optional) function returning the current time in 
+            seconds, defaults to time.time
+        """
+        if ttl <= 0 or negative_ttl < 0:
+            raise ValueError('ttl must be positive and negative_ttl not negative')
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self._entries = LRUCache(max_size)
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.negative_hits = 0
+        
+    def lookup(self, key, create):
+        """
+        Arguments:
+        key - tuple identifying the lookup, see above
+        create - function performing the lookup when its result is
+            not cached
+            
+        Returns: the cached result for key, or the result of create(), 
+        which is cached. Raises the cached PKILookupError if the lookup
+        failed recently, or the one create() raises, which is cached. 
+        Other exceptions raised by create() are passed on and nothing
+        is cached.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            (expires, value, error) = entry
+            if self.clock() < expires:
+                self.hits += 1
+                if error is not None:
+                    self.negative_hits += 1
+                    raise error
+                return value
+            self._entries.pop(key)
+            self.expirations += 1
+        self.misses += 1
+        
+        #the lookup is done outside of the cache's lock, so that 
+        #lookups of different keys do not wait for each other
+        try:
+            value = create()
+        except PKILookupError as error:
+            self.put_error(key, error)
+            raise
+        self.put(key, value)
+        return value
+    
+    def cached(self, key):
+        """
+        Returns: whether a result or failed lookup that has not expired
+        is cached for key, without counting a hit or miss
+        """
+        entry = self._entries.peek(key)
+        return entry is not None and self.clock() < entry[0]
+    
+    def results(self):
+        """
+        Returns: dictionary mapping the keys of the cached lookups that
+        succeeded and have not expired to their results, without 
+        counting hits or misses
+        """
+        now = self.clock()
+        results = {}
+        for key in self._entries.keys():
+            entry = self._entries.peek(key)
+            if entry is not None and entry[2] is None and now < entry[0]:
+                results[key] = entry[1]
+        return results
+    
+    def put(self, key, value):
+        """
+        Caches value as the result of the lookup key for ttl seconds
+        """
+        self._entries.put(key, (self.clock() + self.ttl, value, None))
+        
+    def put_error(self, key, error):
+        """
+        Caches the PKILookupError error as the result of the lookup key
+        for negative_ttl seconds
+        """
+        if self.negative_ttl:
+            self._entries.put(key, (self.clock() + self.negative_ttl, None, error))
+    
+    def invalidate(self, algorithm=None, attribute=None):
+        """
+        Arguments:
+        algorithm - (optional) algorithm whose results are removed,
+            defaults to all algorithms
+        attribute - (optional) attribute whose results are removed, 
+            defaults to all attributes
+            
+        Effect: removes the matching results from the cache, so that
+        they are looked up again
+        """
+        for key in self._entries.keys():
+            if algorithm is not None and key[1] != algorithm:
+                continue
+            if attribute is not None and \
+               (len(key) < 3 or key[0] not in _ATTRIBUTE_LOOKUPS or key[2] != attribute):
+                continue
+            self._entries.pop(key)
+            
+    def clear(self):
+        """
+        Removes all of the results from the cache
+        """
+        self._entries.clear()
+        
+    def stats(self):
+        """
+        Returns: dictionary with the number of hits (including hits of
+        failed lookups), misses, evictions and expirations so far, the
+        number of hits of failed lookups, and the current and maximum
+        size
+        """
+        stats = self._entries.stats()
+        stats['hits'] = self.hits
+        stats['misses'] = self.misses
+        stats['expirations'] = self.expirations
+        stats['negative_hits'] = self.negative_hits
+        return stats
 
-### NB: For functions decorated with:  
-###
-###    @cache.cache('key',expire=3600)   
-###
-### 
-### Objects are cached for a paritcular set of arguments 
-### when a function call is made - in this particular example
-### it will be for an hour. Thus when a call is made again, 
-### with the same set of arguments, the cached value is 
-### returned in lieu of another execution of the method.
-###
-### NB: There exists one copy of the cache for each class. This means
-### that two instances of the cache, that may have different
-### instance variables, will use the same copy of the cache. In 
-### this particular case, two copies of the PKI object that refer
-### to different users on the same system or users who have more
-### than one key store to connect to cannot be supported without
-### further modification. For flexibility, we include both a plain key
-### store and a cached subclass of it.
+#number of cipher objects kept by EncryptionPKIBase.cipher_contexts
+CIPHER_CONTEXTS_SIZE = 64
+
+#lookup methods whose third argument is an attribute 
+_ATTRIBUTE_LOOKUPS = set(['get_attribute_key', 'get_current_attribute_key',
+                          'has_attribute'])
 
 class EncryptionPKIBase(object):
 
+    #incremented by keys_changed(); anything derived from keys looked
+    #up under an earlier epoch (see secret_vis_tree.py) is discarded
+    key_epoch = 0
+
     def __init__(self, *args):
         pass
     
+    def keys_changed(self, algorithm=None, attribute=None):
+        """
+        Arguments:
+        algorithm - (optional) algorithm whose keys changed, defaults
+            to all algorithms
+        attribute - (optional) attribute whose keys changed, defaults
+            to all attributes
+        
+        Records that keys available to the user may have changed, 
+        for example because a key was revoked or a new version of 
+        a key was added. Empties cipher_contexts().
+        """
+        self.key_epoch += 1
+        contexts = self.__dict__.get('_cipher_contexts')
+        if contexts is not None:
+            contexts.clear()
+    
+    def cipher_contexts(self):
+        """
+        Returns: the LRUCache in which the encryption algorithms (see
+        aes_context in AES_encrypt.py) keep cipher objects for this
+        object's keys, so that the keys need not be expanded for each
+        value. It is emptied by keys_changed, so cipher objects for 
+        revoked keys are not kept.
+        """
+        contexts = self.__dict__.get('_cipher_contexts')
+        if contexts is None:
+            contexts = self._cipher_contexts = LRUCache(CIPHER_CONTEXTS_SIZE)
+        return contexts
+    
     def get_key(self, algorithm):
         """
         Arguments:
@@ -134,6 +299,47 @@ class EncryptionPKIBase(object):
         """
         pass
     
+    def get_attribute_keys(self, algorithm, attribute_versions):
+        """
+        Arguments:
+        algorithm - (string) Name of algorithm for which the user
+                    wishes to retrieve the keys
+        attribute_versions - iterable of (attribute, version) pairs, with
+                    integer versions, of the keys to retrieve
+        
+        Returns:
+            Dictionary mapping each (attribute, version) pair for which
+            the user has a key to the key. Pairs for which the user has
+            no key are left out. Subclasses whose keystore can retrieve 
+            several keys at once should override this, by default each
+            key is retrieved with get_attribute_key.
+        """
+        keys = {}
+        for (attribute, version) in set(attribute_versions):
+            try:
+                keys[(attribute, version)] = self.get_attribute_key(algorithm,
+                                                                    attribute,
+                                                                    version)
+            except PKILookupError:
+                pass
+        return keys
+    
+    def has_attribute(self, algorithm, attribute):
+        """
+        Arguments:
+        algorithm - (string) Name of algorithm of the keys
+        attribute - (string) Attribute to check for
+        
+        Returns:
+            False if the user holds no version of the key for 
+            (algorithm, attribute), so that visibility labels the user's
+            other attributes do not satisfy can be rejected whatever
+            the versions of the keys of their cells (see 
+            secret_vis_tree.py). Subclasses that can tell should override
+            this, by default it returns True.
+        """
+        return True
+    
     
 class EncryptionPKIAccumulo(EncryptionPKIBase):
     
@@ -149,7 +355,7 @@ class EncryptionPKIAccumulo(EncryptionPKIBase):
     
     """
     
-    def __init__(self, conn, user_id, rsa_key):
+    def __init__(self, conn, user_id, rsa_key, latest_table=None):
         """
         Arguments:
         conn - (Accumulo connection) Connection to the Accumulo
@@ -162,11 +368,27 @@ class EncryptionPKIAccumulo(EncryptionPKIBase):
                 identify the particular user
         rsa_key - (Crypto.PublicKey.RSA) Key object to wrap/unwrap keys
                 with. TODO: create a loader from a file for RSA keys
+        latest_table - (optional string) Table of the keystore holding
+                users' latest keys, if it keeps one, so that current 
+                keys are retrieved with a single scan (see
+                AccumuloKeyStore.retrieve_latest_version)
                 
+        Keys of the user inserted into or revoked from the keystore 
+        through _acc_keystore call keys_changed(). Changes made through
+        other keystore objects are not seen, and keys_changed() must 
+        be called for them.
         """
-        self._acc_keystore = AccumuloKeyStore(conn)
+        self._acc_keystore = AccumuloKeyStore(conn, latest_table=latest_table)
         self._user_id = user_id
         self._rsa_key = rsa_key
+        self._acc_keystore.add_listener(self._keystore_changed)
+    
+    def _keystore_changed(self, userid, metadata, attr):
+        """
+        Listener for _acc_keystore (see AbstractKeyStore.add_listener)
+        """
+        if userid == self._user_id:
+            self.keys_changed(metadata, attr or None)
     
     def get_current_key(self, algorithm):
         """
@@ -287,31 +509,240 @@ class EncryptionPKIAccumulo(EncryptionPKIBase):
         #unwrap the key
         return key_utils.unwrap_key(key_wrap, self._rsa_key)
 
+    def get_attribute_keys(self, algorithm, attribute_versions):
+        """
+        Arguments:
+        algorithm - (string) Name of algorithm for which the user
+                    wishes to retrieve the keys
+        attribute_versions - iterable of (attribute, version) pairs, with
+                    integer versions, of the keys to retrieve
+        
+        Returns:
+            Dictionary mapping each (attribute, version) pair for which
+            the user has a key to the key. The key wraps for all of the
+            pairs are read from the keystore with a single scan, and only
+            the requested keys are unwrapped, together with a single
+            cipher in the calling process. No worker processes are used,
+            as this is called while decrypting, possibly from several 
+            threads at once, where forking could deadlock (see warm).
+            Pairs for which the user has no key are left out, so looking 
+            them up with get_attribute_key raises PKILookupError as usual. 
+        """
+        wanted = set(attribute_versions)
+        if not wanted:
+            return {}
+        try:
+            key_wraps = self._acc_keystore.batch_retrieve(self._user_id, algorithm)
+        except PKILookupError:
+            return {}
+        infos = [info for info in key_wraps if (info.attr, info.vers) in wanted]
+        keys = key_utils.unwrap_keys([info.keywrap for info in infos],
+                                     self._rsa_key, workers=1)
+        return dict(((info.attr, info.vers), key)
+                    for (info, key) in zip(infos, keys))
+    
+    def warm(self, algorithms, attributes=None, workers=None):
+        """
+        Arguments:
+        algorithms - names of the algorithms (keystore metadata) whose
+                    keys to retrieve
+        attributes - (optional) attributes whose keys to retrieve, the 
+                    empty string standing for non-attribute keys. Defaults
+                    to all of the user's keys for the algorithms.
+        workers - (optional) number of processes the keys are 
+                    unwrapped in, defaults to the number of CPUs (see
+                    key_wrap_utils.unwrap_keys). warm is the only lookup
+                    that unwraps keys in other processes; it should be
+                    called before any threads are started, e.g. when a 
+                    service starts up, since forking a process while 
+                    other threads hold locks can deadlock it.
+                    
+        Returns:
+            Dictionary mapping lookups to their results, keyed as in
+            KeyCache: ('get_key', algorithm, version) and 
+            ('get_attribute_key', algorithm, attribute, version) to keys,
+            ('get_current_key', algorithm) and ('get_current_attribute_key',
+            algorithm, attribute) to (key, version) tuples where the user 
+            has the latest version, and ('has_attribute', algorithm,
+            attribute) to True. The user's keys for each algorithm are
+            read with a single scan, their latest versions with a single
+            batch scan, and all of the key wraps are unwrapped together. 
+            The results are passed to _warmed, so that caching subclasses
+            hold them before the first request is served. Algorithms for which the user has no keys are
+            skipped.
+        """
+        wanted = None if attributes is None else set(attributes)
+        infos = []
+        for algorithm in set(algorithms):
+            try:
+                key_wraps = self._acc_keystore.batch_retrieve(self._user_id, algorithm)
+            except PKILookupError:
+                continue
+            infos.extend(info for info in key_wraps 
+                         if wanted is None or info.attr in wanted)
+        
+        keys = key_utils.unwrap_keys([info.keywrap for info in infos],
+                                     self._rsa_key, workers)
+        
+        results = {}
+        versions = {}
+        for (info, key) in zip(infos, keys):
+            if info.attr:
+                results[('get_attribute_key', info.metadata, info.attr, info.vers)] = key
+                results[('has_attribute', info.metadata, info.attr)] = True
+            else:
+                results[('get_key', info.metadata, info.vers)] = key
+            versions.setdefault((info.metadata, info.attr), {})[info.vers] = key
+        
+        #the current keys are the ones whose version is the latest 
+        #version of the attribute, if the user has it
+        attrs = {}
+        for (metadata, attr) in versions:
+            attrs.setdefault(metadata, set()).add(attr)
+        latest = {}
+        for (metadata, metadata_attrs) in attrs.items():
+            try:
+                latest[metadata] = self._acc_keystore.retrieve_latest_version_numbers(
+                    metadata, metadata_attrs)
+            except PKILookupError:
+                latest[metadata] = {}
+        for ((metadata, attr), keys) in versions.items():
+            version = latest[metadata].get(attr)
+            if version not in keys:
+                continue
+            if attr:
+                results[('get_current_attribute_key', metadata, attr)] = (keys[version], version)
+            else:
+                results[('get_current_key', metadata)] = (keys[version], version)
+        
+        self._warmed(results)
+        return results
+    
+    def _warmed(self, results):
+        """
+        Called by warm with the dictionary of lookup results it 
+        returns. Does nothing, caching subclasses cache the results.
+        """
+        pass
+    
+    def has_attribute(self, algorithm, attribute):
+        """
+        Arguments:
+        algorithm - (string) Name of algorithm of the keys
+        attribute - (string) Attribute to check for
+        
+        Returns:
+            Whether the user holds any version of the key for 
+            (algorithm, attribute), read from the keystore's metadata
+            table without retrieving any key wraps
+        """
+        return algorithm in self._acc_keystore.get_metadatas(self._user_id,
+                                                             attribute)
+
 
 class CachingEncryptionPKIMixin(object):
     """
-    Mixin class that implements caching the results for an hour 
+    Mixin class that caches the keys looked up by each instance in its 
+    own KeyCache, key_cache, so instances for different users or key
+    stores never see each other's keys. The options of the cache are 
+    given as keyword arguments to the constructor:
+        cache_size - maximum number of results held, defaults to 1024
+        cache_ttl - number of seconds keys are cached for, defaults 
+            to 3600
+        negative_ttl - number of seconds failed lookups are cached for,
+            defaults to 60
+    All other arguments are passed on to the next constructor. Cached
+    results are removed when keys_changed() is called. 
     """
-
-    @cache.cache('key',expire=3600)  
+    
+    def __init__(self, *args, **kwargs):
+        self.key_cache = KeyCache(max_size=kwargs.pop('cache_size', 1024),
+                                  ttl=kwargs.pop('cache_ttl', 3600),
+                                  negative_ttl=kwargs.pop('negative_ttl', 60))
+        super(CachingEncryptionPKIMixin, self).__init__(*args, **kwargs)
+        
+    def keys_changed(self, algorithm=None, attribute=None):
+        """
+        Arguments:
+        algorithm - (optional) algorithm whose keys changed, defaults
+            to all algorithms
+        attribute - (optional) attribute whose keys changed, defaults
+            to all attributes
+        
+        Removes the matching results from key_cache (see 
+        KeyCache.invalidate) and records that keys changed, as
+        EncryptionPKIBase.keys_changed does
+        """
+        self.key_cache.invalidate(algorithm, attribute)
+        super(CachingEncryptionPKIMixin, self).keys_changed()
+    
     def get_current_key(self, algorithm):
-        return super(CachingEncryptionPKIMixin, self).get_current_key(algorithm)
+        return self.key_cache.lookup(('get_current_key', algorithm),
+            lambda: super(CachingEncryptionPKIMixin, self).get_current_key(algorithm))
      
-    @cache.cache('key',expire=3600)  
     def get_current_attribute_key(self, algorithm, attribute):
-        return super(CachingEncryptionPKIMixin, self).get_current_attribute_key(algorithm, attribute)
+        return self.key_cache.lookup(('get_current_attribute_key', algorithm, attribute),
+            lambda: super(CachingEncryptionPKIMixin, self).get_current_attribute_key(algorithm, 
+                                                                                    attribute))
 
-    @cache.cache('key',expire=3600)  
     def get_key(self, algorithm, version=1):
-        return super(CachingEncryptionPKIMixin, self).get_key(algorithm, version)
+        return self.key_cache.lookup(('get_key', algorithm, version),
+            lambda: super(CachingEncryptionPKIMixin, self).get_key(algorithm, version))
 
-    @cache.cache('key',expire=3600)  
     def get_attribute_key(self, algorithm, attribute, version=1): 
-        return super(CachingEncryptionPKIMixin, self).get_attribute_key(algorithm, attribute, version)
+        return self.key_cache.lookup(('get_attribute_key', algorithm, attribute, version),
+            lambda: super(CachingEncryptionPKIMixin, self).get_attribute_key(algorithm, 
+                                                                            attribute,
+                                                                            version))
+    
+    def has_attribute(self, algorithm, attribute):
+        return self.key_cache.lookup(('has_attribute', algorithm, attribute),
+            lambda: super(CachingEncryptionPKIMixin, self).has_attribute(algorithm, attribute))
+    
+    def _warmed(self, results):
+        """
+        Caches the results of warm
+        """
+        for (lookup, result) in results.items():
+            self.key_cache.put(lookup, result)
+    
+    def get_attribute_keys(self, algorithm, attribute_versions):
+        """
+        Returns the keys as get_attribute_keys does, retrieving only
+        the ones whose lookups are not cached, and caches the keys 
+        retrieved and the failed lookups of the ones the user does
+        not have
+        """
+        wanted = set(attribute_versions)
+        missing = [(attribute, version) for (attribute, version) in wanted
+                   if not self.key_cache.cached(('get_attribute_key', algorithm,
+                                                 attribute, version))]
+        if missing:
+            retrieved = super(CachingEncryptionPKIMixin, self).get_attribute_keys(algorithm,
+                                                                                 missing)
+            for (attribute, version) in missing:
+                cache_key = ('get_attribute_key', algorithm, attribute, version)
+                if (attribute, version) in retrieved:
+                    self.key_cache.put(cache_key, retrieved[(attribute, version)])
+                else:
+                    self.key_cache.put_error(cache_key, PKILookupError(
+                        "User %s with algorithm %s and attribute %s is not present in keystore."
+                        %(getattr(self, '_user_id', ''), algorithm, attribute)))
+        
+        keys = {}
+        for (attribute, version) in wanted:
+            try:
+                keys[(attribute, version)] = self.get_attribute_key(algorithm,
+                                                                    attribute,
+                                                                    version)
+            except PKILookupError:
+                pass
+        return keys
     
 class CachingEncryptionPKIAccumulo(CachingEncryptionPKIMixin, EncryptionPKIAccumulo):
     """
-    Same as EncryptionPKIAccumulo, but caches results for an hour
+    Same as EncryptionPKIAccumulo, but caches results in a KeyCache,
+    for an hour by default (see CachingEncryptionPKIMixin)
     """
     pass
 
@@ -469,6 +900,7 @@ class DummyEncryptionPKI(EncryptionPKIAccumulo):
         
 class DummyCachingEncryptionPKI(CachingEncryptionPKIMixin, DummyEncryptionPKI):
     """
-    Same as DummyEncryptionPKI, but caches results for an hour
+    Same as DummyEncryptionPKI, but caches results in a KeyCache,
+    for an hour by default (see CachingEncryptionPKIMixin)
     """
     pass
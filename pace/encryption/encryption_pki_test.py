@@ -0,0 +1,224 @@
+## **************
+##  Copyright 2026 MIT Lincoln Laboratory
+##  Project: PACE
+##  Authors: ATLH
+##  Description: Unit tests for encryption_pki
+##  Modifications:
+##  Date         Name  Modification
+##  ----         ----  ------------
+##  17 Oct 2026  ATLH    Original file
+## **************
+
+import os
+import sys
+this_dir = os.path.dirname(os.path.dirname(__file__))
+base_dir = os.path.join(this_dir, '../..')
+sys.path.append(base_dir)
+
+import unittest
+import pace.pki.key_wrap_utils as key_utils
+from pace.pki.abstractpki import PKILookupError
+from pace.encryption.encryption_pki import KeyCache, EncryptionPKIBase, \
+    CachingEncryptionPKIMixin, DummyEncryptionPKI, DummyCachingEncryptionPKI
+from pace.encryption.acc_encrypt import Keytor
+from pace.encryption.AES_encrypt import Pycrypto_AES_CTR
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class CountingPKI(EncryptionPKIBase):
+    '''
+    Key object with one key for each attribute of a user, which
+    counts the lookups made of it
+    '''
+    def __init__(self, user, attributes):
+        self.user = user
+        self.attributes = attributes
+        self.lookups = []
+
+    def get_attribute_key(self, algorithm, attribute, version=1):
+        self.lookups.append((attribute, version))
+        if attribute not in self.attributes:
+            raise PKILookupError('No key for %s' % attribute)
+        return '%s:%s:%s:%d' % (self.user, algorithm, attribute, version)
+
+class CachingCountingPKI(CachingEncryptionPKIMixin, CountingPKI):
+    pass
+
+class KeyCacheTest(unittest.TestCase):
+
+    def test_ttl(self):
+        '''
+        Tests that keys and failed lookups expire
+        '''
+        clock = FakeClock()
+        cache = KeyCache(ttl=10, negative_ttl=2, clock=clock)
+        lookups = []
+        def create():
+            lookups.append(1)
+            return 'key'
+        def fail():
+            lookups.append(1)
+            raise PKILookupError('missing')
+
+        self.assertEqual(cache.lookup(('get_key', 'alg', 1), create), 'key')
+        self.assertRaises(PKILookupError, cache.lookup, ('get_key', 'alg', 2), fail)
+        clock.now += 5
+        self.assertEqual(cache.lookup(('get_key', 'alg', 1), create), 'key')
+        self.assertFalse(cache.cached(('get_key', 'alg', 2)))
+        self.assertRaises(PKILookupError, cache.lookup, ('get_key', 'alg', 2), fail)
+        self.assertRaises(PKILookupError, cache.lookup, ('get_key', 'alg', 2), fail)
+        clock.now += 6
+        self.assertEqual(cache.lookup(('get_key', 'alg', 1), create), 'key')
+        self.assertEqual(len(lookups), 4)
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['expirations'],
+                          stats['negative_hits']), (2, 4, 2, 1))
+
+        self.assertRaises(ValueError, KeyCache, ttl=0)
+
+    def test_eviction_and_invalidation(self):
+        '''
+        Tests the size bound and removing results
+        '''
+        cache = KeyCache(max_size=3)
+        for attribute in ['a', 'b', 'c', 'd']:
+            cache.lookup(('get_attribute_key', 'alg', attribute, 1), lambda: attribute)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertFalse(cache.cached(('get_attribute_key', 'alg', 'a', 1)))
+
+        cache.lookup(('get_key', 'other', 1), lambda: 'key')
+        cache.invalidate(attribute='c')
+        self.assertFalse(cache.cached(('get_attribute_key', 'alg', 'c', 1)))
+        self.assertTrue(cache.cached(('get_attribute_key', 'alg', 'd', 1)))
+        cache.invalidate(algorithm='other')
+        self.assertFalse(cache.cached(('get_key', 'other', 1)))
+        self.assertTrue(cache.cached(('get_attribute_key', 'alg', 'd', 1)))
+        cache.clear()
+        self.assertEqual(cache.stats()['size'], 0)
+
+class CachingEncryptionPKITest(unittest.TestCase):
+
+    def test_instances_do_not_share(self):
+        '''
+        Tests that instances for different users each cache their
+        own keys
+        '''
+        alice = CachingCountingPKI('alice', ['a'], cache_size=16)
+        bob = CachingCountingPKI('bob', ['a', 'b'])
+        self.assertEqual(alice.get_attribute_key('alg', 'a', 1), 'alice:alg:a:1')
+        self.assertEqual(bob.get_attribute_key('alg', 'a', 1), 'bob:alg:a:1')
+        self.assertEqual(alice.get_attribute_key('alg', 'a', 1), 'alice:alg:a:1')
+        self.assertEqual(alice.key_cache.stats()['max_size'], 16)
+        self.assertEqual(len(alice.lookups), 1)
+        self.assertEqual(len(bob.lookups), 1)
+
+        self.assertRaises(PKILookupError, alice.get_attribute_key, 'alg', 'b', 1)
+        self.assertRaises(PKILookupError, alice.get_attribute_key, 'alg', 'b', 1)
+        self.assertEqual(len(alice.lookups), 2)
+
+    def test_get_attribute_keys(self):
+        '''
+        Tests that keys retrieved together are cached, and only keys
+        that are not cached are retrieved
+        '''
+        pki = CachingCountingPKI('alice', ['a', 'b'])
+        pki.get_attribute_key('alg', 'a', 1)
+        self.assertEqual(pki.get_attribute_keys('alg', [('a', 1), ('b', 2), ('c', 1)]),
+                         {('a', 1) : 'alice:alg:a:1', ('b', 2) : 'alice:alg:b:2'})
+        self.assertEqual(sorted(pki.lookups), [('a', 1), ('b', 2), ('c', 1)])
+        pki.get_attribute_keys('alg', [('b', 2), ('c', 1)])
+        self.assertEqual(len(pki.lookups), 3)
+
+    def test_keys_changed(self):
+        '''
+        Tests that keys_changed removes cached keys and bumps the
+        key epoch
+        '''
+        pki = CachingCountingPKI('alice', ['a', 'b'])
+        pki.get_attribute_key('alg', 'a', 1)
+        pki.get_attribute_key('alg', 'b', 1)
+        epoch = pki.key_epoch
+        pki.keys_changed('alg', 'a')
+        self.assertEqual(pki.key_epoch, epoch + 1)
+        pki.get_attribute_key('alg', 'a', 1)
+        pki.get_attribute_key('alg', 'b', 1)
+        self.assertEqual(pki.lookups, [('a', 1), ('b', 1), ('a', 1)])
+        pki.keys_changed()
+        pki.get_attribute_key('alg', 'b', 1)
+        self.assertEqual(len(pki.lookups), 4)
+
+    def test_cipher_contexts(self):
+        '''
+        Tests that encrypting short values through a key object keeps
+        one cipher object per key, which keys_changed discards
+        '''
+        pki = DummyEncryptionPKI()
+        keytor = Keytor('Pycrypto_AES_CTR', pki, 16)
+        for _ in range(3):
+            Pycrypto_AES_CTR.encrypt_cell({'val' : 'short'}, keytor, ['value'])
+        contexts = pki.cipher_contexts()
+        self.assertEqual((len(contexts), contexts.misses, contexts.hits), (1, 1, 2))
+        self.assertTrue(DummyEncryptionPKI().cipher_contexts() is not contexts)
+        pki.keys_changed()
+        self.assertEqual(len(pki.cipher_contexts()), 0)
+
+    def test_warm(self):
+        '''
+        Tests that warm retrieves the same keys as the individual 
+        lookups, and that a caching PKI object serves them afterwards
+        without going to the keystore
+        '''
+        pki = DummyEncryptionPKI(terms=['a', 'b'])
+        results = pki.warm(['VIS_AES_CBC', 'Pycrypto_AES_CBC', 'no_such_algorithm'])
+        self.assertEqual(results[('get_attribute_key', 'VIS_AES_CBC', 'a', 2)],
+                         pki.get_attribute_key('VIS_AES_CBC', 'a', 2))
+        self.assertEqual(results[('get_current_attribute_key', 'VIS_AES_CBC', 'b')],
+                         pki.get_current_attribute_key('VIS_AES_CBC', 'b'))
+        self.assertEqual(results[('get_current_key', 'Pycrypto_AES_CBC')],
+                         pki.get_current_key('Pycrypto_AES_CBC'))
+        self.assertTrue(results[('has_attribute', 'VIS_AES_CBC', 'a')])
+        self.assertFalse(('has_attribute', 'VIS_AES_CBC', 'c') in results)
+        
+        only_a = pki.warm(['VIS_AES_CBC'], attributes=['a'], workers=1)
+        self.assertEqual(set(lookup[2] for lookup in only_a), set(['a']))
+        self.assertEqual(only_a, dict((lookup, result) for (lookup, result) in results.items()
+                                      if lookup[1:3] == ('VIS_AES_CBC', 'a')))
+        
+        caching = DummyCachingEncryptionPKI(terms=['a', 'b'])
+        caching.warm(['VIS_AES_CBC'])
+        keystore = caching._acc_keystore
+        caching._acc_keystore = None
+        try:
+            caching.get_attribute_key('VIS_AES_CBC', 'a', 2)
+            caching.get_current_attribute_key('VIS_AES_CBC', 'b')
+            self.assertTrue(caching.has_attribute('VIS_AES_CBC', 'a'))
+        finally:
+            caching._acc_keystore = keystore
+        self.assertEqual(caching.key_cache.stats()['misses'], 0)
+
+    def test_get_attribute_keys_in_process(self):
+        '''
+        Tests that keys retrieved together while decrypting are unwrapped
+        in the calling process, and only warm uses worker processes
+        '''
+        pki = DummyEncryptionPKI(terms=['a', 'b'])
+        workers = []
+        unwrap_keys = key_utils.unwrap_keys
+        def recording_unwrap_keys(keywraps, RSA_sk, workers=None, calls=workers):
+            calls.append(workers)
+            return unwrap_keys(keywraps, RSA_sk, workers=1)
+        key_utils.unwrap_keys = recording_unwrap_keys
+        try:
+            self.assertEqual(pki.get_attribute_keys('VIS_AES_CBC', [('a', 2), ('b', 1)]),
+                             {('a', 2) : pki.get_attribute_key('VIS_AES_CBC', 'a', 2),
+                              ('b', 1) : pki.get_attribute_key('VIS_AES_CBC', 'b', 1)})
+            pki.warm(['VIS_AES_CBC'], workers=4)
+        finally:
+            key_utils.unwrap_keys = unwrap_keys
+        self.assertEqual(workers, [1, 4])
@@ -25,6 +25,30 @@ CELL_MUT_MAPPING = {'row' : 'row',
                     'value' : 'val'}
 DELIN_CHAR = '+'
 
+#first byte of values holding several cell sections in the length
+#prefixed format, values without it are split on DELIN_CHAR
+SECTIONS_MARKER = 0
+
+#identifies the binary envelope format of ciphertexts, must not be
+#an ASCII digit so that it can be told apart from the legacy 'ver' suffix
+ENVELOPE_FORMAT_ID = 1
+
+#algorithm identifiers recorded in the binary envelope of ciphertexts,
+#values must never be reused or changed
+ALGORITHM_IDS = {"Identity"     : 0,
+              "Pycrypto_AES_CFB" : 1,
+              "Pycrypto_AES_CBC" : 2,
+              "Pycrypto_AES_OFB" : 3,
+              "Pycrypto_AES_CTR" : 4,
+              "Pycrypto_AES_GCM" : 5,
+              "Pycrypto_AES_SIV" : 6,
+              "VIS_Identity"     : 16,
+              "VIS_AES_CFB" : 17,
+              "VIS_AES_CBC" : 18,
+              "VIS_AES_OFB" : 19,
+              "VIS_AES_CTR" : 20,
+              "VIS_AES_GCM" : 21}
+
 KEY_LENGTHS = {"Identity"     : 0,
               "Pycrypto_AES_CFB" : 128,
               "Pycrypto_AES_CBC" : 128,
@@ -18,9 +18,20 @@ sys.path.append(base_dir)
 from Crypto import Random 
 import StringIO
 import base64
+import struct
+import threading
+import time
+import weakref
+import zlib
+from collections import namedtuple
 
 from pace.pki.abstractpki import PKILookupError
-from pace.encryption.visibility.vis_parser import VisParser, VisNode, VisTree, NodeType
+from pace.common.lru_cache import LRUCache
+from pace.encryption.encryption_exceptions import DecryptionException
+from pace.encryption.visibility.vis_parser import VisParser, VisNode, VisTree, NodeType, \
+    VisibilityFormatException, PARSE_CACHE, parse_cached
+from pace.encryption.visibility.share_combine import xor_shares, xor_share_lists
+from pace.encryption.visibility import shamir
  
 
 def byte_xor(bytestring1, bytestring2):
@@ -28,9 +39,8 @@ def byte_xor(bytestring1, bytestring2):
         Calculates the xor of two equal length byte strings
         returns a byte string (not a byte array)
         '''
-        byte_array1 = bytearray(bytestring1)
-        byte_array2 = bytearray(bytestring2)
-        return bytes(bytearray(b1 ^ b2 for (b1, b2) in zip(byte_array1, byte_array2)))
+        length = min(len(bytestring1), len(bytestring2))
+        return xor_shares([bytestring1[:length], bytestring2[:length]])
     
 class SecretVisNode(VisNode):
     '''
@@ -42,16 +52,27 @@ class SecretVisNode(VisNode):
     AND - the share is the bitwise xor of all its
           children
     OR - the share is the same as its children
+    THRESHOLD - the share is split among the children with Shamir 
+          secret sharing (see shamir.py), the i-th child getting the
+          share at x = i
     TERM - a random share 
+    
+    In trees built by optimal_decryption_tree, the children of 
+    THRESHOLD nodes also store the x coordinate of their share. 
     '''
+    __slots__ = ['share', 'attribute', 'encrypted_share', 'x']
+    
     def __init__(self, start, end=None,type=NodeType.TERM, 
-                 share='', attribute='', encrypted_share=''):
+                 share='', attribute='', encrypted_share='',
+                 threshold=None, x=None):
         super(SecretVisNode, self).__init__(start, 
                                             end=end,
-                                            type=type)
+                                            type=type,
+                                            threshold=threshold)
         self.share = share
         self.attribute = attribute
         self.encrypted_share = encrypted_share
+        self.x = x
         
     @staticmethod    
     def copy_node(node):
@@ -65,11 +86,14 @@ class SecretVisNode(VisNode):
                              type=node.type,
                              share=node.share,
                              attribute=node.attribute,
-                             encrypted_share=node.encrypted_share)
+                             encrypted_share=node.encrypted_share,
+                             threshold=node.threshold,
+                             x=node.x)
         else:
             return SecretVisNode(start=node.start,
                                  end=node.end,
-                                 type=node.type)
+                                 type=node.type,
+                                 threshold=node.threshold)
     
         
 class SecretVisTree(VisTree):
@@ -116,6 +140,39 @@ class SecretVisTree(VisTree):
                   for c in node.children]       
             return new_node
         
+    def clone(self):
+        '''
+        Returns: a copy of the tree, with the same secret, whose
+        nodes can be modified without changing this tree 
+        '''
+        return SecretVisTree(self._clone_node(self.root), 
+                             self.expression, 
+                             self.secret)
+    
+    def _clone_node(self, node):
+        '''
+        Returns: a copy of node and all of its children
+        '''
+        new_node = SecretVisNode.copy_node(node)
+        for c in node.children:
+            new_node.add(self._clone_node(c))
+        return new_node
+    
+    def leaves(self):
+        '''
+        Returns: a list of the TERM nodes of the tree, in the 
+        order in which they appear in the expression
+        '''
+        leaves = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            if node.type == NodeType.TERM:
+                leaves.append(node)
+            else:
+                nodes.extend(reversed(node.children))
+        return leaves
+        
     def set_attributes(self, vis_tree):
         '''
         Arguments:
@@ -142,7 +199,7 @@ class SecretVisTree(VisTree):
                  for (c, vc) in zip(node.children, vis_node.children)]       
 
 
-    def optimal_decryption_tree(self, key_container, encrypted=True):
+    def optimal_decryption_tree(self, key_container, encrypted=True, versions=None):
         '''     
         If the terms contained in the key_object passed in satisfy the expression; 
         calculates the minimal tree traversal (and therefore
@@ -157,6 +214,10 @@ class SecretVisTree(VisTree):
                 for unit testing. When set to FALSE a default
                 version number is used rather than extracted 
                 from the ciphertext
+            versions - (optional) dictionary from the start of each leaf
+                to the version of the attribute key its share is 
+                encrypted under, used instead of the versions in the
+                encrypted shares
 
         Returns:
             A three tuple of (match, SecretVisTree, keys). Match is a a boolean
@@ -171,7 +232,8 @@ class SecretVisTree(VisTree):
         #call recursive helper function for tree traversal
         (match, num_decryption, node) = self._optimal_decryption_tree(self.root, 
                                                                       key_container,
-                                                                      encrypted)
+                                                                      encrypted,
+                                                                      versions)
                                                                   
         return (match, SecretVisTree(node, self.expression, self.secret), self.terms)
     
@@ -202,7 +264,7 @@ class SecretVisTree(VisTree):
             except PKILookupError: 
                 return False
             
-    def _optimal_decryption_tree(self, share_node, key_container, encrypted):
+    def _optimal_decryption_tree(self, share_node, key_container, encrypted, versions=None):
         '''
         
         Recursive helper function for optimal_decryption_tree
@@ -216,6 +278,7 @@ class SecretVisTree(VisTree):
                         for unit testing. When set to FALSE a default
                         version number is used rather then extracted 
                         from the ciphertext
+            versions - (optional) as for optimal_decryption_tree
         Returns:
             A four tuple of (match, num_decrypt, root, keys). Match is 
             a boolean value of whether the terms could satisfy
@@ -235,7 +298,9 @@ class SecretVisTree(VisTree):
         if share_node.type == NodeType.TERM:
             share_copy = SecretVisNode.copy_node(share_node)
             #if not encrypted, then we have no version info for the key
-            if encrypted is False:
+            if versions is not None:
+                version = versions[share_node.start]
+            elif encrypted is False:
                 version = '1'
             else:
                 version = share_copy.encrypted_share.rsplit('ver',1)[1]
@@ -253,7 +318,7 @@ class SecretVisTree(VisTree):
             for c in share_node.children:
                 (match, num_decrypt, child_copy) =\
                         self._optimal_decryption_tree(c, key_container,
-                                                      encrypted)
+                                                      encrypted, versions)
                 if not match:
                     return (match, 0, None)
                 max_decrypt = max(max_decrypt, num_decrypt)
@@ -267,7 +332,7 @@ class SecretVisTree(VisTree):
             for c in share_node.children:
                 (match, num_decrypt, child_copy) =\
                      self._optimal_decryption_tree(c, key_container,
-                                                   encrypted)
+                                                   encrypted, versions)
                 if match:
                     share_children.append(child_copy)
                     num_decrypts.append(num_decrypt)
@@ -278,6 +343,27 @@ class SecretVisTree(VisTree):
                 min_decrypt = min(num_decrypts)
                 share_node_copy.add(share_children[num_decrypts.index(min_decrypt)])
                 return (True, min_decrypt, share_node_copy)
+        #THRESHOLD case: see if at least threshold children satisfy, if
+        #so keep the threshold children with the fewest decryptions, 
+        #recording the x coordinates of their shares
+        elif share_node.type == NodeType.THRESHOLD:
+            matches = []
+            for (x, c) in enumerate(share_node.children, 1):
+                (match, num_decrypt, child_copy) =\
+                     self._optimal_decryption_tree(c, key_container,
+                                                   encrypted, versions)
+                if match:
+                    child_copy.x = x
+                    matches.append((num_decrypt, x, child_copy))
+            if len(matches) < share_node.threshold:
+                return (False, 0, None)
+            share_node_copy = SecretVisNode.copy_node(share_node)
+            matches.sort(key=lambda match: match[:2])
+            chosen = matches[:share_node.threshold]
+            for (_, _, child_copy) in sorted(chosen, key=lambda match: match[1]):
+                share_node_copy.add(child_copy)
+            return (True, max(num_decrypt for (num_decrypt, _, _) in chosen) +\
+                          len(chosen) - 1, share_node_copy)
         
     def print_shares(self, encrypted=False):
         """
@@ -309,11 +395,20 @@ class SecretVisTree(VisTree):
                 output.write('"'+str(root.share)+'"')
             else:
                 output.write('"'+str(root.encrypted_share)+'"')
+        elif root.type == NodeType.THRESHOLD:
+            output.write('%d{' % root.threshold)
+            sep = ''
+            for c in root.children:
+                output.write(sep)
+                self._print_shares(c, output, encrypted)
+                sep = ','
+            output.write('}')
         else:
             sep = ''
             for c in root.children:
                 output.write(sep)
-                parens = (c.type != NodeType.TERM) and (root.type != c.type)   
+                parens = (c.type not in (NodeType.TERM, NodeType.THRESHOLD)) and\
+                         (root.type != c.type)   
                 if parens:
                     output.write("(")
                 self._print_shares(c, output, encrypted)
@@ -342,6 +437,10 @@ class SecretVisTree(VisTree):
         OR - Children should all verify and their shares
         should all be the same as the node's own share
         
+        THRESHOLD - Children should all verify and both the first
+        and the last threshold of their shares should combine to 
+        the node's own share
+        
         TERM - Nothing to verify
         
         Returns: True or False if the shares verify
@@ -357,10 +456,15 @@ class SecretVisTree(VisTree):
         elif node.type == NodeType.AND:
             children_verified = all([self._verify_shares(c) 
                                      for c in node.children])
-            children_share = node.children[0].share
-            for c in node.children[1:]:
-                children_share = byte_xor(children_share, c.share)
+            children_share = xor_shares([c.share for c in node.children])
             return children_verified and (children_share == node.share)
+        elif node.type == NodeType.THRESHOLD:
+            children_verified = all([self._verify_shares(c) 
+                                     for c in node.children])
+            points = list(enumerate([c.share for c in node.children], 1))
+            return children_verified and \
+                shamir.combine_shares(points[:node.threshold]) == node.share and \
+                shamir.combine_shares(points[-node.threshold:]) == node.share
     
     @staticmethod   
     def _generate_n_random_shares(n, l):
@@ -411,17 +515,276 @@ class SecretVisTree(VisTree):
             random_shares = SecretVisTree._generate_n_random_shares(
                                             len(node.children)-1,
                                             len(share))
-            last_share = share
             for (c,r) in zip(node.children[:-1],random_shares):
-                last_share = byte_xor(last_share, r)
                 self._compute_shares(c, r)
 
-            self._compute_shares(node.children[-1], last_share)
+            self._compute_shares(node.children[-1], 
+                                 xor_shares([share] + random_shares))
+            
+        elif node.type == NodeType.THRESHOLD:
+            #split the share with a random polynomial of degree
+            #threshold-1, giving the i-th child its value at x = i
+            node.share = share
+            coefficients = SecretVisTree._generate_n_random_shares(
+                                            node.threshold-1,
+                                            len(share))
+            shares = shamir.split_secret(share, node.threshold, 
+                                         len(node.children), coefficients)
+            for (c, s) in zip(node.children, shares):
+                self._compute_shares(c, s)
           
         else:
             #Should never be hitting the empty case
             raise ValueError("Ill formed visibility tree")
                       
+_ShareTemplate = namedtuple('_ShareTemplate', ['tree', 'separators', 'random_shares',
+                                               'header'])
+"""
+Parsed form of a visibility expression, cached in PARSE_CACHE, from 
+which the secret share trees for that expression are cloned.
+    tree - SecretVisTree with the attributes set and no shares 
+    separators - the text of the share expressions for the tree between
+                 the quoted shares (see SecretVisTree.print_shares), 
+                 one more than the number of leaves
+    random_shares - the number of random shares needed to split a 
+                 secret according to the tree, one fewer than the 
+                 number of children of each AND node and one fewer
+                 than the threshold of each THRESHOLD node
+    header - the first bytes of the binary share trees for the 
+                 expression (see SHARE_TREE_FORMAT)
+"""
+
+SHARE_TREE_FORMAT = 2
+"""
+First byte of binary share trees. The shape of a share tree is that of
+the visibility expression of its cell, so a binary share tree only holds
+what differs from one cell to the next: 
+    - the format byte and the SHARE_TREE_LABEL checksum of the visibility
+      expression, so that shares do not decrypt under another label
+    - the versions of the attribute keys of the leaves, as a varint of
+      twice the version if all of the leaves share it, and otherwise a
+      varint of 1 followed by a varint of the version of each leaf
+    - the tree IV: iv_length random bytes of the leaf class. The leaf 
+      shares are encrypted with consecutive IVs starting from it (see 
+      _leaf_iv_material), so only the first is stored. The shares are
+      uniformly random, so the IVs being predictable from one another
+      gives nothing away, and random tree IVs keep them from repeating
+      across cells as random per-leaf IVs do.
+    - a varint of the length of the leaf ciphertexts without their IVs,
+      which is the same for all leaves as the shares all have the length
+      of the cell key, followed by the ciphertexts in the order of the 
+      leaves
+"""
+SHARE_TREE_LABEL = struct.Struct('>I')
+
+def _share_tree_header(vis_expr):
+    '''
+    Returns: the header of the _ShareTemplate for vis_expr
+    '''
+    return chr(SHARE_TREE_FORMAT) + \
+        SHARE_TREE_LABEL.pack(zlib.crc32(vis_expr) & 0xFFFFFFFF)
+
+def _pack_varint(n):
+    '''
+    Returns: the non-negative integer n as a varint: seven bits per byte,
+    least significant first, with the high bit set on all but the last
+    '''
+    parts = []
+    while n >= 0x80:
+        parts.append(chr(0x80 | (n & 0x7F)))
+        n >>= 7
+    parts.append(chr(n))
+    return ''.join(parts)
+
+def _unpack_varint(data, offset):
+    '''
+    Returns: (n, offset) tuple with the varint n read from data at offset
+    and the offset just past it. Raises a DecryptionException if data 
+    ends in the middle of the varint.
+    '''
+    n = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise DecryptionException('Encrypted shares do not match the '+\
+                                      'visibility label of the cell')
+        byte = ord(data[offset])
+        offset += 1
+        n |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return (n, offset)
+        shift += 7
+
+def _leaf_iv_material(tree_iv, index):
+    '''
+    Returns: the IV material of the leaf at index of a share tree with
+    the tree IV tree_iv, which is tree_iv plus index as a big-endian 
+    integer of the same length
+    '''
+    length = len(tree_iv)
+    value = (int(tree_iv.encode('hex'), 16) + index) % (1 << 8*length)
+    return ('%0*x' % (2*length, value)).decode('hex')
+
+def _iv_prefix_length(leaf_class):
+    '''
+    Returns: the number of bytes of IV that the ciphertexts of leaf_class
+    start with, which are left out of binary share trees
+    '''
+    iv_length = getattr(leaf_class, 'iv_length', 0)
+    if not iv_length:
+        return 0
+    return len(leaf_class._iv_from_random('\x00' * iv_length))
+
+def pack_share_tree(template, versions, tree_iv, ciphertexts):
+    '''
+    Arguments:
+    template - _ShareTemplate of the visibility expression the shares
+        were split with
+    versions - list of the versions of the attribute keys each leaf 
+        share is encrypted under, in the order of the leaves
+    tree_iv - (byte string) the IV material the leaf shares were 
+        encrypted from (see _leaf_iv_material)
+    ciphertexts - list of the encrypted shares of the leaves without 
+        their IVs, in the order of the leaves
+        
+    Returns: the binary share tree (see SHARE_TREE_FORMAT) for the shares
+    '''
+    if len(set(len(ciphertext) for ciphertext in ciphertexts)) > 1:
+        raise ValueError('Encrypted shares must all be the same length')
+    parts = [template.header]
+    if len(set(versions)) == 1:
+        parts.append(_pack_varint(2*versions[0]))
+    else:
+        parts.append(_pack_varint(1))
+        parts.extend(_pack_varint(version) for version in versions)
+    parts.extend([tree_iv, _pack_varint(len(ciphertexts[0]))])
+    parts.extend(ciphertexts)
+    return ''.join(parts)
+
+def _share_tree_versions(template, data):
+    '''
+    Arguments:
+    template - _ShareTemplate of the visibility expression of the cell
+    data - (byte string) binary share tree, as packed by pack_share_tree
+    
+    Returns: (versions, offset) tuple with the list of the versions of
+    the attribute keys of the leaves and the offset of the tree IV in 
+    data. Raises a DecryptionException if data does not start like a 
+    share tree for template's visibility expression.
+    '''
+    offset = len(template.header)
+    if data[:offset] != template.header:
+        raise DecryptionException('Encrypted shares do not match the '+\
+                                  'visibility label of the cell')
+    (first, offset) = _unpack_varint(data, offset)
+    num_leaves = len(template.separators) - 1
+    if not first & 1:
+        return ([first >> 1] * num_leaves, offset)
+    versions = []
+    for i in xrange(num_leaves):
+        (version, offset) = _unpack_varint(data, offset)
+        versions.append(version)
+    return (versions, offset)
+
+def unpack_share_tree(template, data, leaf_class):
+    '''
+    Arguments:
+    template - _ShareTemplate of the visibility expression of the cell
+    data - (byte string) binary share tree, as packed by pack_share_tree
+    leaf_class - class the leaf shares were encrypted with
+        
+    Returns: list of (version, ciphertext) tuples of the encrypted shares
+    of the leaves with their IVs, in order. Raises a DecryptionException
+    if data is not a share tree for template's visibility expression.
+    '''
+    (versions, offset) = _share_tree_versions(template, data)
+    iv_length = getattr(leaf_class, 'iv_length', 0)
+    tree_iv = data[offset:offset+iv_length]
+    (length, offset) = _unpack_varint(data, offset + iv_length)
+    if len(tree_iv) != iv_length or len(data) != offset + length*len(versions):
+        raise DecryptionException('Encrypted shares do not match the '+\
+                                  'visibility label of the cell')
+    leaf_shares = []
+    for (index, version) in enumerate(versions):
+        ciphertext = data[offset:offset+length]
+        if iv_length:
+            ciphertext = leaf_class._iv_from_random(_leaf_iv_material(tree_iv, index)) +\
+                         ciphertext
+        leaf_shares.append((version, ciphertext))
+        offset += length
+    return leaf_shares
+
+_DecryptionPlan = namedtuple('_DecryptionPlan', ['leaves'])
+"""
+The result of optimal_decryption_tree for the shares of a visibility 
+expression encrypted under a given set of key versions.
+    leaves - tuple of (index, attribute, version, coefficient) tuples for
+             the leaves whose shares combine to the secret, where index
+             is the position of the leaf in the share expression and 
+             version the version of the attribute key its share is 
+             encrypted under. The secret is the xor of the shares, each
+             multiplied by its coefficient in GF(2^8) (see shamir.py);
+             coefficients are 1 unless the leaf is under a THRESHOLD node. 
+Plans hold no keys: the keys are looked up through the key object each
+time a plan is used, so they are only as current as the key object 
+(and its cache, see encryption_pki.py) makes them. 
+"""
+
+#number of decryption plans kept for each key object
+DECRYPTION_PLAN_CACHE_SIZE = 1024
+
+#for each key object, the key epoch and the cache of decryption plans
+#found with its keys during that epoch 
+_DECRYPTION_PLANS = weakref.WeakKeyDictionary()
+_DECRYPTION_PLANS_LOCK = threading.Lock()
+
+def _decryption_plan_cache(key_object):
+    '''
+    Returns: the cache of decryption plans for key_object, which is 
+    emptied whenever the key_epoch of key_object changes, or None 
+    if plans cannot be cached for key_object 
+    '''
+    epoch = getattr(key_object, 'key_epoch', 0)
+    with _DECRYPTION_PLANS_LOCK:
+        try:
+            (cache_epoch, cache) = _DECRYPTION_PLANS.get(key_object, (None, None))
+            if cache_epoch != epoch:
+                cache = LRUCache(DECRYPTION_PLAN_CACHE_SIZE)
+                _DECRYPTION_PLANS[key_object] = (epoch, cache)
+        except TypeError:
+            #key object cannot be weakly referenced 
+            return None
+    return cache
+
+#marks the visibility expressions in a cache of decryption plans that
+#the user's attributes cannot satisfy whatever the versions of the 
+#keys the shares are encrypted under, until the time stored with them
+_UNSATISFIABLE = object()
+
+#number of seconds labels are remembered as unsatisfiable for, unless
+#the key object caches failed lookups for some other time 
+UNSATISFIABLE_TTL = 60
+
+def _unsatisfiable_key(key_container, vis_expression):
+    return (_UNSATISFIABLE, key_container.key_id, vis_expression)
+
+def _unsatisfiable_ttl(key_object):
+    '''
+    Returns: (clock, ttl) tuple with the function giving the current time
+    and the number of seconds unsatisfiable labels are remembered for.
+    These are the clock and negative_ttl of the key_cache of key_object,
+    or of the key object it wraps (see BatchKeyResolver in 
+    acc_encrypt.py), so that labels are checked again once the failed
+    key lookups behind them expire; otherwise time.time and 
+    UNSATISFIABLE_TTL.
+    '''
+    key_cache = getattr(key_object, 'key_cache', None)
+    if key_cache is None:
+        key_cache = getattr(getattr(key_object, 'key_object', None), 'key_cache', None)
+    if key_cache is None:
+        return (time.time, UNSATISFIABLE_TTL)
+    return (key_cache.clock, key_cache.negative_ttl)
+
 class SecretVisTreeEncryptor(object):
     """
     Logic for dealing with secret sharing according to visibility labels, 
@@ -443,7 +806,8 @@ class SecretVisTreeEncryptor(object):
     def encrypt_secret_shares(vis_expr,
                               secret,
                               key_container,
-                              leaf_class):  
+                              leaf_class,
+                              binary=False):  
         """
         Arguments:
         vis_expr - (string) vis_expr to be parsed and shares created
@@ -452,47 +816,197 @@ class SecretVisTreeEncryptor(object):
         up keys. Throws PKILookupError if the algorithm or attribute
         is not present for that particular user. 
         leaf_class - (Encryption class) class to encrypt the leaves of the vis_tree 
+        binary - (optional) whether to return a binary share tree (see 
+            SHARE_TREE_FORMAT), defaults to False
         
         Returns: String of encrypted shares (base64 encoded) formatted
-         like a visibility expression
+         like a visibility expression, or the binary share tree if 
+         binary is True
         """
-        parser = VisParser()
-        tree = parser.parse(vis_expr)
-        secret_tree = SecretVisTree(tree.root, 
-                                    vis_expr,
-                                    secret=secret)
-        secret_tree.compute_shares()
-        SecretVisTreeEncryptor._encrypt_secret_shares(secret_tree.root,
-                                                      key_container,
-                                                      leaf_class)
-        return secret_tree.print_shares(encrypted=True)
+        return SecretVisTreeEncryptor.encrypt_secret_shares_many(vis_expr,
+                                                                 [secret],
+                                                                 key_container,
+                                                                 leaf_class,
+                                                                 binary)[0]
+    
+    @staticmethod 
+    def encrypt_secret_shares_many(vis_expr,
+                                   secrets,
+                                   key_container,
+                                   leaf_class,
+                                   binary=False):  
+        """
+        Arguments:
+        vis_expr - (string) vis_expr to be parsed and shares created
+        secrets - (list of bytestrings) the secrets to be shared, all 
+            of the same length
+        key_container - (Keytor) key_id for the particular algorithm and key_object to look
+        up keys. Throws PKILookupError if the algorithm or attribute
+        is not present for that particular user. 
+        leaf_class - (Encryption class) class to encrypt the leaves of the vis_tree 
+        binary - (optional) whether to return binary share trees, 
+            defaults to False
+        
+        Returns: a list containing, for each secret, the encrypted 
+         shares that encrypt_secret_shares returns for it.
+         The random shares for all of the secrets are drawn with a 
+         single read from the random number generator, each attribute 
+         key is looked up once, and the leaf shares under each key are
+         encrypted together. 
+        """
+        if not secrets:
+            return []
+        if len(set(len(secret) for secret in secrets)) != 1:
+            raise ValueError('Secrets must all be the same length')
+        
+        template = SecretVisTreeEncryptor._share_template(vis_expr)
+        share_length = len(secrets[0])
+        randoms = Random.get_random_bytes(share_length * template.random_shares * len(secrets))
+        randoms = iter([randoms[i:i+share_length] 
+                        for i in xrange(0, len(randoms), share_length)])
+        #leaf shares for each secret, in the order of the leaves
+        leaf_shares = [[] for secret in secrets]
+        SecretVisTreeEncryptor._split_secrets(template.tree.root, secrets, 
+                                              randoms, leaf_shares)
+        
+        #encrypt the shares of the leaves with the same attribute together
+        leaves = template.tree.leaves()
+        positions = {}
+        for (index, leaf) in enumerate(leaves):
+            positions.setdefault(leaf.attribute, []).append(index)
+        #binary share trees store a single IV per tree, from which 
+        #the IVs of the leaves are derived
+        iv_length = getattr(leaf_class, 'iv_length', 0) if binary else 0
+        tree_ivs = [''] * len(secrets)
+        if iv_length:
+            tree_ivs = Random.get_random_bytes(iv_length * len(secrets))
+            tree_ivs = [tree_ivs[i:i+iv_length] 
+                        for i in xrange(0, len(tree_ivs), iv_length)]
+        encrypted_shares = [[None] * len(leaves) for secret in secrets]
+        for (attribute, indices) in positions.items():
+            (key, version) = key_container.key_object.get_current_attribute_key(key_container.key_id,
+                                                                                attribute)
+            plaintexts = [shares[index] for shares in leaf_shares for index in indices]
+            if iv_length:
+                iv_material = ''.join([_leaf_iv_material(tree_iv, index)
+                                       for tree_iv in tree_ivs 
+                                       for index in indices])
+                ciphertexts = leaf_class._encrypt_many(plaintexts, key, iv_material)
+            else:
+                ciphertexts = leaf_class._encrypt_many(plaintexts, key)
+            ciphertexts = iter(ciphertexts)
+            for encrypted in encrypted_shares:
+                for index in indices:
+                    encrypted[index] = (version, next(ciphertexts))
+        
+        if binary:
+            prefix = _iv_prefix_length(leaf_class)
+            return [pack_share_tree(template, 
+                                    [version for (version, _) in encrypted],
+                                    tree_iv,
+                                    [ciphertext[prefix:] for (_, ciphertext) in encrypted])
+                    for (encrypted, tree_iv) in zip(encrypted_shares, tree_ivs)]
+        
+        #same as SecretVisTree.print_shares(encrypted=True)
+        encrypted_shares = [[base64.b64encode(ciphertext) + 'ver' + str(version)
+                             for (version, ciphertext) in encrypted]
+                            for encrypted in encrypted_shares]
+        share_expressions = []
+        for encrypted in encrypted_shares:
+            parts = [template.separators[0]]
+            for (share, separator) in zip(encrypted, template.separators[1:]):
+                parts.extend([share, separator])
+            share_expressions.append('"'.join(parts))
+        return share_expressions
     
     @staticmethod
-    def _encrypt_secret_shares(node, key_container, leaf_class):
+    def _split_secrets(node, shares, randoms, leaf_shares):
         '''
-        Arugments:
-        node - node to be processed
-        attribute_key_dict - see main function
+        Arguments:
+        node - node of the share tree to split shares for 
+        shares - list of the shares for node, one for each secret
+        randoms - iterator over random shares of the same length as 
+            the shares
+        leaf_shares - list with a list for each secret, to which the 
+            shares of the leaves under node are appended, in order
         
-        Side-effect: Share in node is encrypted
+        Splits the shares as SecretVisTree.compute_shares does, without 
+        building a SecretVisTree. The last shares of the children of an 
+        AND node are computed for all of the secrets in a single call to
+        xor_share_lists. The children of a THRESHOLD node are given the
+        Shamir shares of all of the secrets at once, by splitting the 
+        secrets concatenated together. 
         '''
         if node.type == NodeType.TERM:
-            (key, version) = key_container.key_object.get_current_attribute_key(key_container.key_id,
-                                                                                node.attribute)
-            ciphertext = leaf_class.encrypt(str(node.share), key) 
-            node.encrypted_share = base64.b64encode(ciphertext)+'ver'+str(version)
-        else: 
+            for (share, leaves) in zip(shares, leaf_shares):
+                leaves.append(share)
+        elif node.type == NodeType.OR:
             for c in node.children:
-                SecretVisTreeEncryptor._encrypt_secret_shares(c,
-                                                              key_container,
-                                                              leaf_class)
-                
-      
+                SecretVisTreeEncryptor._split_secrets(c, shares, randoms, leaf_shares)
+        elif node.type == NodeType.AND:
+            combined = [[share] for share in shares]
+            for c in node.children[:-1]:
+                random_shares = [next(randoms) for share in shares]
+                for (r, share_list) in zip(random_shares, combined):
+                    share_list.append(r)
+                SecretVisTreeEncryptor._split_secrets(c, random_shares, 
+                                                      randoms, leaf_shares)
+            SecretVisTreeEncryptor._split_secrets(node.children[-1], 
+                                                  xor_share_lists(combined),
+                                                  randoms, leaf_shares)
+        elif node.type == NodeType.THRESHOLD:
+            #every byte is shared independently, so the secrets and 
+            #the coefficients of their polynomials are concatenated
+            length = len(shares[0])
+            coefficients = [''.join([next(randoms) for share in shares])
+                            for i in xrange(node.threshold - 1)]
+            split = shamir.split_secret(''.join(shares), node.threshold,
+                                        len(node.children), coefficients)
+            for (c, child_shares) in zip(node.children, split):
+                SecretVisTreeEncryptor._split_secrets(c,
+                                                      [child_shares[i:i+length] 
+                                                       for i in xrange(0, len(child_shares), 
+                                                                       length)],
+                                                      randoms, leaf_shares)
+        else:
+            #Should never be hitting the empty case
+            raise ValueError("Ill formed visibility tree")
+    
+    @staticmethod
+    def _share_template(vis_expr):
+        '''
+        Arguments:
+        vis_expr - (string) visibility expression 
+        
+        Returns: the _ShareTemplate for vis_expr, which is built
+        only the first time vis_expr is seen and afterwards taken
+        from PARSE_CACHE. Raises VisibilityFormatException if
+        vis_expr is ill-formed. 
+        '''
+        def create():
+            tree = parse_cached(vis_expr)
+            secret_tree = SecretVisTree(tree.root, vis_expr)
+            random_shares = 0
+            nodes = [secret_tree.root]
+            while nodes:
+                node = nodes.pop()
+                if node.type == NodeType.AND:
+                    random_shares += len(node.children) - 1
+                elif node.type == NodeType.THRESHOLD:
+                    random_shares += node.threshold - 1
+                nodes.extend(node.children)
+            return _ShareTemplate(secret_tree, 
+                                  secret_tree.print_shares().split('"')[0::2],
+                                  random_shares,
+                                  _share_tree_header(vis_expr))
+        return PARSE_CACHE.get_or_create((_ShareTemplate, vis_expr), create)
+    
     @staticmethod  
     def decrypt_secret_shares(vis_expression,
                               share_expression,
                               key_container,
-                              leaf_class):
+                              leaf_class,
+                              binary=False):
         """
         Arguments:
         vis_expression - the underlying visibility expression,
@@ -503,22 +1017,68 @@ class SecretVisTreeEncryptor(object):
         up keys. Throws PKILookupError if the algorithm or attribute
         is not present for that particular user. 
         leaf_class - class to encrypt the leaves of the vis_tree 
+        binary - (optional) whether share_expression is a binary share
+            tree (see SHARE_TREE_FORMAT) rather than text, defaults
+            to False. Binary share trees that do not match 
+            vis_expression raise a DecryptionException.
             
         Returns: the top level secret share made by combining all 
         the necessary shares decrypted. If it is not possible 
         to satisfy the vis_expression with the given terms 
         (the ones present in the attribute_key_dict) None is returned.
+        Labels found to be unsatisfiable with any version of the
+        user's keys are rejected straight away afterwards (see 
+        label_unsatisfiable). 
         """
+        if SecretVisTreeEncryptor.label_unsatisfiable(vis_expression, key_container):
+            return None
         
-        visparser = VisParser()
+        template = SecretVisTreeEncryptor._share_template(vis_expression)
+        if binary:
+            leaf_shares = unpack_share_tree(template, share_expression, leaf_class)
+        else:
+            parts = share_expression.split('"')
+            if parts[0::2] == template.separators:
+                #the share expression has the structure of the visibility
+                #expression, so the shares are just the quoted parts
+                leaf_shares = [share.rsplit('ver',1)[::-1] for share in parts[1::2]]
+            else:
+                leaf_shares = None
+                
+        if leaf_shares is not None:
+            try:
+                versions = [int(version) for (version, _) in leaf_shares]
+            except ValueError:
+                raise DecryptionException('Encrypted shares do not contain '+\
+                                          'version information')
+            planned = SecretVisTreeEncryptor._decryption_plan(vis_expression,
+                                                              template,
+                                                              versions,
+                                                              key_container)
+            if planned is None:
+                return None
+            (plan, keys) = planned
+            
+            #the OR nodes of the optimal tree each keep a single child, the
+            #AND nodes xor theirs and the THRESHOLD nodes xor theirs 
+            #multiplied by Lagrange coefficients, so the secret is the 
+            #xor of the leaves multiplied by the plan's coefficients
+            shares = []
+            for (index, attribute, version, coefficient) in plan.leaves:
+                ciphertext = leaf_shares[index][1]
+                if not binary:
+                    ciphertext = base64.b64decode(ciphertext)
+                shares.append(shamir.scale(leaf_class.decrypt(ciphertext, 
+                                                              keys[(attribute, version)]),
+                                           coefficient))
+            return xor_shares(shares)
         
-        vistree = visparser.parse(vis_expression)
         #NB: in this share tree, start and end in nodes represent the 
         #start and end for the share expression, not the visibility expression
         #as they would when one is encrypting
         shareparser = SecretVisParser()
         share_tree = shareparser.parse(share_expression)
-        share_tree.set_attributes(vistree)
+        share_tree.set_attributes(parse_cached(vis_expression))
         (match, opt_share_tree, keys) = share_tree.optimal_decryption_tree(key_container)
         if not match:
             return None
@@ -528,6 +1088,199 @@ class SecretVisTreeEncryptor(object):
                                                       leaf_class)
         return opt_share_tree.root.share
     
+    @staticmethod
+    def label_unsatisfiable(vis_expression, key_container):
+        """
+        Arguments:
+        vis_expression - visibility expression of a cell
+        key_container - Keytor object used to look up attribute keys
+        
+        Returns: True if an earlier decryption found that the user 
+        holds no version of the keys of attributes that would satisfy
+        vis_expression (see has_attribute in encryption_pki.py), so 
+        cells with the label can be rejected without parsing it or 
+        looking up any keys. This is remembered for each key object
+        until its key_epoch changes, and for no longer than failed key
+        lookups are (see _unsatisfiable_ttl). 
+        """
+        cache = _decryption_plan_cache(key_container.key_object)
+        if cache is None:
+            return False
+        key = _unsatisfiable_key(key_container, vis_expression)
+        expires = cache.peek(key)
+        if expires is None:
+            return False
+        (clock, _) = _unsatisfiable_ttl(key_container.key_object)
+        if clock() < expires:
+            return True
+        cache.pop(key)
+        return False
+    
+    @staticmethod
+    def _satisfiable(node, key_container, held):
+        '''
+        Arguments:
+        node - node of a share template tree
+        key_container - Keytor object used to look up attribute keys
+        held - dictionary from attributes to whether the user holds
+            some version of their keys, filled in as attributes are
+            checked
+        
+        Returns: whether the attributes the user holds some version 
+        of the keys of satisfy node
+        '''
+        if node.type == NodeType.TERM:
+            if node.attribute not in held:
+                has_attribute = getattr(key_container.key_object, 'has_attribute', None)
+                held[node.attribute] = has_attribute is None or \
+                    has_attribute(key_container.key_id, node.attribute)
+            return held[node.attribute]
+        elif node.type == NodeType.AND:
+            return all(SecretVisTreeEncryptor._satisfiable(c, key_container, held)
+                       for c in node.children)
+        elif node.type == NodeType.THRESHOLD:
+            return len([c for c in node.children 
+                        if SecretVisTreeEncryptor._satisfiable(c, key_container, held)])\
+                   >= node.threshold
+        else:
+            return any(SecretVisTreeEncryptor._satisfiable(c, key_container, held)
+                       for c in node.children)
+    
+    @staticmethod
+    def leaf_key_versions(vis_expression, share_expression, binary=False):
+        """
+        Arguments:
+        vis_expression - the underlying visibility expression
+        share_expression - the encrypted shares, as passed to 
+            decrypt_secret_shares
+        binary - (optional) whether share_expression is a binary share
+            tree, defaults to False
+            
+        Returns: list of the (attribute, version) pairs of the attribute
+        keys the shares of the leaves are encrypted under, with integer
+        versions, in the order of the leaves. The list is empty if the
+        shares do not have the structure of vis_expression. 
+        """
+        template = SecretVisTreeEncryptor._share_template(vis_expression)
+        if binary:
+            try:
+                (versions, _) = _share_tree_versions(template, share_expression)
+            except DecryptionException:
+                return []
+        else:
+            parts = share_expression.split('"')
+            if parts[0::2] != template.separators:
+                return []
+            try:
+                versions = [int(share.rsplit('ver',1)[1]) for share in parts[1::2]]
+            except (IndexError, ValueError):
+                return []
+        return [(leaf.attribute, version) 
+                for (leaf, version) in zip(template.tree.leaves(), versions)]
+    
+    @staticmethod
+    def _decryption_plan(vis_expression, template, versions, key_container):
+        '''
+        Arguments:
+        vis_expression - the underlying visibility expression
+        template - the _ShareTemplate for vis_expression
+        versions - (ints) the versions of the attribute keys the 
+            shares of the leaves of the template are encrypted under, 
+            in order
+        key_container - Keytor object used to look up attribute keys
+        
+        Returns: a (plan, keys) tuple of the _DecryptionPlan for the 
+        shares and a dictionary from the (attribute, version) pairs of
+        its leaves to their keys, or None if the user's attributes do
+        not satisfy vis_expression. Plans depend only on the expression
+        and the versions of the keys the shares are encrypted under, so
+        they are cached for each key object until its key_epoch changes.
+        A cached plan is found again if one of its keys can no longer
+        be looked up, for example because it was revoked. If the user
+        holds no version of the keys that would satisfy vis_expression,
+        the label is remembered as unsatisfiable (see 
+        label_unsatisfiable). 
+        '''
+        plan_key = (key_container.key_id, vis_expression, tuple(versions))
+        cache = _decryption_plan_cache(key_container.key_object)
+        if cache is not None:
+            plan = cache.get(plan_key)
+            if plan is not None:
+                try:
+                    return (plan, SecretVisTreeEncryptor._plan_keys(plan, key_container))
+                except PKILookupError:
+                    cache.pop(plan_key)
+        
+        share_tree = template.tree.clone()
+        leaves = share_tree.leaves()
+        (match, opt_share_tree, _) = share_tree.optimal_decryption_tree(key_container,
+            versions=dict((leaf.start, version) for (leaf, version) in zip(leaves, versions)))
+        if not match:
+            if cache is not None and \
+               not SecretVisTreeEncryptor._satisfiable(template.tree.root, 
+                                                       key_container, {}):
+                (clock, ttl) = _unsatisfiable_ttl(key_container.key_object)
+                if ttl:
+                    cache.put(_unsatisfiable_key(key_container, vis_expression),
+                              clock() + ttl)
+            return None
+        
+        #leaves of the template are told apart by their position in
+        #the visibility expression, which copies of them keep 
+        indices = dict((leaf.start, index) for (index, leaf) in enumerate(leaves))
+        plan = _DecryptionPlan(tuple((indices[leaf.start], leaf.attribute, 
+                                      versions[indices[leaf.start]], coefficient)
+                                     for (leaf, coefficient) 
+                                     in SecretVisTreeEncryptor._leaf_coefficients(opt_share_tree.root)))
+        try:
+            keys = SecretVisTreeEncryptor._plan_keys(plan, key_container)
+        except PKILookupError:
+            return None
+        if cache is not None:
+            cache.put(plan_key, plan)
+        return (plan, keys)
+    
+    @staticmethod
+    def _plan_keys(plan, key_container):
+        '''
+        Returns: dictionary from the (attribute, version) pairs of the
+        leaves of plan to their keys, looked up through the key object
+        of key_container. Raises PKILookupError if a key cannot be 
+        looked up.
+        '''
+        keys = {}
+        for (_, attribute, version, _) in plan.leaves:
+            if (attribute, version) not in keys:
+                keys[(attribute, version)] = key_container.key_object.get_attribute_key(
+                                                key_container.key_id, attribute, version)
+        return keys
+    
+    @staticmethod
+    def _leaf_coefficients(root):
+        '''
+        Arguments:
+        root - root of a tree built by optimal_decryption_tree
+        
+        Returns: list of (leaf, coefficient) tuples for the leaves of
+        the tree, in order, where the coefficient is the product of the
+        Lagrange coefficients of the THRESHOLD nodes above the leaf. 
+        Multiplication in GF(2^8) distributes over xor, so the secret
+        is the xor of the leaf shares multiplied by their coefficients.
+        '''
+        result = []
+        nodes = [(root, 1)]
+        while nodes:
+            (node, coefficient) = nodes.pop()
+            if node.type == NodeType.TERM:
+                result.append((node, coefficient))
+            elif node.type == NodeType.THRESHOLD:
+                lagrange = shamir.lagrange_coefficients([c.x for c in node.children])
+                nodes.extend(reversed([(c, shamir.gf_mul(coefficient, l)) 
+                                       for (c, l) in zip(node.children, lagrange)]))
+            else:
+                nodes.extend(reversed([(c, coefficient) for c in node.children]))
+        return result
+    
     @staticmethod
     def _decrypt_secret_shares(node, keys, leaf_class):
         '''
@@ -548,15 +1301,16 @@ class SecretVisTreeEncryptor(object):
             _ = [SecretVisTreeEncryptor._decrypt_secret_shares(c, keys, leaf_class)
                  for c in node.children]
             
-            children_share = node.children[0].share
-            for c in node.children[1:]:
-                children_share = byte_xor(children_share, c.share)
-            node.share = children_share
+            node.share = xor_shares([c.share for c in node.children])
             
         elif node.type == NodeType.OR:
             _ = [SecretVisTreeEncryptor._decrypt_secret_shares(c, keys, leaf_class)
                  for c in node.children]
             node.share = node.children[0].share
+        elif node.type == NodeType.THRESHOLD:
+            _ = [SecretVisTreeEncryptor._decrypt_secret_shares(c, keys, leaf_class)
+                 for c in node.children]
+            node.share = shamir.combine_shares([(c.x, c.share) for c in node.children])
         else:
             #Should never be hitting the empty case
             raise ValueError("Ill formed visibility tree")
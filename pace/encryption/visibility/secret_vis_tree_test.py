@@ -18,11 +18,13 @@ sys.path.append(base_dir)
 import unittest
 from Crypto import Random 
 from pace.encryption.acc_encrypt import Encryptor, Keytor
-from pace.encryption.AES_encrypt import Pycrypto_AES_CBC
+from pace.encryption.AES_encrypt import Pycrypto_AES_CBC, Pycrypto_AES_CTR
 from pace.encryption.visibility.vis_parser import VisParser
-from pace.encryption.encryption_pki import DummyEncryptionPKI
+from pace.encryption.encryption_pki import DummyEncryptionPKI, DummyCachingEncryptionPKI, KeyCache
 from pace.pki.abstractpki import PKILookupError
-from pace.encryption.visibility.secret_vis_tree import SecretVisNode, SecretVisTree, SecretVisParser, SecretVisTreeEncryptor
+from pace.encryption.encryption_exceptions import DecryptionException
+from pace.encryption.visibility.secret_vis_tree import SecretVisNode, SecretVisTree, SecretVisParser, SecretVisTreeEncryptor, \
+    pack_share_tree, unpack_share_tree
 
 class DummyKeys(object):
     def __init__(self, terms):
@@ -43,6 +45,27 @@ class DummyKeys(object):
             raise PKILookupError('Nope')
         return self.keys[attribute]
     
+class CountingPKI(DummyEncryptionPKI):
+    '''
+    DummyEncryptionPKI that counts the attribute keys looked up, and
+    separately the current attribute keys looked up
+    '''
+    def __init__(self):
+        DummyEncryptionPKI.__init__(self)
+        self.lookups = 0
+        self.current_lookups = 0
+        self.revoked = set()
+        
+    def get_current_attribute_key(self, algorithm, attribute):
+        self.current_lookups += 1
+        return DummyEncryptionPKI.get_current_attribute_key(self, algorithm, attribute)
+        
+    def get_attribute_key(self, algorithm, attribute, version=1):
+        self.lookups += 1
+        if attribute in self.revoked:
+            raise PKILookupError('Key for %s was revoked' % attribute)
+        return DummyEncryptionPKI.get_attribute_key(self, algorithm, attribute, version)
+    
 class SecretVisTreeTest(unittest.TestCase):
     
     def test_optimal_path(self):
@@ -140,4 +163,253 @@ class SecretVisTreeTest(unittest.TestCase):
                                                           Keytor('VIS_AES_CBC',DummyPKI,16),
                                                           Pycrypto_AES_CBC)
             self.assertEqual(share, secret)
-            
\ No newline at end of file
+            
+            
+    def test_share_expression_fallback(self):
+        '''
+        Tests decrypting share expressions that are not laid out 
+        exactly as encrypt_secret_shares writes them
+        '''
+        DummyPKI = DummyEncryptionPKI()
+        keytor = Keytor('VIS_AES_CBC',DummyPKI,16)
+        for e in ['a&b', '(a|b)&c', 'a|(b&c)']:
+            secret = Random.get_random_bytes(16)
+            encrypted_shares = SecretVisTreeEncryptor.encrypt_secret_shares(e,
+                                                                            secret,
+                                                                            keytor,
+                                                                            Pycrypto_AES_CBC)
+            share = SecretVisTreeEncryptor.decrypt_secret_shares(e, 
+                                                          '(' + encrypted_shares + ')',
+                                                          keytor,
+                                                          Pycrypto_AES_CBC)
+            self.assertEqual(share, secret)
+            
+    def test_thresholds(self):
+        '''
+        Tests sharing secrets with threshold nodes, and that the
+        optimal tree keeps only threshold of their children
+        '''
+        parser = VisParser()
+        for (e, t, g) in [('2{a,b,c}', ['a','c'], '2{a,c}'),
+                          ('2{a,b,c}', ['c'], ''),
+                          ('2{a&d,b,c}', ['a','b','c','d'], '2{b,c}'),
+                          ('2{a,b|d,c}&e', ['b','c','d','e'], '2{b,c}&e'),
+                          ('1{a,2{b,c,d}}|e', ['c','d'], '1{2{c,d}}')]:
+            vis_tree = parser.parse(e)
+            share_tree = SecretVisTree(vis_tree.root, e, 
+                                       secret=Random.get_random_bytes(16))
+            share_tree.compute_shares()
+            self.assertTrue(share_tree.verify_shares())
+            share_tree.set_attributes(vis_tree)
+            (match, opt_tree, keys) = share_tree.optimal_decryption_tree(Keytor('VIS_AES_CBC',DummyKeys(terms=t),16),
+                                                                     encrypted=False)
+            self.assertEqual(match, g != '')
+            self.assertEqual(g, str(opt_tree))
+        
+        full = Keytor('VIS_AES_CBC', DummyEncryptionPKI(), 16)
+        partial = Keytor('VIS_AES_CBC', DummyEncryptionPKI(terms=['a', 'c', 'd']), 16)
+        limited = Keytor('VIS_AES_CBC', DummyEncryptionPKI(terms=['b', 'c']), 16)
+        for e in ['2{a,b,c}', '3{a,c,d,b}|e', '2{a&b,c,1{d,e}}']:
+            for binary in [False, True]:
+                secret = Random.get_random_bytes(16)
+                encrypted_shares = SecretVisTreeEncryptor.encrypt_secret_shares(e,
+                                                                                secret,
+                                                                                full,
+                                                                                Pycrypto_AES_CBC,
+                                                                                binary)
+                self.assertEqual(SecretVisTreeEncryptor.decrypt_secret_shares(e,
+                                                                              encrypted_shares,
+                                                                              partial,
+                                                                              Pycrypto_AES_CBC,
+                                                                              binary),
+                                 secret)
+                if not binary:
+                    self.assertEqual(SecretVisTreeEncryptor.decrypt_secret_shares(e,
+                                                                                  '(' + encrypted_shares + ')',
+                                                                                  partial,
+                                                                                  Pycrypto_AES_CBC),
+                                     secret)
+        self.assertEqual(SecretVisTreeEncryptor.decrypt_secret_shares('2{a&b,c,1{d,e}}',
+                                                                      encrypted_shares,
+                                                                      limited,
+                                                                      Pycrypto_AES_CBC,
+                                                                      True),
+                         None)
+        
+        #a threshold stores one share per term, rather than one for
+        #each term of every clause of the expanded expression
+        expanded = '(a&b)|(a&c)|(a&d)|(b&c)|(b&d)|(c&d)'
+        secret = Random.get_random_bytes(16)
+        self.assertTrue(len(SecretVisTreeEncryptor.encrypt_secret_shares('2{a,b,c,d}', secret,
+                                                                         full, Pycrypto_AES_CBC, 
+                                                                         True)) * 2 < 
+                        len(SecretVisTreeEncryptor.encrypt_secret_shares(expanded, secret,
+                                                                         full, Pycrypto_AES_CBC, 
+                                                                         True)))
+            
+    def test_clone(self):
+        '''
+        Tests that cloned trees share no nodes with the original
+        '''
+        tree = VisParser().parse('(a|b)&c')
+        secret_tree = SecretVisTree(tree.root, tree.expression)
+        clone = secret_tree.clone()
+        self.assertEqual([leaf.attribute for leaf in clone.leaves()], ['a', 'b', 'c'])
+        clone.compute_shares(Random.get_random_bytes(16))
+        self.assertTrue(clone.verify_shares())
+        self.assertEqual([leaf.share for leaf in secret_tree.leaves()], ['', '', ''])
+        
+    def test_decryption_plan_cache(self):
+        '''
+        Tests that decryption plans are reused until the key epoch 
+        changes, and that the keys of a plan are looked up through the
+        key object each time it is used, so keys that can no longer be
+        looked up are not used
+        '''
+        pki = CountingPKI()
+        keytor = Keytor('VIS_AES_CBC',pki,16)
+        e = '(a|b)&(c|d)'
+        secrets = [Random.get_random_bytes(16) for i in range(3)]
+        encrypted_shares = [SecretVisTreeEncryptor.encrypt_secret_shares(e,
+                                                                        secret,
+                                                                        keytor,
+                                                                        Pycrypto_AES_CBC)
+                            for secret in secrets]
+        
+        decrypt = lambda shares: SecretVisTreeEncryptor.decrypt_secret_shares(e,
+                                                                     shares,
+                                                                     keytor,
+                                                                     Pycrypto_AES_CBC)
+        self.assertEqual(decrypt(encrypted_shares[0]), secrets[0])
+        lookups = pki.lookups
+        self.assertTrue(lookups > 2)
+        #only the keys of the two leaves of the plan are looked up
+        for (shares, secret) in zip(encrypted_shares, secrets):
+            self.assertEqual(decrypt(shares), secret)
+        self.assertEqual(pki.lookups, lookups + 2 * len(secrets))
+        
+        pki.keys_changed()
+        self.assertEqual(decrypt(encrypted_shares[1]), secrets[1])
+        self.assertEqual(pki.lookups, 2 * lookups + 2 * len(secrets))
+        
+        #without keys_changed, a plan whose key was revoked is replaced
+        pki.revoked.add('a')
+        self.assertEqual(decrypt(encrypted_shares[2]), secrets[2])
+        pki.revoked.add('b')
+        self.assertEqual(decrypt(encrypted_shares[2]), None)
+
+
+    def test_encrypt_many(self):
+        '''
+        Tests sharing several secrets under one label at once, looking
+        up each attribute key only once
+        '''
+        pki = CountingPKI()
+        keytor = Keytor('VIS_AES_CBC',pki,16)
+        e = '(a|b)&(c|(d&a))'
+        secrets = [Random.get_random_bytes(16) for i in range(5)]
+        encrypted_shares = SecretVisTreeEncryptor.encrypt_secret_shares_many(e,
+                                                                          secrets,
+                                                                          keytor,
+                                                                          Pycrypto_AES_CBC)
+        self.assertEqual(pki.current_lookups, 4)
+        self.assertEqual(len(set(encrypted_shares)), len(secrets))
+        for (shares, secret) in zip(encrypted_shares, secrets):
+            self.assertEqual(SecretVisTreeEncryptor.decrypt_secret_shares(e,
+                                                                 shares,
+                                                                 keytor,
+                                                                 Pycrypto_AES_CBC),
+                             secret)
+        
+        self.assertEqual(SecretVisTreeEncryptor.encrypt_secret_shares_many(e,
+                                                                        [],
+                                                                        keytor,
+                                                                        Pycrypto_AES_CBC),
+                         [])
+        self.assertRaises(ValueError,
+                          SecretVisTreeEncryptor.encrypt_secret_shares_many,
+                          e, secrets + ['short'], keytor, Pycrypto_AES_CBC)
+
+    def test_unsatisfiable_expiry(self):
+        '''
+        Tests that labels are only remembered as unsatisfiable for as 
+        long as the key object remembers failed lookups
+        '''
+        e = 'c|d'
+        secret = Random.get_random_bytes(16)
+        shares = SecretVisTreeEncryptor.encrypt_secret_shares(e, secret,
+                                                              Keytor('VIS_AES_CBC',
+                                                                     DummyEncryptionPKI(),
+                                                                     16),
+                                                              Pycrypto_AES_CBC)
+        now = [0]
+        pki = DummyCachingEncryptionPKI(terms=['a', 'b'])
+        pki.key_cache = KeyCache(negative_ttl=2, clock=lambda: now[0])
+        keytor = Keytor('VIS_AES_CBC', pki, 16)
+        self.assertFalse(SecretVisTreeEncryptor.label_unsatisfiable(e, keytor))
+        self.assertEqual(SecretVisTreeEncryptor.decrypt_secret_shares(e, shares, keytor,
+                                                                      Pycrypto_AES_CBC),
+                         None)
+        self.assertTrue(SecretVisTreeEncryptor.label_unsatisfiable(e, keytor))
+        now[0] += 1
+        self.assertTrue(SecretVisTreeEncryptor.label_unsatisfiable(e, keytor))
+        now[0] += 2
+        self.assertFalse(SecretVisTreeEncryptor.label_unsatisfiable(e, keytor))
+        
+        #nothing is remembered if failed lookups are not
+        pki.key_cache = KeyCache(negative_ttl=0)
+        self.assertEqual(SecretVisTreeEncryptor.decrypt_secret_shares(e, shares, keytor,
+                                                                      Pycrypto_AES_CBC),
+                         None)
+        self.assertFalse(SecretVisTreeEncryptor.label_unsatisfiable(e, keytor))
+
+    def test_binary_share_tree(self):
+        '''
+        Tests encrypting shares as a binary share tree, which is about
+        half the size of the text shares and only decrypts with its own 
+        label
+        '''
+        keytor = Keytor('VIS_AES_CBC',DummyEncryptionPKI(),16)
+        e = '(a|b)&(c|(d&a))'
+        secret = Random.get_random_bytes(16)
+        tree = SecretVisTreeEncryptor.encrypt_secret_shares(e, secret, keytor,
+                                                            Pycrypto_AES_CBC, 
+                                                            binary=True)
+        text = SecretVisTreeEncryptor.encrypt_secret_shares(e, secret, keytor,
+                                                            Pycrypto_AES_CBC)
+        self.assertTrue(len(tree) < 0.55 * len(text))
+        decrypt = lambda shares, expression: \
+            SecretVisTreeEncryptor.decrypt_secret_shares(expression, shares, keytor,
+                                                         Pycrypto_AES_CBC, binary=True)
+        self.assertEqual(decrypt(tree, e), secret)
+        
+        for (shares, expression) in [(tree, '(a|b)&(c|d)'),
+                                     (tree, '(a|b)&(c|d|a)'),
+                                     (tree[:-1], e),
+                                     (tree + 'x', e),
+                                     (text, e)]:
+            self.assertRaises(DecryptionException, decrypt, shares, expression)
+        
+        #CTR shares carry no padding, so their trees are smaller still
+        tree = SecretVisTreeEncryptor.encrypt_secret_shares(e, secret, keytor,
+                                                            Pycrypto_AES_CTR, 
+                                                            binary=True)
+        text = SecretVisTreeEncryptor.encrypt_secret_shares(e, secret, keytor,
+                                                            Pycrypto_AES_CTR)
+        self.assertTrue(len(tree) < 0.45 * len(text))
+        self.assertEqual(SecretVisTreeEncryptor.decrypt_secret_shares(e, tree, keytor,
+                                                                      Pycrypto_AES_CTR,
+                                                                      binary=True),
+                         secret)
+        
+        #leaves under different key versions list each version
+        template = SecretVisTreeEncryptor._share_template(e)
+        tree_iv = Random.get_random_bytes(Pycrypto_AES_CBC.iv_length)
+        bodies = [Random.get_random_bytes(32) for i in xrange(5)]
+        for versions in [[1, 1, 1, 1, 1], [1, 200, 3, 1, 70000]]:
+            tree = pack_share_tree(template, versions, tree_iv, bodies)
+            self.assertEqual([(v, c[16:]) for (v, c) 
+                              in unpack_share_tree(template, tree, Pycrypto_AES_CBC)],
+                             zip(versions, bodies))
+            self.assertEqual(SecretVisTreeEncryptor.leaf_key_versions(e, tree, binary=True),
+                             zip(['a', 'b', 'c', 'd', 'a'], versions))
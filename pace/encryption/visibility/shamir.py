@@ -0,0 +1,136 @@
+## **************
+##  Copyright 2026 MIT Lincoln Laboratory
+##  Project: PACE
+##  Authors: ATLH
+##  Description: Shamir secret sharing over GF(2^8) for threshold
+##               nodes of visibility expressions
+##  Modifications:
+##  Date         Name  Modification
+##  ----         ----  ------------
+##  17 Oct 2026  ATLH    Original file
+## **************
+
+import os
+import sys
+this_dir = os.path.dirname(os.path.dirname(__file__))
+base_dir = os.path.join(this_dir, '../..')
+sys.path.append(base_dir)
+
+from pace.encryption.visibility.share_combine import xor_shares
+
+#largest number of shares a secret can be split into, one for each
+#non-zero element of GF(2^8)
+MAX_SHARES = 255
+
+def _build_tables():
+    '''
+    Returns: (exp, log) tables of GF(2^8) with the AES reduction
+    polynomial x^8+x^4+x^3+x+1 and generator 3. The exp table is
+    doubled so that sums of two logarithms can be looked up directly.
+    '''
+    exp = [0] * 510
+    log = [0] * 256
+    x = 1
+    for i in xrange(255):
+        exp[i] = exp[i + 255] = x
+        log[x] = i
+        #multiply by the generator, x + 1
+        x ^= (x << 1) ^ (0x11b if x & 0x80 else 0)
+    return (exp, log)
+
+_EXP, _LOG = _build_tables()
+
+def gf_mul(a, b):
+    '''
+    Returns: the product of the elements a and b of GF(2^8)
+    '''
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+def gf_div(a, b):
+    '''
+    Returns: a divided by the non-zero element b of GF(2^8)
+    '''
+    if b == 0:
+        raise ZeroDivisionError('division by zero in GF(2^8)')
+    if a == 0:
+        return 0
+    return _EXP[(_LOG[a] - _LOG[b]) % 255]
+
+#for each element c of GF(2^8), the translation table (see str.translate)
+#that multiplies every byte of a string by c
+MUL_TABLES = [''.join([chr(gf_mul(c, b)) for b in xrange(256)])
+              for c in xrange(256)]
+
+def scale(share, c):
+    '''
+    Returns: the byte string share with every byte multiplied by the
+    element c of GF(2^8), with a single table lookup per byte
+    '''
+    if c == 1:
+        return share
+    return share.translate(MUL_TABLES[c])
+
+def split_secret(secret, threshold, num_shares, coefficients):
+    '''
+    Arguments:
+    secret - (byte string) the secret to split
+    threshold - number of shares needed to recover the secret
+    num_shares - number of shares to split the secret into, at most
+        MAX_SHARES
+    coefficients - list of threshold-1 random byte strings of the same
+        length as secret, the coefficients of the polynomial whose
+        constant term is the secret
+
+    Returns: list of num_shares byte strings, where the share at index
+    i is the polynomial evaluated at x = i+1, byte by byte. Any threshold
+    of them give back the secret with combine_shares. Since every byte
+    is shared independently, several secrets can be split at once by
+    concatenating them and their coefficients.
+    '''
+    if not 1 <= threshold <= num_shares <= MAX_SHARES:
+        raise ValueError('Need 1 <= threshold <= number of shares <= %d' % MAX_SHARES)
+    if len(coefficients) != threshold - 1:
+        raise ValueError('Need threshold-1 coefficients')
+    shares = []
+    for x in xrange(1, num_shares + 1):
+        terms = [secret]
+        power = 1
+        for coefficient in coefficients:
+            power = gf_mul(power, x)
+            terms.append(scale(coefficient, power))
+        shares.append(xor_shares(terms))
+    return shares
+
+def lagrange_coefficients(xs):
+    '''
+    Arguments:
+    xs - list of the distinct, non-zero x coordinates of the shares
+
+    Returns: the list of the Lagrange coefficients for interpolating
+    at zero from shares at xs, in the same order
+    '''
+    if len(set(xs)) != len(xs) or not all(0 < x <= MAX_SHARES for x in xs):
+        raise ValueError('Share coordinates must be distinct and between 1 and %d'
+                         % MAX_SHARES)
+    coefficients = []
+    for xi in xs:
+        coefficient = 1
+        for xj in xs:
+            if xj != xi:
+                coefficient = gf_mul(coefficient, gf_div(xj, xj ^ xi))
+        coefficients.append(coefficient)
+    return coefficients
+
+def combine_shares(points):
+    '''
+    Arguments:
+    points - list of (x, share) tuples of at least as many shares split
+        by split_secret as its threshold, all of the same length
+
+    Returns: the secret the shares were split from
+    '''
+    coefficients = lagrange_coefficients([x for (x, _) in points])
+    return xor_shares([scale(share, c)
+                       for ((_, share), c) in zip(points, coefficients)])
@@ -0,0 +1,85 @@
+## **************
+##  Copyright 2026 MIT Lincoln Laboratory
+##  Project: PACE
+##  Authors: ATLH
+##  Description: Unit tests for shamir
+##  Modifications:
+##  Date         Name  Modification
+##  ----         ----  ------------
+##  17 Oct 2026  ATLH    Original file
+## **************
+
+import os
+import sys
+this_dir = os.path.dirname(os.path.dirname(__file__))
+base_dir = os.path.join(this_dir, '../..')
+sys.path.append(base_dir)
+
+import random
+import itertools
+import unittest
+from pace.encryption.visibility.shamir import gf_mul, gf_div, scale, split_secret, \
+    combine_shares, lagrange_coefficients, MAX_SHARES
+
+def slow_mul(a, b):
+    '''
+    Shift-and-add multiplication in GF(2^8) to check the tables against
+    '''
+    product = 0
+    while b:
+        if b & 1:
+            product ^= a
+        a <<= 1
+        if a & 0x100:
+            a ^= 0x11b
+        b >>= 1
+    return product
+
+def random_share(length):
+    return ''.join(chr(random.randint(0, 255)) for i in xrange(length))
+
+class ShamirTest(unittest.TestCase):
+
+    def test_field(self):
+        '''
+        Tests multiplication and division in GF(2^8)
+        '''
+        for a in xrange(256):
+            for b in [0, 1, 2, 3, 0x53, 0xca, 0xff, random.randint(1, 255)]:
+                self.assertEqual(gf_mul(a, b), slow_mul(a, b))
+                if b:
+                    self.assertEqual(gf_mul(gf_div(a, b), b), a)
+        self.assertEqual(gf_mul(0x53, 0xca), 1)
+        self.assertRaises(ZeroDivisionError, gf_div, 1, 0)
+
+        share = random_share(64)
+        self.assertEqual(scale(share, 7),
+                         ''.join(chr(slow_mul(ord(c), 7)) for c in share))
+        self.assertEqual(scale(share, 1), share)
+
+    def test_split_combine(self):
+        '''
+        Tests that any threshold of the shares give back the secret
+        and fewer do not
+        '''
+        secret = random_share(16)
+        for (threshold, num_shares) in [(1, 3), (2, 3), (3, 3), (3, 5)]:
+            coefficients = [random_share(16) for i in xrange(threshold - 1)]
+            shares = split_secret(secret, threshold, num_shares, coefficients)
+            self.assertEqual(len(shares), num_shares)
+            points = list(enumerate(shares, 1))
+            for subset in itertools.combinations(points, threshold):
+                self.assertEqual(combine_shares(list(subset)), secret)
+            self.assertEqual(combine_shares(points), secret)
+            if threshold > 1:
+                self.assertNotEqual(combine_shares(points[:threshold - 1]), secret)
+
+        shares = split_secret(secret, 2, MAX_SHARES, [random_share(16)])
+        self.assertEqual(combine_shares([(MAX_SHARES, shares[-1]), (1, shares[0])]), secret)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, split_secret, 'secret', 3, 2, ['a', 'b'])
+        self.assertRaises(ValueError, split_secret, 'secret', 2, MAX_SHARES + 1, ['a'])
+        self.assertRaises(ValueError, split_secret, 'secret', 2, 3, [])
+        self.assertRaises(ValueError, lagrange_coefficients, [1, 1])
+        self.assertRaises(ValueError, lagrange_coefficients, [0, 1])
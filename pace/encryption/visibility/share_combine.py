@@ -0,0 +1,93 @@
+## **************
+##  Copyright 2026 MIT Lincoln Laboratory
+##  Project: PACE
+##  Authors: ATLH
+##  Description: Bulk xor of secret shares
+##  Modifications:
+##  Date         Name  Modification
+##  ----         ----  ------------
+##  17 Oct 2026  ATLH    Original file
+## **************
+
+import os
+import sys
+this_dir = os.path.dirname(os.path.dirname(__file__))
+base_dir = os.path.join(this_dir, '../..')
+sys.path.append(base_dir)
+
+from binascii import hexlify, unhexlify
+
+def _to_int(share):
+    '''
+    Returns: the byte string share as a big-endian integer
+    '''
+    return int(hexlify(share), 16)
+
+def _to_bytes(value, length):
+    '''
+    Returns: the integer value as a big-endian byte string of
+    length bytes
+    '''
+    return unhexlify('%0*x' % (2 * length, value))
+
+def xor_shares(shares):
+    '''
+    Arguments:
+    shares - non-empty list of byte strings, all of the same length
+
+    Returns: the xor of all of the shares, as a byte string. The
+    shares are xored as big integers, so the work is done a machine
+    word rather than a byte at a time. Raises a ValueError if the
+    shares are not all the same length.
+    '''
+    if not shares:
+        raise ValueError('There must be at least one share to combine')
+    length = len(shares[0])
+    if any(len(share) != length for share in shares):
+        raise ValueError('Shares must all be the same length')
+    if length == 0:
+        return ''
+    if len(shares) == 1:
+        return shares[0]
+
+    value = 0
+    for share in shares:
+        value ^= _to_int(share)
+    return _to_bytes(value, length)
+
+def xor_share_lists(share_lists):
+    '''
+    Arguments:
+    share_lists - list of non-empty lists of byte strings, such as the
+        shares of the children of AND nodes of a batch of cells. All of
+        the shares in all of the lists must be the same length, but the
+        lists may differ in length.
+
+    Returns: a list containing the xor of the shares of each list, in
+    order. The i-th shares of all the lists are concatenated and xored
+    as a single integer, so combining the shares of a batch takes one
+    integer xor per share in the longest list rather than one per
+    share in the batch. Raises a ValueError if the shares are not all
+    the same length or a list is empty.
+    '''
+    if not share_lists:
+        return []
+    if not all(share_lists):
+        raise ValueError('There must be at least one share to combine')
+    length = len(share_lists[0][0])
+    if any(len(share) != length for shares in share_lists for share in shares):
+        raise ValueError('Shares must all be the same length')
+    if length == 0:
+        return [''] * len(share_lists)
+
+    #xor with zero leaves a share unchanged, so shorter lists are
+    #padded with zero shares
+    padding = '\x00' * length
+    columns = max(len(shares) for shares in share_lists)
+    value = 0
+    for i in xrange(columns):
+        value ^= _to_int(''.join([shares[i] if i < len(shares) else padding
+                                  for shares in share_lists]))
+    combined = _to_bytes(value, length * len(share_lists))
+    return [combined[i:i+length]
+            for i in xrange(0, len(combined), length)]
@@ -0,0 +1,87 @@
+## **************
+##  Copyright 2026 MIT Lincoln Laboratory
+##  Project: PACE
+##  Authors: ATLH
+##  Description: Microbenchmark of share combination
+##  Modifications:
+##  Date         Name  Modification
+##  ----         ----  ------------
+##  17 Oct 2026  ATLH    Original file
+## **************
+
+import os
+import sys
+this_dir = os.path.dirname(os.path.dirname(__file__))
+base_dir = os.path.join(this_dir, '../..')
+sys.path.append(base_dir)
+
+import timeit
+from optparse import OptionParser
+from pace.encryption.visibility.share_combine import xor_shares, xor_share_lists
+
+def generator_xor(bytestring1, bytestring2):
+    '''
+    The byte by byte xor that secret_vis_tree.byte_xor used to be,
+    kept as the baseline for the benchmark
+    '''
+    byte_array1 = bytearray(bytestring1)
+    byte_array2 = bytearray(bytestring2)
+    return bytes(bytearray(b1 ^ b2 for (b1, b2) in zip(byte_array1, byte_array2)))
+
+def benchmark(num_cells, num_shares, share_length, repeat):
+    '''
+    Arguments:
+    num_cells - number of cells in the batch
+    num_shares - number of shares combined for each cell, as for
+        an AND node with num_shares children
+    share_length - length of the shares in bytes
+    repeat - number of times each method is timed
+
+    Returns: list of (method, seconds) tuples with the best time to
+    combine the shares of the whole batch with each method
+    '''
+    share_lists = [[os.urandom(share_length) for i in xrange(num_shares)]
+                   for j in xrange(num_cells)]
+
+    def pairwise():
+        for shares in share_lists:
+            combined = shares[0]
+            for share in shares[1:]:
+                combined = generator_xor(combined, share)
+
+    def per_cell():
+        for shares in share_lists:
+            xor_shares(shares)
+
+    def batch():
+        xor_share_lists(share_lists)
+
+    return [(name, min(timeit.repeat(method, number=1, repeat=repeat)))
+            for (name, method) in [('generator byte_xor', pairwise),
+                                   ('xor_shares', per_cell),
+                                   ('xor_share_lists', batch)]]
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--cells', dest='num_cells',
+                      type='int', default=10000,
+                      help='Number of cells in a batch. Default: 10000')
+    parser.add_option('--shares', dest='num_shares',
+                      type='int', default=3,
+                      help='Number of shares combined per cell. Default: 3')
+    parser.add_option('--length', dest='share_length',
+                      type='int', default=16,
+                      help='Length of the shares in bytes. Default: 16')
+    parser.add_option('--repeat', dest='repeat',
+                      type='int', default=5,
+                      help='Number of times each method is timed. Default: 5')
+    (options, args) = parser.parse_args()
+
+    results = benchmark(options.num_cells, options.num_shares,
+                        options.share_length, options.repeat)
+    baseline = results[0][1]
+    for (name, seconds) in results:
+        print '%-20s %10.4fs %8.1fx' % (name, seconds, baseline / seconds)
+
+if __name__ == "__main__":
+    main()
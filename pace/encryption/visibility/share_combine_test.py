@@ -0,0 +1,66 @@
+## **************
+##  Copyright 2026 MIT Lincoln Laboratory
+##  Project: PACE
+##  Authors: ATLH
+##  Description: Unit tests for share_combine
+##  Modifications:
+##  Date         Name  Modification
+##  ----         ----  ------------
+##  17 Oct 2026  ATLH    Original file
+## **************
+
+import os
+import sys
+this_dir = os.path.dirname(os.path.dirname(__file__))
+base_dir = os.path.join(this_dir, '../..')
+sys.path.append(base_dir)
+
+import random
+import unittest
+from pace.encryption.visibility.share_combine import xor_shares, xor_share_lists
+
+def slow_xor(shares):
+    '''
+    Byte by byte xor to check the results against
+    '''
+    result = bytearray(len(shares[0]))
+    for share in shares:
+        for (i, b) in enumerate(bytearray(share)):
+            result[i] ^= b
+    return str(result)
+
+def random_share(length):
+    return ''.join(chr(random.randint(0, 255)) for i in xrange(length))
+
+class ShareCombineTest(unittest.TestCase):
+
+    def test_xor_shares(self):
+        '''
+        Tests xoring lists of shares, including ones with leading
+        zero bytes
+        '''
+        for length in [1, 16, 33]:
+            for count in [1, 2, 5]:
+                shares = [random_share(length) for i in range(count)]
+                self.assertEqual(xor_shares(shares), slow_xor(shares))
+        share = '\x00\x00' + random_share(14)
+        self.assertEqual(xor_shares([share, '\x00' * 16]), share)
+        self.assertEqual(xor_shares([share, share]), '\x00' * 16)
+        self.assertEqual(xor_shares(['', '']), '')
+
+    def test_xor_share_lists(self):
+        '''
+        Tests xoring a batch of lists of shares of different lengths
+        '''
+        share_lists = [[random_share(16) for i in range(count)]
+                       for count in [3, 1, 2, 5, 2]]
+        self.assertEqual(xor_share_lists(share_lists),
+                         [slow_xor(shares) for shares in share_lists])
+        self.assertEqual(xor_share_lists([]), [])
+        self.assertEqual(xor_share_lists([[''], ['', '']]), ['', ''])
+
+    def test_errors(self):
+        self.assertRaises(ValueError, xor_shares, [])
+        self.assertRaises(ValueError, xor_shares, ['ab', 'abc'])
+        self.assertRaises(ValueError, xor_share_lists, [['ab'], []])
+        self.assertRaises(ValueError, xor_share_lists, [['ab'], ['ab', 'abc']])
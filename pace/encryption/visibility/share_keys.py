@@ -0,0 +1,230 @@
+## **************
+##  Copyright 2026 MIT Lincoln Laboratory
+##  Project: PACE
+##  Authors: ATLH
+##  Description: Reuse of cell keys across cells with the same
+##               visibility label
+##  Modifications:
+##  Date         Name  Modification
+##  ----         ----  ------------
+##  17 Oct 2026  ATLH    Original file
+## **************
+
+import os
+import sys
+this_dir = os.path.dirname(os.path.dirname(__file__))
+base_dir = os.path.join(this_dir, '../..')
+sys.path.append(base_dir)
+
+import time
+import threading
+from Crypto import Random
+from pyaccumulo import Mutation
+
+from pace.common.lru_cache import LRUCache
+from pace.common.common_utils import get_single_entry
+from pace.encryption.encryption_exceptions import DecryptionException
+from pace.encryption.visibility.secret_vis_tree import SecretVisTreeEncryptor
+
+#length in bytes of the random references to share keys stored in cells
+KEY_REF_LENGTH = 16
+
+class MemoryShareKeyStore(object):
+    """
+    Share key store that keeps the encrypted shares of share keys in
+    memory. Cells encrypted with it can only be decrypted by the same
+    process, so it is mostly useful for testing.
+
+    Share key stores implement two methods:
+        put(key_ref, vis_expr, encrypted_shares) - stores the encrypted
+            shares of the key referred to by key_ref, which was shared
+            according to the visibility expression vis_expr
+        get(key_ref) - returns the (vis_expr, encrypted_shares) tuple
+            stored for key_ref, or None if there is none
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def __reduce__(self):
+        #a copy in another process would not see the shares written here,
+        #nor this process the shares written there
+        raise TypeError('MemoryShareKeyStore cannot be shared between processes')
+
+    def put(self, key_ref, vis_expr, encrypted_shares):
+        self._entries[key_ref] = (vis_expr, encrypted_shares)
+
+    def get(self, key_ref):
+        return self._entries.get(key_ref)
+
+class AccumuloShareKeyStore(object):
+    """
+    Share key store (see MemoryShareKeyStore) that keeps the encrypted
+    shares of share keys in an Accumulo table. Each key is one entry,
+    with the key reference as the row and the visibility expression the
+    key was shared with as the visibility label, so Accumulo only
+    returns the shares to users who could decrypt them.
+    """
+
+    def __init__(self, conn, table='__VIS_SHARE_KEYS__'):
+        """
+        Arguments:
+        conn - connection to the Accumulo instance holding the table
+        table - (optional) name of the table, created if it does not
+            exist, defaults to '__VIS_SHARE_KEYS__'
+        """
+        self.conn = conn
+        self.table = table
+        if not conn.table_exists(table):
+            conn.create_table(table)
+
+    def put(self, key_ref, vis_expr, encrypted_shares):
+        mut = Mutation(key_ref)
+        mut.put(cf='shares', cq='', cv=vis_expr, val=encrypted_shares)
+        self.conn.write(self.table, mut)
+
+    def get(self, key_ref):
+        entry = get_single_entry(self.conn, self.table, row=key_ref)
+        if entry is None:
+            return None
+        return (entry.cv, entry.val)
+
+class _ShareKey(object):
+    """
+    A share key in use for encryption, with the number of cells it has
+    encrypted and the time it was created
+    """
+    def __init__(self, key_ref, cell_key):
+        self.key_ref = key_ref
+        self.cell_key = cell_key
+        self.created = time.time()
+        self.uses = 0
+
+class ShareKeyManager(object):
+    """
+    Keeps one cell key for each visibility label, rather than one for
+    every cell, so that the key only needs to be split into shares and
+    the shares encrypted once. The encrypted shares are written to a
+    share key store, and cells only carry a short random reference to
+    them.
+
+    A key is replaced by a new one once it has encrypted max_uses cells,
+    once it is max_age seconds old, or once the key_epoch of the key
+    object (see encryption_pki.py) changes, so revoked attribute keys
+    are not used for new cells.
+
+    Cell keys recovered for decryption are cached, so a manager must
+    only be used with the keys of a single user.
+    """
+
+    def __init__(self, store, max_uses=10000, max_age=3600, max_labels=1024):
+        """
+        Arguments:
+        store - share key store, such as an AccumuloShareKeyStore
+        max_uses - (optional) number of cells encrypted with a key
+            before it is replaced, defaults to 10000
+        max_age - (optional) number of seconds a key is used for before
+            it is replaced, defaults to 3600
+        max_labels - (optional) number of labels for which keys are
+            kept, and number of keys cached for decryption, defaults
+            to 1024
+        """
+        if max_uses < 1 or max_age <= 0:
+            raise ValueError('max_uses and max_age must be positive')
+        self.store = store
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self._encryption_keys = LRUCache(max_labels)
+        self._decryption_keys = LRUCache(max_labels)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Returns: the state of the manager to pickle. The lock and the
+        key caches, which hold locks of their own, cannot be pickled
+        and are left out. Copies of the manager, for example in the
+        worker processes of AccumuloEncrypt.encrypt_many, so make their
+        own keys, and max_uses is not exceeded by several copies using
+        the same key.
+        """
+        state = self.__dict__.copy()
+        for name in ('_lock', '_encryption_keys', '_decryption_keys'):
+            del state[name]
+        state['max_labels'] = self._encryption_keys.max_size
+        return state
+
+    def __setstate__(self, state):
+        max_labels = state.pop('max_labels')
+        self.__dict__.update(state)
+        self._encryption_keys = LRUCache(max_labels)
+        self._decryption_keys = LRUCache(max_labels)
+        self._lock = threading.Lock()
+
+    def encryption_key(self, vis_expr, key_container, leaf_class):
+        """
+        Arguments:
+        vis_expr - visibility expression of the cell to be encrypted
+        key_container - Keytor object used to look up attribute keys
+        leaf_class - encryption class for the leaves of the share tree
+
+        Returns: (key_ref, cell_key) tuple of the key to encrypt the
+        cell with and the reference to store in the cell.
+        """
+        label = (key_container.key_id, leaf_class.name, vis_expr,
+                 getattr(key_container.key_object, 'key_epoch', 0))
+        with self._lock:
+            share_key = self._encryption_keys.get(label)
+            if share_key is None or share_key.uses >= self.max_uses or\
+               time.time() - share_key.created >= self.max_age:
+                share_key = self._new_key(vis_expr, key_container, leaf_class)
+                self._encryption_keys.put(label, share_key)
+            share_key.uses += 1
+            return (share_key.key_ref, share_key.cell_key)
+
+    def _new_key(self, vis_expr, key_container, leaf_class):
+        """
+        Returns: a new _ShareKey for vis_expr, whose shares have been
+        written to the store
+        """
+        cell_key = Random.get_random_bytes(key_container.cell_key_length)
+        encrypted_shares = SecretVisTreeEncryptor.encrypt_secret_shares(vis_expr,
+                                                                       cell_key,
+                                                                       key_container,
+                                                                       leaf_class)
+        key_ref = Random.get_random_bytes(KEY_REF_LENGTH)
+        self.store.put(key_ref, vis_expr, encrypted_shares)
+        return _ShareKey(key_ref, cell_key)
+
+    def decryption_key(self, key_ref, vis_expr, key_container, leaf_class):
+        """
+        Arguments:
+        key_ref - reference to the share key stored in the cell
+        vis_expr - visibility expression of the cell to be decrypted
+        key_container - Keytor object used to look up attribute keys
+        leaf_class - encryption class for the leaves of the share tree
+
+        Returns: the cell key referred to by key_ref, or None if the
+        user's attributes do not satisfy vis_expr. Raises a
+        DecryptionException if the key is not in the store or was
+        not shared according to vis_expr.
+        """
+        cache_key = (key_ref, vis_expr, key_container.key_id, leaf_class.name,
+                     getattr(key_container.key_object, 'key_epoch', 0))
+        cell_key = self._decryption_keys.get(cache_key)
+        if cell_key is not None:
+            return cell_key
+
+        entry = self.store.get(key_ref)
+        if entry is None:
+            raise DecryptionException('The share key for this cell is not in the share key store')
+        (stored_vis_expr, encrypted_shares) = entry
+        if stored_vis_expr != vis_expr:
+            raise DecryptionException('The share key for this cell was not shared '+\
+                                      'according to its visibility label')
+        cell_key = SecretVisTreeEncryptor.decrypt_secret_shares(vis_expr,
+                                                               encrypted_shares,
+                                                               key_container,
+                                                               leaf_class)
+        if cell_key is not None:
+            self._decryption_keys.put(cache_key, cell_key)
+        return cell_key
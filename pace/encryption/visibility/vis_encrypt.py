@@ -15,16 +15,44 @@ this_dir = os.path.dirname(os.path.dirname(__file__))
 base_dir = os.path.join(this_dir, '../..')
 sys.path.append(base_dir)
 
+import struct
 from Crypto import Random
 from Crypto.Cipher import AES
 from pyaccumulo import Cell
 from pace.encryption.enc_mutation import EncMutation, EncCell
 from pace.encryption.vars import CELL_MUT_MAPPING, CELL_ORDER 
 from pace.encryption.AES_encrypt import Pycrypto_AES_CTR, Pycrypto_AES_OFB, \
-    Pycrypto_AES_CFB, Pycrypto_AES_CBC, Pycrypto_AES_GCM
+    Pycrypto_AES_CFB, Pycrypto_AES_CBC, Pycrypto_AES_GCM, seal_envelope, open_envelope
 from pace.encryption.abstract_encrypt import AbstractEncrypt, \
     EncryptionException, DecryptionException, Identity_AccEncrypt
+from pace.encryption.encryption_exceptions import UnsatisfiableLabelException
 from pace.encryption.visibility.secret_vis_tree import SecretVisTreeEncryptor
+from pace.encryption.visibility.vis_parser import accumulo_expression
+
+SHARES_LENGTH = struct.Struct('>I')
+
+#set in the shares length of ciphertexts whose cell key is a share key
+#(see visibility/share_keys.py), in which case the rest of the field is 
+#the length of the reference to the share key that follows it 
+KEY_REF_FLAG = 0x80000000
+
+#set in the shares length of ciphertexts whose encrypted shares are a 
+#binary share tree (see SHARE_TREE_FORMAT in secret_vis_tree.py) rather
+#than text formatted like the visibility label
+BINARY_SHARES_FLAG = 0x40000000
+
+#set in the shares length of ciphertexts of cells whose visibility label
+#has threshold terms. Such cells are written to Accumulo with the 
+#equivalent column visibility (see accumulo_expression in vis_parser.py),
+#so the label the cell key was split with follows the shares length,
+#preceded by its length as LABEL_LENGTH, and the rest of the field is 
+#the length of the shares (or key reference) after it
+LABEL_FLAG = 0x20000000
+LABEL_LENGTH = struct.Struct('>H')
+SHARES_LENGTH_MASK = ~(KEY_REF_FLAG | BINARY_SHARES_FLAG | LABEL_FLAG)
+
+_UNSATISFIABLE_MESSAGE = "The key object does not contain keys for the "+\
+                         "necessary attributes to decrypt this cell"
 
 class Vis_Encrypt_Mixin(AbstractEncrypt):
     
@@ -37,19 +65,182 @@ class Vis_Encrypt_Mixin(AbstractEncrypt):
               to obtain the keys.
         vis_expr - visibility expression of the cell to be encrypted
         
-        Returns - the encrypted shares concatenated with the ciphertext
-        or the field of the cell being encrypted 
-        '''
-        #generate a random key for the cell 
-        cell_key = Random.get_random_bytes(key_id.cell_key_length)
-        #break into shares and then encrypt
-        encrypted_shares = SecretVisTreeEncryptor.encrypt_secret_shares(vis_expr,
-                                                                 cell_key,
-                                                                 key_id,
-                                                                 cls.leaf_class)
-        #encrypt the plaintext 
-        ciphertext = cls._encrypt(plaintext, cell_key)
-        return encrypted_shares + "#" + ciphertext
+        Returns - the length of the encrypted shares, the encrypted shares
+        and the ciphertext of the field of the cell being encrypted,
+        wrapped in the binary envelope (see AES_encrypt.py). If key_id 
+        has a ShareKeyManager, the cell key is the share key for the
+        label and a reference to it takes the place of the shares. If
+        vis_expr has threshold terms, it is stored before the shares
+        (see LABEL_FLAG).
+        '''
+        return cls._encrypt_many_with_shares([plaintext], key_id, [vis_expr])[0]
+
+    @classmethod
+    def _encrypt_many_with_shares(cls, plaintexts, key_id, vis_exprs):
+        '''
+        Arguments:
+        plaintexts - list of plaintext portions of cells to be encrypted
+        key_id - the keytor object used to obtain the keys
+        vis_exprs - list of the visibility expressions of the cells, 
+              in the same order as plaintexts
+        
+        Returns - list of ciphertexts as returned by _encrypt_with_shares,
+        in the same order as plaintexts. The cell keys are drawn at once,
+        and cells with the same visibility expression are split into
+        shares together, so each label is parsed and its attribute keys 
+        looked up once per batch rather than once per cell.
+        '''
+        if not plaintexts:
+            return []
+
+        if key_id.share_keys is not None:
+            #reuse the cell key for the label, storing only a reference to it
+            cell_keys = []
+            headers = []
+            for vis_expr in vis_exprs:
+                (key_ref, cell_key) = key_id.share_keys.encryption_key(vis_expr,
+                                                                       key_id,
+                                                                       cls.leaf_class)
+                cell_keys.append(cell_key)
+                headers.append(cls._shares_header(KEY_REF_FLAG, key_ref, vis_expr))
+        else:
+            #generate a random key for each cell 
+            length = key_id.cell_key_length
+            randoms = Random.get_random_bytes(length * len(plaintexts))
+            cell_keys = [randoms[i*length:(i+1)*length] 
+                         for i in xrange(len(plaintexts))]
+            #break into shares and then encrypt, one label at a time
+            groups = {}
+            for (i, vis_expr) in enumerate(vis_exprs):
+                groups.setdefault(vis_expr, []).append(i)
+            headers = [None] * len(plaintexts)
+            for (vis_expr, indices) in groups.iteritems():
+                shares = SecretVisTreeEncryptor.encrypt_secret_shares_many(vis_expr,
+                                                 [cell_keys[i] for i in indices],
+                                                 key_id,
+                                                 cls.leaf_class,
+                                                 binary=True)
+                for (i, encrypted_shares) in zip(indices, shares):
+                    headers[i] = cls._shares_header(BINARY_SHARES_FLAG, 
+                                                    encrypted_shares, vis_expr)
+        #encrypt the plaintexts; the cell keys are random, so there is 
+        #no key version to record
+        return [seal_envelope(header + cls._encrypt(plaintext, cell_key),
+                              cls.name, 0, cls.iv_length)
+                for (plaintext, cell_key, header) in zip(plaintexts,
+                                                         cell_keys,
+                                                         headers)]
+    
+    @staticmethod
+    def _shares_header(flags, shares, vis_expr):
+        '''
+        Arguments:
+        flags - the flags to set in the shares length
+        shares - the encrypted shares or share key reference of a cell
+        vis_expr - visibility expression of the cell
+        
+        Returns - the shares length and shares of the cell, preceded by
+        vis_expr if it has threshold terms (see LABEL_FLAG)
+        '''
+        if accumulo_expression(vis_expr) == vis_expr:
+            return SHARES_LENGTH.pack(flags | len(shares)) + shares
+        return SHARES_LENGTH.pack(flags | LABEL_FLAG | len(shares)) +\
+               LABEL_LENGTH.pack(len(vis_expr)) + vis_expr + shares
+    
+    @classmethod
+    def _split_shares(cls, ciphertext):
+        '''
+        Arguments:
+        ciphertext - string that contains the encrypted shares and
+          the ciphertext of the portion of the cell, either in the 
+          binary envelope format or in the legacy format where they
+          are delineated by the first '#'
+          
+        Returns - (encrypted_shares, binary, key_ref, ciphertext, label) 
+        tuple, for the envelope format the ciphertext is a buffer over the
+        string passed in. binary is whether the encrypted shares are a 
+        binary share tree. If the cell key is a share key, encrypted_shares
+        is None and key_ref is the reference to the share key; otherwise 
+        key_ref is None. label is the visibility label stored with the 
+        shares (see LABEL_FLAG), or None if there is none. 
+        '''
+        #legacy share expressions always start with a term or a parenthesis,
+        #while the envelope format starts with the length of the shares
+        if ciphertext[:1] in ('"', '('):
+            encrypted_shares = ciphertext.split('#')[0] 
+            return (encrypted_shares, False, None, 
+                    ciphertext[len(encrypted_shares)+1:], None)
+        
+        (payload, _) = open_envelope(ciphertext, cls.name, cls.iv_length)
+        if len(payload) < SHARES_LENGTH.size:
+            raise DecryptionException('Ciphertext is not properly formatted: it '+\
+                                      'does not contain encrypted shares')
+        (shares_length,) = SHARES_LENGTH.unpack_from(payload)
+        shares_start = SHARES_LENGTH.size
+        label = None
+        if shares_length & LABEL_FLAG:
+            shares_start += LABEL_LENGTH.size
+            if len(payload) < shares_start:
+                raise DecryptionException('Ciphertext is not properly formatted: it '+\
+                                          'does not contain a visibility label')
+            (label_length,) = LABEL_LENGTH.unpack_from(payload, SHARES_LENGTH.size)
+            label = payload[shares_start:shares_start + label_length]
+            shares_start += label_length
+        shares_end = shares_start + (shares_length & SHARES_LENGTH_MASK)
+        if len(payload) < shares_end:
+            raise DecryptionException('Ciphertext is not properly formatted: it '+\
+                                      'does not contain encrypted shares')
+        shares = payload[shares_start:shares_end]
+        if shares_length & KEY_REF_FLAG:
+            return (None, False, shares, buffer(payload, shares_end), label)
+        return (shares, bool(shares_length & BINARY_SHARES_FLAG), None,
+                buffer(payload, shares_end), label)
+    
+    @staticmethod
+    def _shares_label(label, vis_expr):
+        '''
+        Arguments:
+        label - the visibility label stored with the shares of a cell, 
+          or None
+        vis_expr - the column visibility of the cell
+        
+        Returns - the label the cell key was split with: label if there
+        is one, otherwise vis_expr. Raises a DecryptionException if the 
+        column visibility of the cell is not the one label is written 
+        to Accumulo with. 
+        '''
+        if label is None:
+            return vis_expr
+        if accumulo_expression(label) != vis_expr:
+            raise DecryptionException('The visibility label stored with the '+\
+                                      'encrypted shares does not match the '+\
+                                      'visibility of the cell')
+        return label
+    
+    @classmethod
+    def attribute_key_versions(cls, ciphertext, vis_expr):
+        '''
+        Arguments:
+        ciphertext - string that contains the encrypted shares and
+          the ciphertext of the portion of the cell
+        vis_expr - visibility expression of the cell
+        
+        Returns - list of the (attribute, version) pairs of the attribute
+        keys that the shares of the cell key are encrypted under, so
+        that they can be retrieved before the cell is decrypted. The 
+        list is empty for cells encrypted with share keys and for cells
+        that are not properly formatted, which fail when decrypted. 
+        '''
+        try:
+            (encrypted_shares, binary, key_ref, _, label) = cls._split_shares(ciphertext)
+            vis_expr = cls._shares_label(label, vis_expr)
+        except DecryptionException:
+            return []
+        if encrypted_shares is None:
+            return []
+        return SecretVisTreeEncryptor.leaf_key_versions(vis_expr, 
+                                                        encrypted_shares,
+                                                        binary)
     
     @classmethod
     def _decrypt_with_shares(cls, ciphertext, key_id, vis_expr):
@@ -60,20 +251,38 @@ class Vis_Encrypt_Mixin(AbstractEncrypt):
         key - the keytor object, see decrypt_mutation for more details
         vis_expr - visibility expression of the cell to be encrypted
         
-        Returns - the plaintext of the cell that was encrypted
+        Returns - the plaintext of the cell that was encrypted. Raises
+        an UnsatisfiableLabelException if the user's attributes do not
+        satisfy vis_expr, without reading the cell if the label is 
+        already known to be unsatisfiable (see label_unsatisfiable in
+        secret_vis_tree.py). 
         '''
+        if SecretVisTreeEncryptor.label_unsatisfiable(vis_expr, key_id):
+            raise UnsatisfiableLabelException(_UNSATISFIABLE_MESSAGE)
+        
         #recover the cell_key 
-        encrypted_shares = ciphertext.split('#')[0] 
-        ciphertext = ciphertext[len(encrypted_shares)+1:]
-        cell_key = SecretVisTreeEncryptor.decrypt_secret_shares(vis_expr,
-                                                         encrypted_shares,
-                                                         key_id, 
-                                                         cls.leaf_class)
+        (encrypted_shares, binary, key_ref, ciphertext, label) = cls._split_shares(ciphertext)
+        if label is not None:
+            vis_expr = cls._shares_label(label, vis_expr)
+            if SecretVisTreeEncryptor.label_unsatisfiable(vis_expr, key_id):
+                raise UnsatisfiableLabelException(_UNSATISFIABLE_MESSAGE)
+        if key_ref is not None:
+            if key_id.share_keys is None:
+                raise DecryptionException('The cell key is a share key, but no '+\
+                                          'share key store is configured')
+            cell_key = key_id.share_keys.decryption_key(key_ref, vis_expr, 
+                                                        key_id, cls.leaf_class)
+        else:
+            cell_key = SecretVisTreeEncryptor.decrypt_secret_shares(vis_expr,
+                                                             encrypted_shares,
+                                                             key_id, 
+                                                             cls.leaf_class,
+                                                             binary)
         if cell_key is None:
-            raise DecryptionException("The key object does not contain keys for the necessary attributes to decrypt this cell")
+            raise UnsatisfiableLabelException(_UNSATISFIABLE_MESSAGE)
 
         plaintext = cls._decrypt(ciphertext, cell_key)
-        return plaintext
+        return str(plaintext)
     
     @classmethod
     def encrypt_mutation(cls, mutation, key_id, cell_sections):
@@ -97,14 +306,38 @@ class Vis_Encrypt_Mixin(AbstractEncrypt):
               This is done for each update in the list of updates.   
         
         """
-        ptexts = EncMutation.concatenate_cell_section_values(mutation, cell_sections)
-        vis_exprs = mutation.update_dict['colVisibility']
-        if not all([vis != '' for vis in vis_exprs]):
-            raise EncryptionException("There are rows without visibility labels, "+\
-                                      "cannot encrypt the mutation")
-        ctexts = [cls._encrypt_with_shares(ptext, key_id, vis) 
-                  for (ptext, vis) in zip(ptexts,vis_exprs)] 
-        return ctexts
+        return cls.encrypt_mutations([mutation], key_id, cell_sections)[0]
+    
+    @classmethod
+    def encrypt_mutations(cls, mutations, key_id, cell_sections):
+        """
+        Encrypts the updates of all the mutations as encrypt_mutation
+        does, returning a list with the list of ciphertexts of each
+        mutation. The updates of all the mutations are encrypted 
+        together, grouped by visibility label (see 
+        _encrypt_many_with_shares).
+        """
+        ptexts = []
+        vis_exprs = []
+        counts = []
+        for mutation in mutations:
+            mut_ptexts = EncMutation.concatenate_cell_section_values(mutation,
+                                                                     cell_sections)
+            mut_vis_exprs = mutation.update_dict['colVisibility']
+            if not all([vis != '' for vis in mut_vis_exprs]):
+                raise EncryptionException("There are rows without visibility labels, "+\
+                                          "cannot encrypt the mutation")
+            ptexts.extend(mut_ptexts)
+            vis_exprs.extend(mut_vis_exprs)
+            counts.append(len(mut_ptexts))
+
+        ctexts = cls._encrypt_many_with_shares(ptexts, key_id, vis_exprs)
+        result = []
+        start = 0
+        for count in counts:
+            result.append(ctexts[start:start + count])
+            start += count
+        return result
     
         
     @classmethod
@@ -139,7 +372,7 @@ class Vis_Encrypt_Mixin(AbstractEncrypt):
                                       "cannot decrypt the mutation")
         ptexts = [cls._decrypt_with_shares(ctext, key_id, vis) 
                   for (ctext, vis) in zip(ctexts,vis_exprs)] 
-        split_values = EncMutation.split_values(ptexts)
+        split_values = EncMutation.split_values(ptexts, len(cell_sections))
         for sec, values in zip(cell_sections, split_values):
             dec_mutation[sec] = list(values) 
             
@@ -188,7 +421,7 @@ class Vis_Encrypt_Mixin(AbstractEncrypt):
         ptext = cls._decrypt_with_shares(cell_dict[CELL_MUT_MAPPING[cell_location]],
                                          key,
                                          vis_expr)
-        split_value = EncCell.split_value_by_cell_string(ptext)
+        split_value = EncCell.split_value_by_cell_string(ptext, len(cell_sections))
         for (sec, value) in zip(cell_sections, split_value):
             dec_cell[CELL_MUT_MAPPING[sec]] = value
             
@@ -196,6 +429,10 @@ class Vis_Encrypt_Mixin(AbstractEncrypt):
     def encrypt_row(row, key):
         raise NotImplementedError("CEABAC does not currently support deterministic encryption")
     
+    @classmethod
+    def encrypt_rows(cls, rows, key, memo=None):
+        raise NotImplementedError("CEABAC does not currently support deterministic encryption")
+    
     @classmethod
     def encrypt_cols(cols, key_container, cell_location, cell_sections):
         raise NotImplementedError("CEABAC does not currently support deterministic encryption")
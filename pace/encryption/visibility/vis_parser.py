@@ -17,9 +17,13 @@ this_dir = os.path.dirname(os.path.dirname(__file__))
 base_dir = os.path.join(this_dir, '../..')
 sys.path.append(base_dir)
  
+import re
+import itertools
 from enum import IntEnum
 import StringIO
 
+from pace.common.lru_cache import LRUCache
+
 class VisibilityFormatException(Exception):
     """ Exception raised when unable to process a vis label
         
@@ -47,11 +51,17 @@ class NodeType(IntEnum):
          
        AND: Node for an and clause, children are either other OR/AND
          nodes or terminal TERM nodes.
+         
+       THRESHOLD: Node for a k-of-n clause, satisfied when at least
+         threshold of its children are. Written as the threshold 
+         followed by the children in braces, separated by commas: 
+         '2{a,b,c}' is satisfied by any two of a, b and c. 
     """
     EMPTY = 0
     TERM = 1
     OR = 2
     AND = 3
+    THRESHOLD = 4
 
 VALID_CHAR = ['_','-',':','.','/']
 
@@ -61,9 +71,12 @@ class VisNode(object):
     type of the node and the start and the end locations of
     the term in the expression, does not actually store the 
     term itself. Can have multiple children if OR/AND node:
-    for example a&b&c would have three children. 
+    for example a&b&c would have three children. THRESHOLD nodes
+    also store the number of children that must be satisfied. 
     """
-    def __init__(self, start, end=None, type=NodeType.TERM):
+    __slots__ = ['type', 'start', 'end', 'children', 'threshold']
+    
+    def __init__(self, start, end=None, type=NodeType.TERM, threshold=None):
         '''
         Arguments:
           start: integer representing the start of the term,
@@ -75,9 +88,12 @@ class VisNode(object):
                  to be one more than the start.
           type:  The type of the node as specified in NodeType. 
                  Defaults to TERM.
+          threshold: for THRESHOLD nodes, the number of children
+                 that must be satisfied. Defaults to None.
         '''
         self.type = type 
         self.start = start
+        self.threshold = threshold
         self.children = []
         if end: 
             self.end = end
@@ -92,7 +108,8 @@ class VisNode(object):
         
         return VisNode(start=node.start, 
                        end=node.end,
-                       type=node.type)
+                       type=node.type,
+                       threshold=node.threshold)
         
     def add(self, child):
         """
@@ -122,6 +139,21 @@ class VisTree(object):
         self.root = root
         self.expression = expression
                       
+    def get_terms(self):
+        """
+        Returns: the set of terms (without quotes) that 
+        appear in the expression
+        """
+        terms = set()
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            if node.type == NodeType.TERM:
+                terms.add(node.getTerm(self.expression))
+            else:
+                nodes.extend(node.children)
+        return terms
+                      
     def __str__(self):
         """
         Overloading str function, does not simply
@@ -154,11 +186,20 @@ class VisTree(object):
        
         if root.type == NodeType.TERM:
             out_put.write(expression[root.start:root.end])
+        elif root.type == NodeType.THRESHOLD:
+            out_put.write('%d{' % root.threshold)
+            sep = ''
+            for c in root.children:
+                out_put.write(sep)
+                self._stringify(c, expression, out_put)
+                sep = ','
+            out_put.write('}')
         else:
             sep = ''
             for c in root.children:
                 out_put.write(sep)
-                parens = (c.type != NodeType.TERM) and (root.type != c.type)   
+                parens = (c.type not in (NodeType.TERM, NodeType.THRESHOLD)) and\
+                         (root.type != c.type)   
                 if parens:
                     out_put.write("(")
                 self._stringify(c, expression, out_put)
@@ -171,10 +212,22 @@ class VisTree(object):
                     
         
                 
+#tokens of visibility expressions: an operator, parenthesis, brace or
+#comma, a quoted term (its opening quote and body, then its closing 
+#quote if there is one), or a run of unquoted term characters
+_TOKEN = re.compile(r'([&|(){},])|("(?:[^"\\]|\\.)*)("?)|([^&|(){},"]+)', re.DOTALL)
+#escape sequences within the body of a quoted term
+_ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+
+_OPERATORS = {'&' : NodeType.AND, '|' : NodeType.OR}
+
 class VisParser(object):
     """
     Contains the logic for parsing visibility labels and turning into
-    VisTree
+    VisTree. Expressions are split into tokens with a regular 
+    expression and parsed with an explicit stack for the enclosing
+    parenthesized terms and thresholds, so deeply nested labels do 
+    not recurse. 
     """
     
     def _getTreeType(self, node, expression):
@@ -190,9 +243,6 @@ class VisParser(object):
           Raises VisibilityFormatException if the visibility 
           is ill-formed. 
         """
-        self._index = 0  #current parse location
-        self._parens = 0 #number of parenthesis encountered
-        
         if len(expression) == 0:
             return None
         
@@ -201,21 +251,8 @@ class VisParser(object):
         if node is None:
           raise VisibilityFormatException("operator or missing parens: %s" % (expression))
         
-        if self._parens != 0: 
-          raise VisibilityFormatException("parenthesis mis-match: %s" % (expression))
-        
         return self._getTreeType(node, expression)
     
-    def _isValidAuthChar(self, c):
-        """
-        Determines if the character c is an authorized character for the 
-        visibility field
-        """
-        return any([c >= 'a', c <= 'z',
-                    c >= 'A', c <= 'Z',
-                    c >= '0', c <= '9',
-                    c in VALID_CHAR])
-
     def _processTerm(self, start, end, node_expr, expression):
         """
         Arguments:
@@ -240,6 +277,30 @@ class VisParser(object):
     def _create_node(self, start, type):
         return VisNode(start = start, type = type)
     
+    def _close_subterm(self, subtermStart, end, expr, result, expression):
+        """
+        Arguments:
+            subtermStart - start of the last subterm
+            end - end of the last subterm
+            expr - Existing node of the last subterm or None
+            result - node of the enclosing AND or OR, or None
+            expression - the overall expression 
+        
+        Returns: the node of the term enclosed in parentheses or 
+          braces, or between commas, that ends at end
+        """
+        child = self._processTerm(subtermStart, end, expr, expression)
+        if result is not None:
+            #if the child is the same type as parent (result), promote the child's children 
+            if result.type == child.type:
+                for c in child.children:
+                    result.add(c)
+            else:   
+                result.add(child)
+            result.end = end 
+            child = result
+        return child
+    
     def _parse(self, expression):
         """
         Arguments:
@@ -247,109 +308,133 @@ class VisParser(object):
             
         Returns: Root node to the newly parsed visibility tree
         """
+        stack = []                    #(result, wholeTermStart, threshold) of enclosing
+                                      #terms, threshold is None for parentheses
         result = None                 #current top-level node
         expr = None                   #child node being parsed
-        wholeTermStart = self._index  #start of the top-level term 
-        subtermStart = self._index    #start of sub-level term
+        wholeTermStart = 0            #start of the top-level term 
+        subtermStart = 0              #start of sub-level term
         subtermComplete = False       #has the subterm been completed
+        index = 0                     #current parse location
         
-        #loop through all characters and parse them individually
-        while self._index < len(expression):
-            e = expression[self._index]
-            self._index += 1
-            if e == '&': #case of whole term being being AND
-                expr = self._processTerm(subtermStart, self._index - 1, expr, expression)
-                if result != None:
-                    if result.type != NodeType.AND: 
-                        raise VisibilityFormatException("cannot mix & and |")
-                else:
-                    result = self._create_node(wholeTermStart, NodeType.AND )
-                result.add(expr)
-                expr = None
-                subtermStart = self._index
-                subtermComplete = False 
-                continue
-            
-            elif e == '|': #case of whole term being OR
-                expr = self._processTerm(subtermStart, self._index - 1, expr, expression)
-                if result != None:
-                    if result.type != NodeType.OR:
-                        raise VisibilityFormatException("cannot mix & and |")
-                else:
-                    result = self._create_node(wholeTermStart, NodeType.OR )
-                result.add(expr)
-                expr = None
-                subtermStart = self._index
-                subtermComplete = False 
-                continue
-        
-            elif e == '(': #case of start of a parenthetical term 
-                self._parens += 1
-                if (subtermStart != self._index - 1) or (expr is not None):
-                    raise VisibilityFormatException("expression needs & or |") 
-                #parse the subterm expression 
-                expr = self._parse(expression) 
-                subtermStart = self._index
-                subtermComplete = False
-                continue
+        #loop through the tokens, every character is part of one 
+        for (operator, quoted, close, term) in _TOKEN.findall(expression):
             
-            elif e == ')': #case of end of a parenthetical term 
-                self._parens -= 1
-                #process the subterm and make sure it is wellformed 
-                child = self._processTerm(subtermStart, self._index - 1, expr, expression)
-                if child is None and result is None:
-                    raise VisibilityFormatException("empty expression not allowed")
-                if result is None:
-                    return child
-                #if the child is the same type as parent (result), promote the child's children 
-                if result.type == child.type:
-                    for c in child.children:
-                        result.add(c)
-                else:   
-                    result.add(child)
-                result.end = self._index - 1 
-                return result
-            
-            elif e == '"': #case of a quoted expression 
-                if subtermStart != (self._index - 1):
+            if term: #characters of an unquoted term 
+                if subtermComplete:
+                    raise VisibilityFormatException("expression needs & or |")
+                index += len(term)
+                
+            elif quoted: #case of a quoted expression 
+                if subtermStart != index:
                     raise VisibilityFormatException("expression needs & or |")
                 
                 #check to make nothing is invalid escaped in the quotes 
-                while (self._index < len(expression) and \
-                       expression[self._index] != '"'):
-                    if expression[self._index] == '\\':
-                          self._index += 1
-                          if (expression[self._index] != '\\' and \
-                              expression[self._index] != '"'):
-                              raise VisibilityFormatException('invalid escaping within quotes')
-                    self._index += 1
-                    
+                if any([c != '\\' and c != '"' for c in _ESCAPE.findall(quoted)]):
+                    raise VisibilityFormatException('invalid escaping within quotes')
+                
                 #case without a closing quote
-                if self._index == len(expression):
+                if not close:
                     raise VisibilityFormatException("unclosed quote")
                 
-                if subtermStart + 1 == self._index:
+                if len(quoted) == 1:
                     raise VisibilityFormatException("empty term")
                 
-                self._index += 1
+                index += len(quoted) + 1
                 subtermComplete = True
-                continue
             
-            else: #all other cases, should be valid characters part of a term 
-                if subtermComplete:
-                    raise VisibilityFormatException("expression needs & or |")
+            elif operator in _OPERATORS: #case of whole term being AND or OR
+                type = _OPERATORS[operator]
+                index += 1
+                expr = self._processTerm(subtermStart, index - 1, expr, expression)
+                if result != None:
+                    if result.type != type: 
+                        raise VisibilityFormatException("cannot mix & and |")
+                else:
+                    result = self._create_node(wholeTermStart, type)
+                result.add(expr)
+                expr = None
+                subtermStart = index
+                subtermComplete = False 
+                
+            elif operator == '(': #case of start of a parenthetical term 
+                if (subtermStart != index) or (expr is not None):
+                    raise VisibilityFormatException("expression needs & or |") 
+                index += 1
+                #parse the subterm expression, coming back to this
+                #term at the closing parenthesis
+                stack.append((result, wholeTermStart, None))
+                result = None
+                wholeTermStart = index
+                subtermStart = index
+                subtermComplete = False
+                
+            elif operator == '{': #case of start of a threshold
+                #the threshold is the unquoted term before the brace
+                threshold = expression[subtermStart:index]
+                if expr is not None or not threshold.isdigit():
+                    raise VisibilityFormatException("threshold must be a number: %s" 
+                                                    % (expression))
+                node = self._create_node(subtermStart, NodeType.THRESHOLD)
+                node.threshold = int(threshold)
+                index += 1
+                #parse the children one at a time, coming back to the
+                #threshold at each comma and at the closing brace
+                stack.append((result, wholeTermStart, node))
+                result = None
+                wholeTermStart = index
+                subtermStart = index
+                subtermComplete = False
+                
+            elif operator == ',': #case of end of a child of a threshold
+                index += 1
+                if not stack or stack[-1][2] is None:
+                    raise VisibilityFormatException("comma outside of threshold: %s" 
+                                                    % (expression))
+                stack[-1][2].add(self._close_subterm(subtermStart, index - 1, 
+                                                     expr, result, expression))
+                result = None
+                expr = None
+                wholeTermStart = index
+                subtermStart = index
+                subtermComplete = False
                 
-                #check to see the character is valid
-                c = expression[self._index - 1]
-                if not self._isValidAuthChar(c):
-                    raise VisibilityFormatException('bad character (%c)' % (c))
+            elif operator == '}': #case of end of a threshold
+                index += 1
+                if not stack or stack[-1][2] is None:
+                    raise VisibilityFormatException("brace mis-match: %s" % (expression))
+                child = self._close_subterm(subtermStart, index - 1, expr, result, 
+                                            expression)
+                (result, wholeTermStart, node) = stack.pop()
+                node.add(child)
+                node.end = index
+                if len(node.children) < 2 or\
+                   not 1 <= node.threshold <= len(node.children):
+                    raise VisibilityFormatException("threshold must be between 1 and the "+\
+                                                    "number of terms: %s" % (expression))
+                expr = node
+                subtermStart = index
+                subtermComplete = False
                 
-                continue
+            else: #case of end of a parenthetical term 
+                index += 1
+                #process the subterm and make sure it is wellformed 
+                child = self._close_subterm(subtermStart, index - 1, expr, result, 
+                                            expression)
+                if not stack or stack[-1][2] is not None:
+                    raise VisibilityFormatException("parenthesis mis-match: %s" % (expression))
+                (result, wholeTermStart, _) = stack.pop()
+                expr = child
+                subtermStart = index
+                subtermComplete = False
+        
+        if stack:
+            raise VisibilityFormatException("parenthesis mis-match: %s" % (expression))
             
-        child = self._processTerm(subtermStart, self._index, expr, expression)
+        child = self._processTerm(subtermStart, index, expr, expression)
         if result is not None:
             result.add(child)
-            result.end = self._index
+            result.end = index
         else:
             result = child
       
@@ -358,13 +443,87 @@ class VisParser(object):
                 raise VisibilityFormatException("missing term")
       
         return result
+
+
+#parsed visibility trees, and the templates built from them in 
+#secret_vis_tree.py, keyed by the kind of tree and the expression. 
+#Tables usually hold only a few hundred distinct labels, so each
+#label is parsed about once. 
+PARSE_CACHE = LRUCache(1024)
+
+def parse_cached(expression):
+    '''
+    Arguments:
+        expression - the expression to parse
     
+    Returns: VisTree for the expression as VisParser().parse returns,
+      taken from PARSE_CACHE if the expression was parsed before. 
+      The tree is shared with other callers, so it must not be 
+      modified. Raises VisibilityFormatException if the visibility
+      is ill-formed; ill-formed expressions are not cached. 
+    '''
+    return PARSE_CACHE.get_or_create((VisTree, expression),
+                                     lambda: VisParser().parse(expression))
 
+def accumulo_expression(expression):
+    '''
+    Arguments:
+        expression - a visibility expression
     
+    Returns: an expression in Accumulo's column visibility syntax that 
+      is satisfied by the same terms. Expressions without threshold 
+      terms are returned unchanged; in the others every threshold term
+      k{e1,...,en} is written as the OR, over every k of its terms, of
+      their AND, so '2{a,b,c}' becomes '(a&b)|(a&c)|(b&c)'. Accumulo 
+      does not accept braces or commas outside of quotes, so this is 
+      the label cells must be written to Accumulo with. The result is 
+      cached in PARSE_CACHE. Raises VisibilityFormatException if the 
+      expression is ill-formed. 
+    '''
+    if '{' not in expression:
+        return expression
+    def create():
+        tree = parse_cached(expression)
+        nodes = [tree.root]
+        while nodes:
+            node = nodes.pop()
+            if node.type == NodeType.THRESHOLD:
+                return _accumulo_expression(tree.root, expression)[0]
+            nodes.extend(node.children)
+        #the braces are all within quoted terms
+        return expression
+    return PARSE_CACHE.get_or_create((accumulo_expression, expression), create)
 
-        
-            
+def _accumulo_expression(node, expression):
+    '''
+    Arguments:
+        node - VisNode of a parsed expression
+        expression - the expression node was parsed from
     
+    Returns: (text, type) tuple with the column visibility for node as
+      accumulo_expression writes it and the NodeType of its top-level
+      operator (TERM if it has none)
+    '''
+    if node.type == NodeType.TERM:
+        return (expression[node.start:node.end], NodeType.TERM)
     
+    children = [_accumulo_expression(c, expression) for c in node.children]
+    if node.type != NodeType.THRESHOLD:
+        return (_join(children, node.type), node.type)
+    if node.threshold == len(children):
+        return (_join(children, NodeType.AND), NodeType.AND)
+    if node.threshold == 1:
+        return (_join(children, NodeType.OR), NodeType.OR)
+    clauses = [(_join(combination, NodeType.AND), NodeType.AND)
+               for combination in itertools.combinations(children, node.threshold)]
+    return (_join(clauses, NodeType.OR), NodeType.OR)
 
-    
\ No newline at end of file
+def _join(children, type):
+    '''
+    Returns: the (text, type) tuples of children joined with the 
+      operator of type, parenthesized where their operator differs 
+    '''
+    operator = '&' if type == NodeType.AND else '|'
+    return operator.join([text if child_type in (NodeType.TERM, type) 
+                          else '(' + text + ')'
+                          for (text, child_type) in children])
@@ -0,0 +1,108 @@
+## **************
+##  Copyright 2026 MIT Lincoln Laboratory
+##  Project: PACE
+##  Authors: ATLH
+##  Description: Microbenchmark of visibility label parsing
+##  Modifications:
+##  Date         Name  Modification
+##  ----         ----  ------------
+##  17 Oct 2026  ATLH    Original file
+## **************
+
+import os
+import sys
+this_dir = os.path.dirname(os.path.dirname(__file__))
+base_dir = os.path.join(this_dir, '../..')
+sys.path.append(base_dir)
+
+import base64
+import timeit
+from optparse import OptionParser
+from pace.encryption.visibility.vis_parser import VisParser
+from pace.encryption.visibility.secret_vis_tree import SecretVisParser
+
+def deep_label(depth):
+    '''
+    Returns: a label with depth nested parenthesized terms,
+    alternating between AND and OR
+    '''
+    label = 'a'
+    for i in xrange(depth):
+        label = '(%s%sb%d)' % (label, '&' if i % 2 else '|', i)
+    return label
+
+def wide_label(width):
+    '''
+    Returns: an AND of width terms
+    '''
+    return '&'.join('term%d' % i for i in xrange(width))
+
+def share_expression(label):
+    '''
+    Returns: label with every term replaced by a quoted base64 string
+    of the length of an encrypted 16 byte share, as SecretVisParser
+    parses when decrypting
+    '''
+    share = '"%sver1"' % base64.b64encode(os.urandom(32))
+    tree = VisParser().parse(label)
+    terms = []
+    nodes = [tree.root]
+    while nodes:
+        node = nodes.pop()
+        if node.children:
+            nodes.extend(node.children)
+        else:
+            terms.append(node)
+    parts = []
+    last = 0
+    for node in sorted(terms, key=lambda node: node.start):
+        parts.extend([label[last:node.start], share])
+        last = node.end
+    parts.append(label[last:])
+    return ''.join(parts)
+
+def benchmark(labels, number, repeat):
+    '''
+    Arguments:
+    labels - list of (name, label) tuples of the labels to parse
+    number - number of times each label is parsed per timing
+    repeat - number of timings taken, the best is reported
+
+    Returns: list of (name, parser, seconds) tuples with the best
+    time per parse of each label, with VisParser and with
+    SecretVisParser on the corresponding share expression
+    '''
+    results = []
+    for (name, label) in labels:
+        for (parser, expression) in [(VisParser(), label),
+                                     (SecretVisParser(), share_expression(label))]:
+            seconds = min(timeit.repeat(lambda: parser.parse(expression),
+                                        number=number, repeat=repeat))
+            results.append((name, type(parser).__name__, seconds / number))
+    return results
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--depth', dest='depth',
+                      type='int', default=500,
+                      help='Nesting depth of the deep label. Default: 500')
+    parser.add_option('--width', dest='width',
+                      type='int', default=500,
+                      help='Number of terms of the wide label. Default: 500')
+    parser.add_option('--number', dest='number',
+                      type='int', default=100,
+                      help='Number of parses per timing. Default: 100')
+    parser.add_option('--repeat', dest='repeat',
+                      type='int', default=5,
+                      help='Number of timings per label. Default: 5')
+    (options, args) = parser.parse_args()
+
+    labels = [('simple', '((a&b)|c)&(d|e)'),
+              ('deep', deep_label(options.depth)),
+              ('wide', wide_label(options.width))]
+    for (name, parser_name, seconds) in benchmark(labels, options.number,
+                                                  options.repeat):
+        print '%-8s %-16s %10.1fus' % (name, parser_name, seconds * 1e6)
+
+if __name__ == "__main__":
+    main()
@@ -16,9 +16,47 @@ base_dir = os.path.join(this_dir, '../..')
 sys.path.append(base_dir)
 
 import random
+import re
 import unittest
 from pace.encryption.visibility.vis_parser import NodeType, VisNode, VisTree, VisParser,\
-                                            VisibilityFormatException
+                                            VisibilityFormatException, PARSE_CACHE, parse_cached,\
+                                            accumulo_expression
+
+#tokens of Accumulo's column visibility grammar (ColumnVisibility.java):
+#an operator or parenthesis, a quoted term, or an unquoted term
+_ACCUMULO_TOKEN = re.compile(r'[&|()]|"(?:[^"\\]|\\["\\])+"|[A-Za-z0-9_\-.:/]+')
+
+def accumulo_valid(expression):
+    '''
+    Returns: whether expression is a column visibility that Accumulo 
+    accepts: terms joined by & or |, which may only be mixed inside 
+    parentheses
+    '''
+    tokens = _ACCUMULO_TOKEN.findall(expression)
+    if ''.join(tokens) != expression:
+        return False
+    if not tokens:
+        return True
+    def parse(position):
+        #returns the position after the expression starting at position
+        operator = None
+        while True:
+            if position >= len(tokens) or tokens[position] in '&|)':
+                return None
+            if tokens[position] == '(':
+                position = parse(position + 1)
+                if position is None or position >= len(tokens) or \
+                   tokens[position] != ')':
+                    return None
+            position += 1
+            if position == len(tokens) or tokens[position] == ')':
+                return position
+            if tokens[position] not in '&|' or \
+               operator not in (None, tokens[position]):
+                return None
+            operator = tokens[position]
+            position += 1
+    return parse(0) == len(tokens)
 
 class VisNodeTest(unittest.TestCase):
 
@@ -74,4 +112,98 @@ class VisParserTest(unittest.TestCase):
         for e in expressions:
             self.assertRaises(VisibilityFormatException,parser.parse, e)
 
-        
\ No newline at end of file
+                    
+    def test_escaped_quotes(self):
+        '''
+        Tests quoted terms with escapes, and that a quote left open by
+        an escape raises a VisibilityFormatException
+        '''
+        parser = VisParser()
+        tree = parser.parse('"a\\"b\\\\"|c')
+        self.assertEqual(tree.root.type, NodeType.OR)
+        self.assertEqual(tree.root.children[0].getTerm(tree.expression), 'a\\"b\\\\')
+        for e in ['"a\\', '"a\\"', '"a\\b"', 'a|"b']:
+            self.assertRaises(VisibilityFormatException, parser.parse, e)
+    
+    def test_deep_and_wide(self):
+        '''
+        Tests that labels nested deeper than the recursion limit, 
+        and labels with many terms, parse
+        '''
+        parser = VisParser()
+        depth = sys.getrecursionlimit() + 100
+        deep = 'a'
+        for i in xrange(depth):
+            deep = '(%s%sb%d)' % (deep, '&' if i % 2 else '|', i)
+        tree = parser.parse(deep)
+        self.assertEqual(len(tree.get_terms()), depth + 1)
+        self.assertRaises(VisibilityFormatException, parser.parse, deep[1:])
+        
+        wide = '|'.join('t%d' % i for i in xrange(5000))
+        tree = parser.parse(wide)
+        self.assertEqual(len(tree.root.children), 5000)
+        self.assertEqual(str(tree), wide)
+                    
+    def test_thresholds(self):
+        '''
+        Tests parsing threshold (k-of-n) terms
+        '''
+        parser = VisParser()
+        tree = parser.parse('2{a,b&c,(d|e)}&f')
+        self.assertEqual(str(tree), '2{a,b&c,d|e}&f')
+        threshold = tree.root.children[0]
+        self.assertEqual(threshold.type, NodeType.THRESHOLD)
+        self.assertEqual(threshold.threshold, 2)
+        self.assertEqual([c.type for c in threshold.children],
+                         [NodeType.TERM, NodeType.AND, NodeType.OR])
+        self.assertEqual(tree.get_terms(), set(['a', 'b', 'c', 'd', 'e', 'f']))
+        for e in ['3{a,b,c}', '1{a,2{b,c,d}}|e', '"a,b"|2{"c}",d}']:
+            self.assertEqual(str(parser.parse(e)), e)
+        
+        for e in ['2{a}', '4{a,b,c}', '0{a,b}', 'x{a,b}', '{a,b}', 'a,b',
+                  '(a,b)', '2{a,b', '2{a,b)', '(2{a,b}', '2{a,,b}', '2{a,b}c']:
+            self.assertRaises(VisibilityFormatException, parser.parse, e)
+                    
+    def test_accumulo_expression(self):
+        '''
+        Tests writing threshold terms in Accumulo's column visibility 
+        syntax
+        '''
+        for e in ['a&(b|c)', '"a{b,c}"|d', '(a|b)']:
+            self.assertEqual(accumulo_expression(e), e)
+        for (e, expected) in [('2{a,b,c}', '(a&b)|(a&c)|(b&c)'),
+                              ('3{a,b,c}', 'a&b&c'),
+                              ('1{a,b&c}|d', 'a|(b&c)|d'),
+                              ('2{a,b&c,(d|e)}&f', '((a&b&c)|(a&(d|e))|(b&c&(d|e)))&f'),
+                              ('2{a,"c}",1{d,e}}', '(a&"c}")|(a&(d|e))|("c}"&(d|e))')]:
+            self.assertEqual(accumulo_expression(e), expected)
+            self.assertTrue(accumulo_valid(expected))
+            self.assertFalse(accumulo_valid(e))
+            parser = VisParser()
+            self.assertEqual(parser.parse(expected).get_terms(), parser.parse(e).get_terms())
+        for e in ['a|b&c', 'a,b', '(a', '"a', '&a', 'a&', '()']:
+            self.assertFalse(accumulo_valid(e))
+        self.assertRaises(VisibilityFormatException, accumulo_expression, '2{a}')
+
+    def test_get_terms(self):
+        '''
+        Test extracting the terms of an expression 
+        '''
+        parser = VisParser()
+        self.assertEqual(parser.parse('a&(b|"c:d")&a').get_terms(),
+                         set(['a', 'b', 'c:d']))
+        self.assertEqual(parser.parse('abc').get_terms(), set(['abc']))
+        
+    def test_parse_cached(self):
+        '''
+        Tests that expressions are parsed only once by parse_cached
+        '''
+        expression = 'cached&(b|"c:d")'
+        tree = parse_cached(expression)
+        self.assertEqual(str(tree), expression)
+        hits = PARSE_CACHE.hits
+        self.assertTrue(parse_cached(expression) is tree)
+        self.assertEqual(PARSE_CACHE.hits, hits + 1)
+        
+        self.assertRaises(VisibilityFormatException, parse_cached, 'a&|b')
+        self.assertFalse((VisTree, 'a&|b') in PARSE_CACHE)
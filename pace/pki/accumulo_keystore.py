@@ -17,14 +17,12 @@ sys.path.append(base_dir)
 
 from pyaccumulo import Mutation, Range
 from types import IntType
-from collections import defaultdict
 
 from pace.pki.keystore import AbstractKeyStore, KeyInfo
 from pace.common.common_utils import get_single_entry
 from pace.pki.abstractpki import PKILookupError, PKIStorageError
 from pace.pki.attrusermap import AbstractAttrUserMap
 from pace.pki.userattrmap import AbstractUserAttrMap
-from pace.common.common_utils import entry_exists
 
 class AccumuloKeyStore(AbstractKeyStore):
     """ An implementation of AbstractKeyStore (see keystore.py) that
@@ -40,12 +38,19 @@ class AccumuloKeyStore(AbstractKeyStore):
           range of versions
         - Since we assume many users but few metadatas, create one table
           per metadata, then one row per user in each of these tables.
+        - Optionally, keep a copy of each user's latest key wrap for each
+          attribute and metadata in a separate table, so that the latest
+          key can be looked up with a single scan instead of one on the
+          version table followed by one on the metadata's table.
     """
 
     def __init__(self, conn, meta_table='__KEYWRAP_METADATA__',
-                             vers_table='__VERSION_METADATA__'):
+                             vers_table='__VERSION_METADATA__',
+                             latest_table=None):
         """ Init needs the connection that the Accumulo server used to
-            store the keys lives on.
+            store the keys lives on. If latest_table is given, the latest
+            version of each of a user's keys is also stored in that table
+            (see retrieve_latest_version).
         """
         self.conn = conn
         if not conn.table_exists(meta_table):
@@ -54,6 +59,9 @@ class AccumuloKeyStore(AbstractKeyStore):
         if not conn.table_exists(vers_table):
             conn.create_table(vers_table)
         self.vers_table = vers_table
+        if latest_table is not None and not conn.table_exists(latest_table):
+            conn.create_table(latest_table)
+        self.latest_table = latest_table
 
     def insert(self, userid, keyinfo):
         """ Insert a wrapped key into the key store.
@@ -139,77 +147,199 @@ class AccumuloKeyStore(AbstractKeyStore):
                     ideally would be faster than inserting each tuple
                     individually.
         """
-        
-        # Store metadata (i.e. table) names mapping to
-        # BatchWriter, Mutation pairs
+        self.bulk_insert([(userid, infos)])
+
+    def bulk_insert(self, user_infos):
+        """ Add the keys of many users into the key store at once (see
+            AbstractKeyStore.bulk_insert). A single batch writer is kept
+            open for each table written to, and the version table is read
+            and written once for each attribute and metadata pair rather
+            than once for each user.
+
+            Arguments:
+
+            self - the KeyStore object being written to
+            user_infos : iterable of (string, [KeyInfo]) - (userid, infos)
+                    pairs of the ID of a user and the list of that user's
+                    KeyInfo objects
+
+            Raises:
+
+            PKIStorageError - if a user's key infos are not properly
+                    constructed. None of that user's keys are inserted,
+                    but those of the users before them are.
+        """
+
+        # Store table names mapping to BatchWriters
         writers = {}
 
-        # Also keep a mutation to write to the keywrap metadata table
-        # Schema:
-        #   Table - self.meta_table
-        #   Row   - userid
-        #   CF    - attr
-        #   CQ    - metadata
-        #   vis   - [empty]
-        #   value - '1' (dummy value)
-        meta_mutation = Mutation(userid)
-        # Use a defaultdict to return 0 if the attribute searched for is not
-        # found; useful for the call to max() later on. Assumes that all
-        # versions are positive.
-        maxvers = defaultdict(int)
+        # The latest version number of each attr metadata pair, read from
+        # the version table the first time the pair is seen (None if it is
+        # not there), and the pairs whose number needs to be updated
+        latest_vers = {}
+        new_vers = set()
 
-        for keyinfo in infos:
-            if type(keyinfo.vers) is not IntType:
-                raise PKIStorageError('versions must be integers')
-            if type(keyinfo.keylen) is not IntType:
-                raise PKIStorageError('key lengths must be integers')
+        # The (userid, metadata, attr) tuples whose keys were written
+        changes = set()
 
-            metadata = keyinfo.metadata
+        try:
+            for userid, infos in user_infos:
+                infos = list(infos)
+                for keyinfo in infos:
+                    if type(keyinfo.vers) is not IntType:
+                        raise PKIStorageError('versions must be integers')
+                    if type(keyinfo.keylen) is not IntType:
+                        raise PKIStorageError('key lengths must be integers')
+
+                # One mutation per metadata table
+                mutations = {}
+
+                # Also keep a mutation to write to the keywrap metadata table
+                # Schema:
+                #   Table - self.meta_table
+                #   Row   - userid
+                #   CF    - attr
+                #   CQ    - metadata
+                #   vis   - [empty]
+                #   value - '1' (dummy value)
+                meta_mutation = Mutation(userid)
+
+                # The key info with the largest version for each attr
+                # metadata pair
+                latest = {}
+
+                for keyinfo in infos:
+                    metadata = keyinfo.metadata
+
+                    if metadata not in mutations:
+                        mutations[metadata] = Mutation(userid)
+
+                    mutations[metadata].put(cf=keyinfo.attr,
+                                            cq=str(keyinfo.vers),
+                                            cv=keyinfo.attr,
+                                            val='%s,%s' %(keyinfo.keywrap,
+                                                          str(keyinfo.keylen)))
+                    
+                    meta_mutation.put(cf=keyinfo.attr, cq=metadata, val='1')
+
+                    pair = (keyinfo.attr, metadata)
+                    if pair not in latest or latest[pair].vers <= keyinfo.vers:
+                        latest[pair] = keyinfo
+
+                for metadata, mutation in mutations.iteritems():
+                    self._batch_writer(writers, metadata).add_mutation(mutation)
+                if infos:
+                    self._batch_writer(writers, self.meta_table).add_mutation(
+                        meta_mutation)
+
+                # See whether the largest version numbers we found are the
+                # latest ones.
+                # Schema of the latest key table, if there is one:
+                #   Table - self.latest_table
+                #   Row   - userid
+                #   CF    - attr
+                #   CQ    - metadata
+                #   vis   - attr
+                #   value - 'vers,keywrap,keylen'
+                latest_mutation = Mutation(userid)
+                for pair, keyinfo in latest.iteritems():
+                    if pair not in latest_vers:
+                        latest_vers[pair] = self._stored_version(*pair)
+
+                    stored = latest_vers[pair]
+                    if stored is not None and stored > keyinfo.vers:
+                        continue
+                    if stored is None or stored < keyinfo.vers:
+                        latest_vers[pair] = keyinfo.vers
+                        new_vers.add(pair)
+
+                    # The user's key is (still) the latest version
+                    latest_mutation.put(cf=keyinfo.attr, cq=keyinfo.metadata,
+                                        cv=keyinfo.attr,
+                                        val='%s,%s,%s' %(str(keyinfo.vers),
+                                                         keyinfo.keywrap,
+                                                         str(keyinfo.keylen)))
+
+                if self.latest_table is not None and latest:
+                    self._batch_writer(writers, self.latest_table).add_mutation(
+                        latest_mutation)
+
+                changes.update((userid, metadata, attr) 
+                               for attr, metadata in latest)
+        finally:
+            for wr in writers.itervalues():
+                wr.close()
+
+            # Update the version table with the new latest version numbers
+            for attr, metadata in new_vers:
+                vers_mutation = Mutation(attr)
+                vers_mutation.put(cq=metadata, val=str(latest_vers[(attr, metadata)]))
+                self.conn.write(self.vers_table, vers_mutation)
+
+            if self.latest_table is not None:
+                self._remove_stale_latest(new_vers, latest_vers)
+
+            self._keys_changed(changes)
+
+    def _remove_stale_latest(self, pairs, latest_vers):
+        """ Delete the copies in the latest key table of keys older than
+            the latest version of their attr metadata pair, for each pair
+            in pairs, so that users who were not given the latest version
+            have no latest key, as without the table. This scans the whole
+            table for each pair, which only happens when a new version of
+            a key is inserted.
 
-            if metadata not in writers:
-                if not self.conn.table_exists(metadata):
-                    self.conn.create_table(metadata)
+            Arguments:
 
-                writers[metadata] = (self.conn.create_batch_writer(metadata),
-                                     Mutation(userid))
+            pairs : iterable of (string, string) - the (attr, metadata)
+                    pairs whose latest version changed
+            latest_vers : {(string, string): int} - the latest version
+                    of each pair
+        """
+        writer = self.conn.create_batch_writer(self.latest_table)
+        try:
+            for attr, metadata in pairs:
+                for cell in self.conn.scan(self.latest_table,
+                                           cols=[[attr, metadata]]):
+                    try:
+                        vers = int(cell.val.split(',', 1)[0])
+                    except ValueError:
+                        continue
+                    if vers < latest_vers[(attr, metadata)]:
+                        mutation = Mutation(cell.row)
+                        mutation.put(cf=attr, cq=metadata, cv=attr,
+                                     is_delete=True)
+                        writer.add_mutation(mutation)
+        finally:
+            writer.close()
+
+    def _batch_writer(self, writers, table):
+        """ Return the batch writer for the given table from the writers
+            dictionary, creating the table and writer if there are none.
+        """
+        if table not in writers:
+            if not self.conn.table_exists(table):
+                self.conn.create_table(table)
+            writers[table] = self.conn.create_batch_writer(table)
+        return writers[table]
 
-            _, mutation = writers[metadata]
+    def _stored_version(self, attr, metadata):
+        """ Return the version number stored in the version table for the
+            given attribute and metadata, or None if there is none.
 
-            mutation.put(cf=keyinfo.attr,
-                         cq=str(keyinfo.vers),
-                         cv=keyinfo.attr,
-                         val='%s,%s' %(keyinfo.keywrap, str(keyinfo.keylen)))
-            
-            meta_mutation.put(cf=keyinfo.attr, cq=metadata, val='1')
-
-            # Keep track of the largest version number for each attr metadata
-            # pair we've seen so far.
-            maxvers[(keyinfo.attr, metadata)] = max(
-                maxvers[(keyinfo.attr, metadata)], keyinfo.vers)
-
-        for wr, m in writers.itervalues():
-            wr.add_mutation(m)
-            wr.close()
-
-        self.conn.write(self.meta_table, meta_mutation)
-
-        # Go through the largest version numbers we found and see if any
-        # need to be updated in the version table
-        for (attr, metadata), vers in maxvers.iteritems():
-            cell = get_single_entry(self.conn, self.vers_table,
-                                    row=attr, cf='', cq=metadata)
-            if cell:
-                try:
-                    old_vers = int(cell.val)
-                except ValueError:
-                    raise PKIStorageError('stored version must be integer')
-                
-                if old_vers >= vers:
-                    continue
+            Raises:
 
-            vers_mutation = Mutation(attr)
-            vers_mutation.put(cq=metadata, val=str(vers))
-            self.conn.write(self.vers_table, vers_mutation)
+            PKIStorageError - if the stored value is not an integer
+        """
+        cell = get_single_entry(self.conn, self.vers_table,
+                                row=attr, cf='', cq=metadata)
+        if cell is None:
+            return None
+
+        try:
+            return int(cell.val)
+        except ValueError:
+            raise PKIStorageError('stored version must be integer')
 
     def batch_retrieve(self, userid, metadata, attr=None):
         """ Fetch all of a user's keys at once. Optionally, fetch only their
@@ -319,6 +449,14 @@ class AccumuloKeyStore(AbstractKeyStore):
         mutation.put(cf=attr, cq=metadata, is_delete=True)
         self.conn.write(self.meta_table, mutation)
 
+        # And from the latest key table
+        if self.latest_table is not None:
+            mutation = Mutation(userid)
+            mutation.put(cf=attr, cq=metadata, cv=attr, is_delete=True)
+            self.conn.write(self.latest_table, mutation)
+
+        self._keys_changed([(userid, metadata, attr)])
+
     def get_metadatas(self, user, attr):
         """ Get all metadatas that a given user has for a particular attribute.
 
@@ -342,6 +480,48 @@ class AccumuloKeyStore(AbstractKeyStore):
 
         return set([entry.cq for entry in raw_metas])
 
+    def retrieve_latest_version(self, userid, metadata, attr):
+        """ Fetch the latest key for the given user, attribute, and 
+            metadata (see AbstractKeyStore.retrieve_latest_version).
+
+            If the key store keeps a latest key table, the key is read
+            from it with a single scan. The table only holds keys of the 
+            latest version: when a newer version is inserted, the older
+            copies are deleted (see _remove_stale_latest), so a user who
+            was not given the newer version gets PKILookupError, as 
+            without the table. Keys stored before the table was in use
+            are looked up in the version and metadata tables.
+
+            Raises:
+
+            PKILookupError - if no such key is found.
+        """
+        if self.latest_table is None:
+            return super(AccumuloKeyStore, self).retrieve_latest_version(
+                userid, metadata, attr)
+
+        # Only the first entry is needed, so don't read a second one to
+        # check that it is unique
+        cells = self.conn.scan(self.latest_table,
+                               Range(srow=userid, erow=userid),
+                               cols=[[attr, metadata]])
+        cell = next(iter(cells), None)
+
+        if cell is None:
+            return super(AccumuloKeyStore, self).retrieve_latest_version(
+                userid, metadata, attr)
+
+        raw_vers, rest = cell.val.split(',', 1)
+        keywrap, raw_keylen = rest.rsplit(',', 1)
+
+        try:
+            vers = int(raw_vers)
+            keylen = int(raw_keylen)
+        except ValueError:
+            raise PKILookupError('Error: found non-integer version or key length')
+
+        return KeyInfo(attr, vers, metadata, keywrap, keylen)
+
     def retrieve_latest_version_number(self, metadata, attr):
         """ Return the most recent version number for the given attribute
             and metadata. 
@@ -369,6 +549,32 @@ class AccumuloKeyStore(AbstractKeyStore):
         except ValueError:
             raise PKILookupError('Stored version string does not parse as int')
 
+    def retrieve_latest_version_numbers(self, metadata, attrs):
+        """ Return the most recent version numbers for several attributes
+            with the same metadata (see 
+            AbstractKeyStore.retrieve_latest_version_numbers), read with
+            a single batch scan of the version table with one range for
+            each attribute's row.
+
+            Raises:
+
+            PKILookupError - if a stored value is not an integer
+        """
+        attrs = set(attrs)
+        if not attrs:
+            return {}
+
+        cells = self.conn.batch_scan(self.vers_table,
+                                     [Range(srow=attr, erow=attr) for attr in attrs],
+                                     cols=[['', metadata]])
+        versions = {}
+        for cell in cells:
+            try:
+                versions[cell.row] = int(cell.val)
+            except ValueError:
+                raise PKILookupError('Stored version string does not parse as int')
+        return versions
+
 class AccumuloAttrKeyStore(AccumuloKeyStore, AbstractAttrUserMap, 
                            AbstractUserAttrMap):
     """ Subclass of the AccumuloKeyStore that also keeps track of
@@ -389,8 +595,10 @@ class AccumuloAttrKeyStore(AccumuloKeyStore, AbstractAttrUserMap,
     def __init__(self, conn, meta_table='__KEYWRAP_METADATA__',
                              vers_table='__VERSION_METADATA__',
                              attr_user_table='__ATTR_USER_TABLE__',
-                             user_attr_table='__USER_ATTR_TABLE__'):
-        super(AccumuloAttrKeyStore, self).__init__(conn, meta_table, vers_table)
+                             user_attr_table='__USER_ATTR_TABLE__',
+                             latest_table=None):
+        super(AccumuloAttrKeyStore, self).__init__(conn, meta_table, vers_table,
+                                                   latest_table)
 
         if not self.conn.table_exists(attr_user_table):
             self.conn.create_table(attr_user_table)
@@ -400,29 +608,34 @@ class AccumuloAttrKeyStore(AccumuloKeyStore, AbstractAttrUserMap,
             self.conn.create_table(user_attr_table)
         self.user_attr_table = user_attr_table
 
-    def batch_insert(self, userid, infos):
-        # Do a normal insert
-        super(AccumuloAttrKeyStore, self).batch_insert(userid, infos)
-
-        # Also add key information
-        # NB: this can also be done inline to avoid iterating twice
-        #     though the keystore infos, at the downside of more code
-        #     duplication and less modularity.
-        for keyinfo in infos:
-            if not entry_exists(self.conn, self.attr_user_table,
-                                keyinfo.attr, userid):
-                #TODO: we could batch these writes for potentially a
-                #      little bit more efficiency
-                m = Mutation(keyinfo.attr)
-                m.put(cf=userid, val='1')
-                self.conn.write(self.attr_user_table, m)
-
-            if not entry_exists(self.conn, self.user_attr_table,
-                                userid, keyinfo.attr):
-                m = Mutation(userid)
-                m.put(cf=keyinfo.attr, val='1')
-                self.conn.write(self.user_attr_table, m)
-                
+    def bulk_insert(self, user_infos):
+        # Do a normal insert, also adding key information as each user's
+        # keys are inserted, with one batch writer for each of the mapping
+        # tables. Writing a mapping that already exists leaves it as it
+        # was, so there is no need to check for it first.
+        attr_user_writer = self.conn.create_batch_writer(self.attr_user_table)
+        user_attr_writer = self.conn.create_batch_writer(self.user_attr_table)
+
+        def add_mappings():
+            for userid, infos in user_infos:
+                infos = list(infos)
+                yield userid, infos
+
+                # The user's keys were inserted
+                user_mutation = Mutation(userid)
+                for attr in set(keyinfo.attr for keyinfo in infos):
+                    m = Mutation(attr)
+                    m.put(cf=userid, val='1')
+                    attr_user_writer.add_mutation(m)
+                    user_mutation.put(cf=attr, val='1')
+                if infos:
+                    user_attr_writer.add_mutation(user_mutation)
+
+        try:
+            super(AccumuloAttrKeyStore, self).bulk_insert(add_mappings())
+        finally:
+            attr_user_writer.close()
+            user_attr_writer.close()
 
     def users_by_attribute(self, attr):
         """ Return the list of all users who are currently authorized to
@@ -15,9 +15,17 @@ this_dir = os.path.dirname(os.path.dirname(__file__))
 base_dir = os.path.join(this_dir, '../..')
 sys.path.append(base_dir)
 
+from multiprocessing import Pool, cpu_count
 from Crypto.Cipher import PKCS1_OAEP
 from Crypto.PublicKey import RSA
 
+# Batches of fewer keywraps than this are unwrapped in the calling 
+# process, as starting the workers would take longer than unwrapping
+MIN_PARALLEL_KEYS = 8
+
+# The cipher each worker process of unwrap_keys decrypts with
+_worker_cipher = None
+
 def wrap_key(sk, RSA_pk):
     """ Generates a keywrap.
 
@@ -46,3 +54,53 @@ def unwrap_key(keywrap, RSA_sk):
 
     cipher = PKCS1_OAEP.new(RSA_sk)
     return cipher.decrypt(keywrap)
+
+def _init_unwrap_worker(exported_sk):
+    """ Sets up the cipher of a worker process of unwrap_keys.
+
+        Arguments:
+        exported_sk (string) - the user's RSA private key, exported
+    """
+
+    global _worker_cipher
+    _worker_cipher = PKCS1_OAEP.new(RSA.importKey(exported_sk))
+
+def _unwrap_in_worker(keywrap):
+    return _worker_cipher.decrypt(keywrap)
+
+def unwrap_keys(keywraps, RSA_sk, workers=None):
+    """ Unwraps a batch of keywraps.
+
+        Arguments:
+        keywraps (list of strings) - the wrapped keys
+        RSA_sk (_RSAobj) - the user's RSA private key
+        workers (int) - (optional) the number of processes to unwrap
+            the keys in, defaults to the number of CPUs. Batches of
+            fewer than MIN_PARALLEL_KEYS keywraps are unwrapped in the
+            calling process.
+
+        Returns:
+        A list of strings, the RSA-OAEP decryptions of the keywraps
+        under private key `RSA_sk', in the same order as `keywraps'.
+        Each process decrypts with a single cipher.
+
+        Raises:
+        ValueError if any of the keywraps cannot be decrypted
+    """
+
+    keywraps = list(keywraps)
+    if workers is None:
+        workers = cpu_count()
+    workers = min(workers, len(keywraps))
+
+    if workers <= 1 or len(keywraps) < MIN_PARALLEL_KEYS:
+        cipher = PKCS1_OAEP.new(RSA_sk)
+        return [cipher.decrypt(keywrap) for keywrap in keywraps]
+
+    pool = Pool(workers, _init_unwrap_worker, (RSA_sk.exportKey(),))
+    try:
+        return pool.map(_unwrap_in_worker, keywraps,
+                        chunksize=-(-len(keywraps) // workers))
+    finally:
+        pool.terminate()
+        pool.join()
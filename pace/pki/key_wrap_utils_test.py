@@ -19,7 +19,8 @@ import time
 import random
 
 from Crypto.PublicKey import RSA
-from pace.pki.key_wrap_utils import wrap_key, unwrap_key
+from pace.pki.key_wrap_utils import wrap_key, unwrap_key, unwrap_keys, \
+    MIN_PARALLEL_KEYS
 from pace.common.pacetest import PACETestCase
 
 class KeyWrapUtilsTests(PACETestCase):
@@ -61,4 +62,21 @@ class KeyWrapUtilsTests(PACETestCase):
             else:
                 self.assertNotEqual(decrypted_key, sk,
                                     'Decryption succeeded with invalid key')
-    
+
+    def test_unwrap_keys(self):
+        """ Check that unwrapping a batch of keys, in this process or
+            in several, gives back the original keys in order, and
+            fails with a non-corresponding private key.
+        """
+        RSA_key = RSA.generate(3072)
+        RSA_pk = RSA_key.publickey()
+        sks = [format(random.getrandbits(128), 'b')
+               for i in range(MIN_PARALLEL_KEYS + 3)]
+        keywraps = [wrap_key(sk, RSA_pk) for sk in sks]
+        self.assertEqual(unwrap_keys(keywraps, RSA_key, workers=3), sks)
+        self.assertEqual(unwrap_keys(keywraps, RSA_key, workers=1), sks)
+        self.assertEqual(unwrap_keys(keywraps[:2], RSA_key), sks[:2])
+        self.assertEqual(unwrap_keys([], RSA_key), [])
+
+        other_key = RSA.generate(3072)
+        self.assertRaises(ValueError, unwrap_keys, keywraps, other_key, 3)
@@ -15,16 +15,46 @@ this_dir = os.path.dirname(os.path.dirname(__file__))
 base_dir = os.path.join(this_dir, '../..')
 sys.path.append(base_dir)
 import math
+import time
 import ConfigParser
 import struct
 import hmac
+import logging
 from hashlib import sha1
+from multiprocessing import Pool
 
 from Crypto import Random
 from Crypto.PublicKey import RSA
 import pace.pki.key_wrap_utils as utils
 from pace.pki.keystore import KeyInfo
 
+logger = logging.getLogger(__name__)
+
+def report_progress(num_users, num_keys, elapsed):
+    """ Logs the progress of KeyGen.initialize_users at the INFO level; can
+        be passed as its progress argument.
+
+        Arguments:
+        num_users (integer) - the number of users whose keys have been stored
+        num_keys (integer) - the number of keys that have been stored
+        elapsed (float) - the number of seconds since initialization started
+    """
+    rate = num_users / elapsed if elapsed > 0 else 0.0
+    logger.info('Initialized %d users (%d keys) in %.1fs, %.1f users/s',
+                num_users, num_keys, elapsed, rate)
+
+# The key generator each worker process of KeyGen.initialize_users uses
+_worker_keygen = None
+
+def _init_keygen_worker(keygen_class, msk):
+    global _worker_keygen
+    _worker_keygen = keygen_class(msk)
+
+def _wrap_in_worker(user):
+    userid, exported_pk, info = user
+    return userid, _worker_keygen._wrap_user_keys(RSA.importKey(exported_pk),
+                                                  info)
+
 class KeyGen(object):
     def __init__(self, msk):
         """ Initializes key generator with master secret key.
@@ -84,7 +114,8 @@ class KeyGen(object):
             key += block
         return key[:keylen]
 
-    def initialize_users(self, users, keystore):
+    def initialize_users(self, users, keystore, workers=1, progress=None,
+                         report_every=1000):
         """ Generates users' keys, wraps them with their public keys, and 
             stores the keywraps and associated info in the key store.
             
@@ -98,16 +129,72 @@ class KeyGen(object):
                 Note: attr, vers, and metadata strings must not contain the '|' 
                 character.
             keystore (AbstractKeyStore) - the key store to be written to
+            workers (optional integer) - the number of processes to generate
+                and wrap keys in. Defaults to 1, generating and wrapping them
+                in this process.
+            progress (optional function) - called with the number of users
+                and keys stored so far and the number of seconds elapsed
+                after every report_every users, and once all users' keys are 
+                stored; e.g. report_progress
+            report_every (optional integer) - how many users to store between
+                calls to progress, defaults to 1000
+
+            The keys of all users are stored with a single call to the key
+            store's bulk_insert, as they are generated and wrapped.
+        """
+        start = time.time()
+        counts = [0, 0]
+
+        if workers > 1:
+            pool = Pool(workers, _init_keygen_worker, (type(self), self._msk))
+            tasks = ((userid, RSA_pk.exportKey(), info)
+                     for userid, (RSA_pk, info) in users.iteritems())
+            wrapped = pool.imap_unordered(_wrap_in_worker, tasks,
+                                          chunksize=16)
+        else:
+            pool = None
+            wrapped = ((userid, self._wrap_user_keys(RSA_pk, info))
+                       for userid, (RSA_pk, info) in users.iteritems())
+
+        def counted():
+            for userid, keywraps in wrapped:
+                yield userid, keywraps
+                counts[0] += 1
+                counts[1] += len(keywraps)
+                if progress is not None and counts[0] % report_every == 0:
+                    progress(counts[0], counts[1], time.time() - start)
+
+        try:
+            keystore.bulk_insert(counted())
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        # Report the final counts, unless they were just reported
+        if progress is not None and (counts[0] == 0 or counts[0] % report_every):
+            progress(counts[0], counts[1], time.time() - start)
+
+    def _wrap_user_keys(self, RSA_pk, info):
+        """ Generates a user's keys and wraps them with their public key.
+
+            Arguments:
+            RSA_pk (_RSAobj) - the user's RSA public key
+            info ([(string, string, string, integer)]) - list of (attr, vers,
+                metadata, keylen) tuples describing the keys to generate, as
+                for initialize_users
+
+            Returns:
+            A list of KeyInfo tuples with the keywraps of the user's keys.
         """
-        for userid, (RSA_pk, info) in users.iteritems():
-            keywraps = []
-            for attr, vers, metadata, keylen in info:
-                sk = self._generate_key(attr, vers, metadata, keylen)
-                keywrap = utils.wrap_key(sk, RSA_pk)
-                keywraps.append(KeyInfo(attr, vers, metadata, keywrap, keylen))
-            keystore.batch_insert(userid, keywraps)
-
-    def init_from_file(self, user_file, keystore):
+        keywraps = []
+        for attr, vers, metadata, keylen in info:
+            sk = self._generate_key(attr, vers, metadata, keylen)
+            keywrap = utils.wrap_key(sk, RSA_pk)
+            keywraps.append(KeyInfo(attr, vers, metadata, keywrap, keylen))
+        return keywraps
+
+    def init_from_file(self, user_file, keystore, workers=1, progress=None):
         """ Given a user configuration file, generates users' keys, wraps them 
             with their public keys, and stores the keywraps and associated info
             in the key store.
@@ -127,12 +214,16 @@ class KeyGen(object):
                 See user_info.cfg for an example.
                 #TODO: allow pipe character within a quoted string
             keystore (AbstractKeyStore) - the key store to be written to
+            workers (optional integer) - the number of processes to generate
+                and wrap keys in (see initialize_users)
+            progress (optional function) - called with the progress of the
+                initialization (see initialize_users)
 
             Raises an IOError if any of the public key files listed within 
             the config file cannot be opened.
         """
         users = self.file_to_dict(user_file)
-        self.initialize_users(users, keystore)
+        self.initialize_users(users, keystore, workers, progress)
 
     @staticmethod
     def file_to_dict(user_file):
@@ -22,12 +22,13 @@ import random
 import ConfigParser
 import shutil
 import hmac
+import logging
 from hashlib import sha1
 from binascii import unhexlify
 
 from Crypto.PublicKey import RSA
 from pace.common.pacetest import PACETestCase
-from pace.pki.keygen import KeyGen
+from pace.pki.keygen import KeyGen, report_progress
 from pace.pki.keystore import DummyKeyStore,KeyInfo
 from pace.pki.attrusermap import LocalAttrUserMap
 from pace.pki.userattrmap import LocalUserAttrMap
@@ -328,6 +329,67 @@ class KeyGenTests(PACETestCase):
                 self.assertEqual(utils.unwrap_key(keywrap, RSA_sks[userid]), 
                                  keygen._generate_key(attr, vers, meta, keylen))
 
+    def test_initialize_parallel(self):
+        """ Check that keys generated and wrapped in several processes can
+            be retrieved and unwrapped with the users' secret keys, and 
+            that progress is reported.
+        """
+
+        keygen = KeyGen('Sixteen byte key')
+        keystore = DummyKeyStore()
+
+        users = {}
+        RSA_sks = {}
+        for i in xrange(self.num_users):
+            userid = 'user'+str(i)
+            RSA_key = RSA.generate(3072)
+            RSA_sks[userid] = RSA_key
+            users[userid] = (RSA_key.publickey(),
+                             [('attr'+str(i % 3), 1, 'meta', 16),
+                              ('', 1, 'meta', 32)])
+
+        reports = []
+        keygen.initialize_users(users, keystore, workers=3,
+                                progress=lambda *report: reports.append(report),
+                                report_every=4)
+
+        for userid, (RSA_pk, info) in users.iteritems():
+            for attr, vers, meta, keylen in info:
+                keywrap = keystore.retrieve(userid, attr, vers, meta)
+                self.assertEqual(utils.unwrap_key(keywrap, RSA_sks[userid]), 
+                                 keygen._generate_key(attr, vers, meta, keylen))
+
+        self.assertEqual([(users_done, keys_done) 
+                          for users_done, keys_done, _ in reports],
+                         [(4, 8), (8, 16), (self.num_users, 2 * self.num_users)])
+
+    def test_report_progress(self):
+        """ Check that report_progress logs rather than printing.
+        """
+
+        records = []
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        logger = logging.getLogger('pace.pki.keygen')
+        handler = ListHandler()
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            report_progress(10, 20, 2.0)
+            report_progress(0, 0, 0.0)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        self.assertEqual([record.getMessage() for record in records],
+                         ['Initialized 10 users (20 keys) in 2.0s, 5.0 users/s',
+                          'Initialized 0 users (0 keys) in 0.0s, 0.0 users/s'])
+        self.assertEqual(set(record.levelno for record in records),
+                         set([logging.INFO]))
+
     def create_configs_from_dict(self, user_info, filename):
         """ Takes in a dictionary of user info, generates RSA key pair files, 
             and creates a configuration file. For each user, the RSA public and 
@@ -36,10 +36,42 @@ KeyInfo = namedtuple('KeyInfo', 'attr, vers, metadata, keywrap, keylen')
 
 class AbstractKeyStore(object):
     """ Abstract interface for key stores to implement.
+
+        Implementations call _keys_changed() after inserting or removing
+        keys, so that the listeners registered with add_listener() can
+        discard anything they derived from the old keys.
     """
 
     __metaclass__ = ABCMeta
 
+    def add_listener(self, listener):
+        """ Register a function to be called whenever keys are inserted
+            into or removed from the key store through this object.
+            Changes made through other objects, for example by other
+            processes, are not seen.
+
+            Arguments:
+
+            self - the KeyStore object being listened to
+            listener : function - called as listener(userid, metadata, attr)
+                       for each user, metadata and attribute whose keys
+                       changed
+        """
+        if getattr(self, '_listeners', None) is None:
+            self._listeners = []
+        self._listeners.append(listener)
+
+    def _keys_changed(self, changes):
+        """ Call the registered listeners for each (userid, metadata,
+            attr) tuple in changes.
+        """
+        listeners = getattr(self, '_listeners', None)
+        if not listeners:
+            return
+        for userid, metadata, attr in changes:
+            for listener in listeners:
+                listener(userid, metadata, attr)
+
     @abstractmethod
     def insert(self, userid, keyinfo):
         """ Insert a wrapped key into the key store.
@@ -122,6 +154,24 @@ class AbstractKeyStore(object):
         """
         pass
 
+    def bulk_insert(self, user_infos):
+        """ Add the keys of many users into the key store at once, e.g.
+            when provisioning users, to avoid the overhead of a batch 
+            insertion per user.
+
+            Arguments:
+
+            self - the KeyStore object being written to
+            user_infos : iterable of (string, [KeyInfo]) - (userid, infos)
+                    pairs of the ID of a user and the list of that user's
+                    KeyInfo objects, as for batch_insert(). The pairs are
+                    consumed one at a time, so they can be generated as
+                    they are inserted.
+        """
+        # simple default implementation
+        for userid, infos in user_infos:
+            self.batch_insert(userid, infos)
+
     @abstractmethod
     def batch_retrieve(self, userid, metadata, attr=None):
         """ Fetch all of a user's keys at once. Optionally, fetch only their
@@ -191,6 +241,10 @@ class AbstractKeyStore(object):
             and metadata. "Latest" here means that the integer that the
             version contains has the greatest magnitude (e.g. '10' is
             more recent than '2' because 10 > 2 even though '2' > '10').
+
+            A user who was not given the latest version of a key has no
+            latest key, and PKILookupError is raised. Implementations
+            that override this method must do the same.
             
             self - the KeyStore object being read from
             userid : string - the ID of the user whose keys to fetch
@@ -227,6 +281,28 @@ class AbstractKeyStore(object):
         """
         pass
 
+    def retrieve_latest_version_numbers(self, metadata, attrs):
+        """ Return the most recent version numbers for several attributes
+            with the same metadata. Key stores that can look them up 
+            together should override this.
+            
+            self - the KeyStore object being read from
+            metadata : string - the metadata of the key versions to search for
+            attrs : string iterable - the attributes to search for
+
+            Returns:
+
+            {string: int} - the version number for each attribute that
+                            has one; attributes without one are left out
+        """
+        versions = {}
+        for attr in set(attrs):
+            try:
+                versions[attr] = self.retrieve_latest_version_number(metadata, attr)
+            except PKILookupError:
+                pass
+        return versions
+
 
 class DummyKeyStore(AbstractKeyStore):
     
@@ -277,6 +353,8 @@ class DummyKeyStore(AbstractKeyStore):
         self.vnums[(keyinfo.attr, metadata)] = max(
             self.vnums[(keyinfo.attr, metadata)], keyinfo.vers)
 
+        self._keys_changed([(userid, metadata, keyinfo.attr)])
+
     def retrieve_info(self, userid, attr, vers, metadata):
         """ Attempt to retrieve a wrapped key from the key store.
 
@@ -416,6 +494,8 @@ class DummyKeyStore(AbstractKeyStore):
         except KeyError:
             pass
 
+        self._keys_changed([(userid, metadata, attr)])
+
     def get_metadatas(self, user, attr):
         """ Get all metadatas that a given user and attribute have.
 
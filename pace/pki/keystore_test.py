@@ -572,6 +572,39 @@ def _check_most_recent_num_many(self, ks_gen):
         vers = ks.retrieve_latest_version_number(metadata, attr)
         self.assertEqual(vers, max(versions))
 
+def _check_most_recent_nums(self, ks):
+    """ Make sure the latest version numbers of several attributes are
+        the same as when looked up one at a time, and that the Accumulo
+        key stores read them with a single batch scan of the attributes'
+        rows.
+    """
+    ks.batch_insert('user', [KeyInfo(attr, vers, meta, 'wrap', 0)
+                             for (attr, top) in [('A', 3), ('B', 1), ('D', 2)]
+                             for vers in xrange(1, top + 1)
+                             for meta in ['metadata', 'betadata']])
+    ks.insert('user', KeyInfo('C', 5, 'betadata', 'wrap', 0))
+
+    scans = []
+    conn = getattr(ks, 'conn', None)
+    if conn is not None:
+        batch_scan = conn.batch_scan
+        def counting_scan(table, scanranges=None, cols=None):
+            scans.append((table, sorted(r.srow for r in scanranges)))
+            self.assertTrue(all(r.srow == r.erow for r in scanranges))
+            return batch_scan(table, scanranges, cols)
+        conn.batch_scan = counting_scan
+        conn.scan = None
+
+    self.assertEqual(ks.retrieve_latest_version_numbers('metadata',
+                                                        ['A', 'B', 'C', 'D', 'E']),
+                     {'A' : 3, 'B' : 1, 'D' : 2})
+    self.assertEqual(ks.retrieve_latest_version_numbers('betadata', ['C', 'A']),
+                     {'A' : 3, 'C' : 5})
+    self.assertEqual(ks.retrieve_latest_version_numbers('metadata', []), {})
+    if conn is not None:
+        self.assertEqual(scans, [(ks.vers_table, ['A', 'B', 'C', 'D', 'E']),
+                                 (ks.vers_table, ['A', 'C'])])
+
 def _check_remkeys(self, ks):
     """ Make sure basic key removal functionality works.
     """
@@ -891,6 +924,131 @@ def _check_avoid_aliasing(self, ks):
     ks.remove_revoked_keys('user1', 'metadata', 'A')
     self.assertEqual(set(metas), set(['metadata', 'betadata']))
 
+def _check_latest_table(self, ks):
+    """ Make sure a key store with a latest key table looks up the latest
+        key with a single scan, and forgets it when keys are revoked.
+    """
+    ks.batch_insert('user1', [KeyInfo('A', 1, 'metadata', 'wrap1', 16),
+                              KeyInfo('A', 2, 'metadata', 'wrap,2', 16)])
+    ks.insert('user2', KeyInfo('A', 2, 'metadata', 'other2', 16))
+    ks.insert('user1', KeyInfo('A', 1, 'metadata', 'wrap1', 16))
+
+    scans = []
+    scan = ks.conn.scan
+    def counting_scan(*args, **kwargs):
+        scans.append(args[0])
+        return scan(*args, **kwargs)
+    ks.conn.scan = counting_scan
+
+    self.assertEqual(ks.retrieve_latest_version('user1', 'metadata', 'A'),
+                     KeyInfo('A', 2, 'metadata', 'wrap,2', 16))
+    self.assertEqual(ks.retrieve_latest_version('user2', 'metadata', 'A'),
+                     KeyInfo('A', 2, 'metadata', 'other2', 16))
+    self.assertEqual(scans, [ks.latest_table, ks.latest_table])
+
+    ks.remove_revoked_keys('user1', 'metadata', 'A')
+    try:
+        ks.retrieve_latest_version('user1', 'metadata', 'A')
+        self.assertTrue(False, 'Should fail to retrieve deleted keys')
+    except PKILookupError:
+        pass
+
+def _check_missed_latest(self, ks):
+    """ Make sure a user who was not given the latest version of a key
+        gets a PKILookupError, whether or not the key store keeps a latest
+        key table, and gets the key again once given the latest version.
+    """
+    ks.insert('user1', KeyInfo('A', 1, 'metadata', 'wrap1', 16))
+    ks.insert('user2', KeyInfo('A', 1, 'metadata', 'other1', 16))
+    ks.batch_insert('user3', [KeyInfo('A', 1, 'metadata', 'third1', 16),
+                              KeyInfo('B', 1, 'metadata', 'thirdB', 16)])
+    self.assertEqual(ks.retrieve_latest_version('user1', 'metadata', 'A'),
+                     KeyInfo('A', 1, 'metadata', 'wrap1', 16))
+
+    ks.insert('user2', KeyInfo('A', 2, 'metadata', 'other2', 16))
+    self.assertEqual(ks.retrieve_latest_version('user2', 'metadata', 'A'),
+                     KeyInfo('A', 2, 'metadata', 'other2', 16))
+    for userid in ['user1', 'user3']:
+        try:
+            ks.retrieve_latest_version(userid, 'metadata', 'A')
+            self.assertTrue(False, 'Should fail to retrieve a missed version')
+        except PKILookupError:
+            pass
+
+    # Other attributes are left alone
+    self.assertEqual(ks.retrieve_latest_version('user3', 'metadata', 'B'),
+                     KeyInfo('B', 1, 'metadata', 'thirdB', 16))
+
+    ks.insert('user1', KeyInfo('A', 2, 'metadata', 'wrap2', 16))
+    self.assertEqual(ks.retrieve_latest_version('user1', 'metadata', 'A'),
+                     KeyInfo('A', 2, 'metadata', 'wrap2', 16))
+
+def _latest_or_none(ks, userid, meta, attr):
+    try:
+        return ks.retrieve_latest_version(userid, meta, attr)
+    except PKILookupError:
+        return None
+
+def _check_bulk_insert(self, ks_gen):
+    """ Make sure inserting many users' keys at once stores the same keys
+        and latest versions as inserting each user's keys separately.
+    """
+    user_infos = [('user%d' %i,
+                   [KeyInfo(attr, vers, meta, 'wrap%d%s%d%s' %(i, attr, vers, meta), 16)
+                    for attr in ['A', 'B'][:i % 2 + 1]
+                    for vers in xrange(1, i % 3 + 2)
+                    for meta in ['meta1', 'meta2']])
+                  for i in xrange(10)]
+
+    bulk = ks_gen()
+    bulk.bulk_insert(iter(user_infos))
+    separate = ks_gen()
+    for userid, infos in user_infos:
+        separate.batch_insert(userid, infos)
+
+    for userid, infos in user_infos:
+        for meta in ['meta1', 'meta2']:
+            self.assertEqual(sorted(bulk.batch_retrieve(userid, meta)),
+                             sorted(separate.batch_retrieve(userid, meta)))
+            for attr in set(info.attr for info in infos):
+                self.assertEqual(bulk.get_metadatas(userid, attr),
+                                 set(['meta1', 'meta2']))
+                self.assertEqual(bulk.retrieve_latest_version_number(meta, attr), 3)
+                self.assertEqual(_latest_or_none(bulk, userid, meta, attr),
+                                 _latest_or_none(separate, userid, meta, attr))
+
+    try:
+        bulk.bulk_insert([('user10', [KeyInfo('C', '1', 'meta1', 'wrap', 16)])])
+        self.assertTrue(False, 'Should fail to insert a non-integer version')
+    except PKIStorageError:
+        pass
+
+def _check_listeners(self, ks):
+    """ Make sure the listeners of a key store are told about keys
+        that are inserted and removed.
+    """
+
+    changes = []
+    ks.add_listener(lambda *change: changes.append(change))
+
+    ks.insert('user1', KeyInfo('A', 1, 'meta1', 'wrap1', 0))
+    self.assertEqual(changes, [('user1', 'meta1', 'A')])
+
+    del changes[:]
+    ks.batch_insert('user1', [KeyInfo('A', 2, 'meta1', 'wrap2', 0),
+                              KeyInfo('B', 1, 'meta2', 'wrap3', 0)])
+    self.assertEqual(sorted(set(changes)),
+                     [('user1', 'meta1', 'A'), ('user1', 'meta2', 'B')])
+
+    del changes[:]
+    ks.bulk_insert([('user2', [KeyInfo('A', 2, 'meta1', 'wrap4', 0)]),
+                    ('user3', [KeyInfo('', 1, 'meta1', 'wrap5', 0)])])
+    self.assertEqual(sorted(set(changes)),
+                     [('user2', 'meta1', 'A'), ('user3', 'meta1', '')])
+
+    del changes[:]
+    ks.remove_revoked_keys('user1', 'meta1', 'A')
+    self.assertEqual(changes, [('user1', 'meta1', 'A')])
 
 def _dummy_gen():
     return DummyKeyStore()
@@ -903,9 +1061,15 @@ def _attr_gen():
     conn = FakeConnection()
     return AccumuloAttrKeyStore(conn)
 
+def _latest_gen():
+    conn = FakeConnection()
+    return AccumuloKeyStore(conn, latest_table='__LATEST_KEYWRAP__')
+
 def test_all():
     self = DummyTest()
-    generators = [_dummy_gen, _acc_gen, _attr_gen]
+    generators = [_dummy_gen, _acc_gen, _attr_gen, _latest_gen]
+
+    yield _check_latest_table, self, _latest_gen()
 
     for gen in generators:
         yield _check_write_read, self, gen()
@@ -926,6 +1090,8 @@ def test_all():
         yield _check_most_recent_many, self, gen
         yield _check_most_recent_num, self, gen()
         yield _check_most_recent_num_many, self, gen
+        yield _check_most_recent_nums, self, gen()
+        yield _check_missed_latest, self, gen()
         yield _check_remkeys, self, gen()
         yield _check_remkeys_multi_user, self, gen()
         yield _check_remkeys_multi_attr, self, gen()
@@ -935,3 +1101,5 @@ def test_all():
         yield _check_get_metas, self, gen()
         yield _check_get_metas_remove, self, gen()
         yield _check_avoid_aliasing, self, gen()
+        yield _check_bulk_insert, self, gen
+        yield _check_listeners, self, gen()
@@ -43,7 +43,6 @@ setup(
 	# They can be installed using install.sh or by checking the dependency
 	# list in the README and downloaded manually.
 	install_requires=[
-		'Beaker>=1.7.0',
 		'enum34>=1.0.4',
 		'nose>=1.1.2',
 		'pyaccumulo>=1.5.0.6',